@@ -0,0 +1,233 @@
+"""
+同時実行数の制御（アドミッションコントロール）
+
+claude プロセスの同時実行数を制限し、待ち行列の長さにも上限を設ける。
+待ち行列が満杯の場合は即座に拒否し、呼び出し側で 429/503 + Retry-After を返す。
+
+実行枠は優先度レーン（interactive > task > background）ごとに上限を持ち、
+空いた枠は優先度の高いレーンから割り当てる。同じレーン内では呼び出し元
+（ギルドやユーザー）ごとにラウンドロビンで割り当て、呼び出し元ごとの同時実行数にも上限を設ける。
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# 優先度の高い順
+LANES = ("interactive", "task", "background")
+DEFAULT_LANE = "interactive"
+
+queue_wait_seconds = registry.histogram(
+    "claude_queue_wait_seconds", "実行枠を確保するまでの待ち時間", ["lane"]
+)
+
+
+class AdmissionError(Exception):
+    """実行枠を確保できなかった場合の基底例外"""
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(AdmissionError):
+    """待ち行列が満杯（即時拒否）"""
+
+    status_code = 429
+
+
+class QueueTimeoutError(AdmissionError):
+    """待ち行列で一定時間待っても実行枠が空かなかった"""
+
+    status_code = 503
+
+
+@dataclass(eq=False)
+class Ticket:
+    """確保した（または確保待ちの）実行枠"""
+    lane: str
+    caller: str
+    enqueued_at: float = field(default_factory=time.monotonic)
+    future: Optional[asyncio.Future] = None
+    granted: bool = False
+
+
+class AdmissionController:
+    """claude 実行枠の管理
+
+    Args:
+        max_concurrency: 同時に実行できる claude プロセス数
+        max_queue: 実行枠の空き待ちをできるリクエスト数（0 なら待たずに拒否）
+        queue_timeout_sec: 待ち行列での最大待ち時間（None なら無制限）
+        retry_after_sec: 拒否時に Retry-After ヘッダーで返す秒数
+        lane_limits: レーンごとの同時実行数の上限（省略したレーンは max_concurrency）
+        caller_limit: 呼び出し元ごとの同時実行数の上限（None なら無制限）
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue: int,
+        queue_timeout_sec: Optional[float] = None,
+        retry_after_sec: int = 5,
+        lane_limits: Optional[Dict[str, int]] = None,
+        caller_limit: Optional[int] = None,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout_sec = queue_timeout_sec
+        self.retry_after_sec = retry_after_sec
+        lane_limits = lane_limits or {}
+        self.lane_limits = {
+            lane: max(1, min(lane_limits.get(lane, self.max_concurrency), self.max_concurrency))
+            for lane in LANES
+        }
+        self.caller_limit = caller_limit
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._running_by_lane: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._running_by_caller: Dict[str, int] = {}
+        # レーン → 呼び出し元 → 待ちチケット（呼び出し元の並びをラウンドロビンに使う）
+        self._queues: Dict[str, "OrderedDict[str, Deque[Ticket]]"] = {lane: OrderedDict() for lane in LANES}
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "lanes": {
+                lane: {
+                    "running": self._running_by_lane[lane],
+                    "waiting": sum(len(q) for q in self._queues[lane].values()),
+                    "limit": self.lane_limits[lane],
+                }
+                for lane in LANES
+            },
+        }
+
+    def is_full(self) -> bool:
+        """実行枠と待ち行列がすべて埋まっているか"""
+        return self.running + self.waiting >= self.max_concurrency + self.max_queue
+
+    def _can_run(self, ticket: Ticket) -> bool:
+        if self.running >= self.max_concurrency:
+            return False
+        if self._running_by_lane[ticket.lane] >= self.lane_limits[ticket.lane]:
+            return False
+        if self.caller_limit and ticket.caller and self._running_by_caller.get(ticket.caller, 0) >= self.caller_limit:
+            return False
+        return True
+
+    def _grant(self, ticket: Ticket):
+        ticket.granted = True
+        self.running += 1
+        self._running_by_lane[ticket.lane] += 1
+        if ticket.caller:
+            self._running_by_caller[ticket.caller] = self._running_by_caller.get(ticket.caller, 0) + 1
+        queue_wait_seconds.observe(time.monotonic() - ticket.enqueued_at, lane=ticket.lane)
+        if ticket.future and not ticket.future.done():
+            ticket.future.set_result(None)
+
+    def _dispatch(self):
+        """空いている実行枠を待ちチケットに割り当てる"""
+        while self.running < self.max_concurrency:
+            granted = False
+            for lane in LANES:
+                callers = self._queues[lane]
+                for caller in list(callers):
+                    tickets = callers[caller]
+                    if not self._can_run(tickets[0]):
+                        continue
+                    ticket = tickets.popleft()
+                    # 割り当てた呼び出し元は末尾へ回す（ラウンドロビン）
+                    del callers[caller]
+                    if tickets:
+                        callers[caller] = tickets
+                    self.waiting -= 1
+                    self._grant(ticket)
+                    granted = True
+                    break
+                if granted:
+                    break
+            if not granted:
+                return
+
+    def _remove(self, ticket: Ticket):
+        callers = self._queues[ticket.lane]
+        tickets = callers.get(ticket.caller)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            self.waiting -= 1
+            if not tickets:
+                del callers[ticket.caller]
+
+    async def acquire(self, lane: str = DEFAULT_LANE, caller: Optional[str] = None) -> Ticket:
+        """実行枠を確保する（確保できない場合は AdmissionError）"""
+        if lane not in self._queues:
+            lane = DEFAULT_LANE
+        if self.is_full():
+            self.rejected += 1
+            logger.warning(
+                f"🚫 待ち行列が満杯のため拒否 (lane={lane}, running={self.running}, waiting={self.waiting})"
+            )
+            raise QueueFullError("実行待ちのリクエストが多すぎます", self.retry_after_sec)
+
+        ticket = Ticket(lane=lane, caller=caller or "")
+        ticket.future = asyncio.get_running_loop().create_future()
+        self._queues[lane].setdefault(ticket.caller, deque()).append(ticket)
+        self.waiting += 1
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout=self.queue_timeout_sec)
+        except asyncio.TimeoutError:
+            if not ticket.granted:
+                self._remove(ticket)
+                self.rejected += 1
+                logger.warning(f"⌛ 実行枠の待ち時間が {self.queue_timeout_sec} 秒を超えました (lane={lane})")
+                raise QueueTimeoutError("実行枠の空き待ちがタイムアウトしました", self.retry_after_sec)
+        except asyncio.CancelledError:
+            # 待っている間に呼び出し元がいなくなった
+            if ticket.granted:
+                self.release(ticket)
+            else:
+                self._remove(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket):
+        """acquire() で確保した実行枠を返却する"""
+        if not ticket.granted:
+            return
+        ticket.granted = False
+        self.running -= 1
+        self._running_by_lane[ticket.lane] -= 1
+        if ticket.caller:
+            remaining = self._running_by_caller.get(ticket.caller, 1) - 1
+            if remaining > 0:
+                self._running_by_caller[ticket.caller] = remaining
+            else:
+                self._running_by_caller.pop(ticket.caller, None)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, lane: str = DEFAULT_LANE, caller: Optional[str] = None):
+        """実行枠を確保する（async with で使用）"""
+        ticket = await self.acquire(lane, caller)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+負荷試験用の claude のスタブ
+
+本物の CLI と同じ形の出力（--output-format json / stream-json、--input-format stream-json）を返す。
+API には接続せず、環境変数で応答時間・出力サイズ・失敗を調整する。
+起動時間そのものが計測に混ざらないよう、標準ライブラリの軽いモジュールだけを使う（python -S で起動する）。
+
+環境変数:
+    FAKE_CLAUDE_STARTUP_MS: 起動にかかる時間（Node.js の起動の代わり）
+    FAKE_CLAUDE_LATENCY_MS: 応答までの時間
+    FAKE_CLAUDE_JITTER_MS: 応答時間のばらつき（0〜この値を足す）
+    FAKE_CLAUDE_OUTPUT_BYTES: result の文字数
+    FAKE_CLAUDE_EVENTS: stream-json で result の前に出す assistant / tool_result イベントの組数
+    FAKE_CLAUDE_ERROR_RATE: 失敗する割合（0〜1）
+    FAKE_CLAUDE_EXIT_CODE: 失敗したときの終了コード
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+STARTUP_SEC = float(os.getenv("FAKE_CLAUDE_STARTUP_MS", "0")) / 1000
+LATENCY_SEC = float(os.getenv("FAKE_CLAUDE_LATENCY_MS", "100")) / 1000
+JITTER_SEC = float(os.getenv("FAKE_CLAUDE_JITTER_MS", "0")) / 1000
+OUTPUT_BYTES = int(os.getenv("FAKE_CLAUDE_OUTPUT_BYTES", "200"))
+EVENTS = int(os.getenv("FAKE_CLAUDE_EVENTS", "2"))
+ERROR_RATE = float(os.getenv("FAKE_CLAUDE_ERROR_RATE", "0"))
+EXIT_CODE = int(os.getenv("FAKE_CLAUDE_EXIT_CODE", "1"))
+
+
+def emit(event: dict):
+    sys.stdout.write(json.dumps(event, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def option(name: str, default=None):
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+def result_event(session_id: str, failed: bool, duration_ms: int) -> dict:
+    if failed:
+        return {
+            "type": "result", "subtype": "error_during_execution", "is_error": True,
+            "result": "API Error: 529 overloaded (fake)", "session_id": session_id,
+        }
+    return {
+        "type": "result",
+        "subtype": "success",
+        "is_error": False,
+        "duration_ms": duration_ms,
+        "num_turns": EVENTS + 1,
+        "result": ("x" * OUTPUT_BYTES),
+        "session_id": session_id,
+        "total_cost_usd": 0.0,
+        "usage": {"input_tokens": 10, "output_tokens": max(1, OUTPUT_BYTES // 4)},
+    }
+
+
+def run_turn(session_id: str, stream: bool) -> bool:
+    """1ターン分の応答を出す。失敗したら False"""
+    start = time.monotonic()
+    failed = random.random() < ERROR_RATE
+    latency = LATENCY_SEC + random.uniform(0, JITTER_SEC)
+    if stream:
+        emit({"type": "system", "subtype": "init", "session_id": session_id, "model": "fake"})
+        step = latency / (EVENTS + 1)
+        for i in range(EVENTS):
+            time.sleep(step)
+            emit({"type": "assistant", "session_id": session_id, "message": {"content": [
+                {"type": "text", "text": f"step {i}"},
+                {"type": "tool_use", "id": f"tool_{i}", "name": "Read", "input": {"file_path": "README.md"}},
+            ]}})
+            emit({"type": "user", "session_id": session_id, "message": {"content": [
+                {"type": "tool_result", "tool_use_id": f"tool_{i}", "content": "ok"},
+            ]}})
+        time.sleep(step)
+    else:
+        time.sleep(latency)
+    emit(result_event(session_id, failed, int((time.monotonic() - start) * 1000)))
+    return not failed
+
+
+def main():
+    time.sleep(STARTUP_SEC)
+    session_id = option("--resume") or os.urandom(16).hex()
+    stream = option("--output-format", "text") == "stream-json"
+
+    if option("--input-format") == "stream-json":
+        # 事前起動ワーカー: stdin の user メッセージごとに1ターン
+        for line in sys.stdin:
+            if line.strip():
+                run_turn(session_id, stream=True)
+        return 0
+
+    return 0 if run_turn(session_id, stream) else EXIT_CODE
+
+
+if __name__ == "__main__":
+    sys.exit(main())
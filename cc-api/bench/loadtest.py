@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""
+cc-api の負荷試験
+
+claude のスタブ（fake_claude.py）を PATH に置いて cc-api を起動し、
+/v1/claude/run（または /v1/claude/run/stream）に指定した同時接続数でリクエストを送り続ける。
+API に接続しないので、オフラインでスループットの変化や劣化を確認できる。
+
+計測する値:
+    - スループット（req/s）、レイテンシ（p50 / p95 / p99 / max）、ステータスコードごとの件数
+    - サーバープロセスの RSS・スレッド数・CPU 時間、claude の子プロセス数（/proc から取得）
+
+使い方:
+    python bench/loadtest.py --requests 500 --concurrency 32 --latency-ms 200 \\
+        --server-env CC_API_MAX_CONCURRENCY=32 --server-env CC_API_MAX_QUEUE=64 --json result.json
+    python bench/loadtest.py ... --compare baseline.json   # 比較して劣化していたら終了コード 1
+"""
+
+import argparse
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+
+CC_API_DIR = Path(__file__).resolve().parent.parent
+FAKE_CLAUDE = Path(__file__).resolve().parent / "fake_claude.py"
+RESULT_VERSION = 1
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="cc-api の負荷試験（claude のスタブを使用）")
+    load = parser.add_argument_group("負荷")
+    load.add_argument("--requests", type=int, default=200, help="送るリクエスト数")
+    load.add_argument("--duration", type=float, default=0, help="指定すると件数ではなくこの秒数だけ送り続ける")
+    load.add_argument("--concurrency", type=int, default=8, help="同時接続数")
+    load.add_argument("--warmup", type=int, default=None, help="計測前に送るリクエスト数（既定: 同時接続数）")
+    load.add_argument("--endpoint", choices=["run", "stream"], default="run", help="run または run/stream")
+    load.add_argument("--lane", default="interactive")
+    load.add_argument("--same-prompt", action="store_true", help="全リクエストで同じプロンプトを送る（同一リクエストの集約を測る）")
+    load.add_argument("--timeout", type=float, default=120, help="1リクエストのタイムアウト秒")
+
+    fake = parser.add_argument_group("claude のスタブ")
+    fake.add_argument("--startup-ms", type=float, default=0)
+    fake.add_argument("--latency-ms", type=float, default=100)
+    fake.add_argument("--jitter-ms", type=float, default=0)
+    fake.add_argument("--output-bytes", type=int, default=200)
+    fake.add_argument("--events", type=int, default=2, help="stream-json で result の前に出すイベントの組数")
+    fake.add_argument("--error-rate", type=float, default=0)
+    fake.add_argument("--exit-code", type=int, default=1)
+
+    server = parser.add_argument_group("サーバー")
+    server.add_argument("--url", help="起動済みの cc-api を使う（スタブの設定は効かない）")
+    server.add_argument("--pid", type=int, help="--url のサーバーのプロセスID（リソースの計測用）")
+    server.add_argument("--port", type=int, default=18765)
+    server.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE", help="cc-api に渡す環境変数")
+
+    output = parser.add_argument_group("結果")
+    output.add_argument("--json", help="結果の JSON を書き出すパス（- なら標準出力）")
+    output.add_argument("--label", default="", help="結果に付けるラベル（ブランチ名など）")
+    output.add_argument("--compare", help="比較する過去の結果（JSON）")
+    output.add_argument("--tolerance", type=float, default=0.1, help="--compare で劣化とみなす変化の割合")
+    return parser.parse_args(argv)
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    # nearest-rank 法
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class ResourceSampler:
+    """サーバープロセスの RSS・スレッド数・子プロセス数を定期的に読む（Linux の /proc）"""
+
+    def __init__(self, pid: Optional[int], interval_sec: float = 0.2):
+        self.pid = pid
+        self.interval_sec = interval_sec
+        self.samples: List[Dict[str, float]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._cpu_start: Optional[float] = None
+
+    @property
+    def available(self) -> bool:
+        return self.pid is not None and os.path.exists(f"/proc/{self.pid}/status")
+
+    def _status(self) -> Dict[str, float]:
+        values = {}
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "VmRSS":
+                    values["rss_mb"] = int(value.split()[0]) / 1024
+                elif key == "Threads":
+                    values["threads"] = int(value)
+        return values
+
+    def _cpu_sec(self) -> float:
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def _descendants(self) -> int:
+        children: Dict[int, List[int]] = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        count, stack = 0, list(children.get(self.pid, []))
+        while stack:
+            pid = stack.pop()
+            count += 1
+            stack.extend(children.get(pid, []))
+        return count
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                sample = self._status()
+                sample["children"] = self._descendants()
+                self.samples.append(sample)
+            except OSError:
+                return
+            self._stop.wait(self.interval_sec)
+
+    def start(self):
+        if self.available:
+            self._cpu_start = self._cpu_sec()
+            self._thread.start()
+
+    def stop(self) -> Optional[dict]:
+        if not self.available or self._cpu_start is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        if not self.samples:
+            return None
+        return {
+            "rss_mb_peak": round(max(s["rss_mb"] for s in self.samples), 1),
+            "rss_mb_end": round(self.samples[-1]["rss_mb"], 1),
+            "threads_peak": max(s["threads"] for s in self.samples),
+            "threads_end": self.samples[-1]["threads"],
+            "children_peak": max(s["children"] for s in self.samples),
+            "cpu_sec": round(self._cpu_sec() - self._cpu_start, 2),
+        }
+
+
+class LocalServer:
+    """claude のスタブを PATH に置いて cc-api を起動する"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.url = f"http://127.0.0.1:{args.port}"
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="cc-api-bench-")
+        self.log_path = Path(self.tmpdir.name) / "server.log"
+        self.process: Optional[subprocess.Popen] = None
+
+    def _env(self) -> Dict[str, str]:
+        bindir = Path(self.tmpdir.name) / "bin"
+        bindir.mkdir()
+        wrapper = bindir / "claude"
+        wrapper.write_text(f'#!/bin/sh\nexec "{sys.executable}" -S "{FAKE_CLAUDE}" "$@"\n')
+        wrapper.chmod(0o755)
+
+        env = dict(os.environ)
+        env["PATH"] = f"{bindir}{os.pathsep}{env.get('PATH', '')}"
+        env.update({
+            "FAKE_CLAUDE_STARTUP_MS": str(self.args.startup_ms),
+            "FAKE_CLAUDE_LATENCY_MS": str(self.args.latency_ms),
+            "FAKE_CLAUDE_JITTER_MS": str(self.args.jitter_ms),
+            "FAKE_CLAUDE_OUTPUT_BYTES": str(self.args.output_bytes),
+            "FAKE_CLAUDE_EVENTS": str(self.args.events),
+            "FAKE_CLAUDE_ERROR_RATE": str(self.args.error_rate),
+            "FAKE_CLAUDE_EXIT_CODE": str(self.args.exit_code),
+        })
+        for item in self.args.server_env:
+            key, _, value = item.partition("=")
+            env[key] = value
+        return env
+
+    def start(self):
+        log = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+             "--port", str(self.args.port), "--log-level", "warning"],
+            cwd=CC_API_DIR, env=self._env(), stdout=log, stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"cc-api が起動できませんでした:\n{self.log_path.read_text()[-2000:]}")
+            try:
+                if requests.get(f"{self.url}/health", timeout=1).status_code == 200:
+                    return
+            except requests.exceptions.ConnectionError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("cc-api の起動がタイムアウトしました")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.tmpdir.cleanup()
+
+
+class LoadGenerator:
+    """同時接続数を保ってリクエストを送り続ける（クローズドループ）"""
+
+    def __init__(self, args: argparse.Namespace, url: str):
+        self.args = args
+        self.url = url
+        self.path = "/v1/claude/run" if args.endpoint == "run" else "/v1/claude/run/stream"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _payload(self, i: int) -> dict:
+        prompt = "load test" if self.args.same_prompt else f"load test #{i}"
+        return {"prompt": prompt, "lane": self.args.lane, "timeout_sec": max(1, int(self.args.timeout))}
+
+    def request(self, i: int) -> dict:
+        start = time.perf_counter()
+        try:
+            response = self._session().post(
+                f"{self.url}{self.path}", json=self._payload(i), timeout=self.args.timeout,
+                stream=self.args.endpoint == "stream",
+            )
+            if self.args.endpoint == "stream" and response.status_code == 200:
+                events = [json.loads(line) for line in response.iter_lines() if line]
+                ok = bool(events) and events[-1].get("event") == "end" and events[-1].get("exit_code") == 0
+            else:
+                ok = response.status_code == 200 and response.json().get("exit_code") == 0
+            status = str(response.status_code)
+        except requests.exceptions.RequestException as e:
+            ok, status = False, type(e).__name__
+        return {"latency": time.perf_counter() - start, "status": status, "ok": ok}
+
+    def _claim(self, limit: Optional[int], deadline: Optional[float]) -> Optional[int]:
+        with self._lock:
+            if limit is not None and self._next >= limit:
+                return None
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            self._next += 1
+            return self._next
+
+    def run(self, limit: Optional[int], duration: Optional[float]) -> List[dict]:
+        self._next = 0
+        deadline = time.monotonic() + duration if duration else None
+        results: List[dict] = []
+
+        def worker():
+            while (i := self._claim(limit, deadline)) is not None:
+                result = self.request(i)
+                with self._lock:
+                    results.append(result)
+
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            for _ in range(self.args.concurrency):
+                pool.submit(worker)
+        return results
+
+
+def summarize(results: List[dict], elapsed: float) -> dict:
+    latencies = sorted(r["latency"] * 1000 for r in results)
+    statuses: Dict[str, int] = {}
+    for r in results:
+        statuses[r["status"]] = statuses.get(r["status"], 0) + 1
+    ms = lambda v: round(v, 1) if v is not None else None
+    return {
+        "requests": len(results),
+        "ok": sum(1 for r in results if r["ok"]),
+        "failed": sum(1 for r in results if not r["ok"]),
+        "statuses": statuses,
+        "elapsed_sec": round(elapsed, 3),
+        "rps": round(len(results) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None),
+            "mean": ms(statistics.fmean(latencies) if latencies else None),
+        },
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=CC_API_DIR, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# --compare で見る値（名前, 取り出し方, 大きいほど良いか）
+COMPARED_METRICS = [
+    ("rps", lambda r: r["results"]["rps"], True),
+    ("p50_ms", lambda r: r["results"]["latency_ms"]["p50"], False),
+    ("p95_ms", lambda r: r["results"]["latency_ms"]["p95"], False),
+    ("p99_ms", lambda r: r["results"]["latency_ms"]["p99"], False),
+    ("rss_mb_peak", lambda r: (r.get("resources") or {}).get("rss_mb_peak"), False),
+    ("threads_peak", lambda r: (r.get("resources") or {}).get("threads_peak"), False),
+]
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """過去の結果と比べて表示し、劣化した値の名前を返す"""
+    regressions = []
+    print(f"\n📊 比較: {baseline.get('label') or baseline.get('git') or 'baseline'} → {current.get('label') or current.get('git') or 'current'}")
+    for name, get, higher_is_better in COMPARED_METRICS:
+        before, after = get(baseline), get(current)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        mark = "❌" if worse > tolerance else "✅"
+        if worse > tolerance:
+            regressions.append(name)
+        print(f"  {mark} {name:<13} {before:>10} → {after:>10} ({change:+.1%})")
+    return regressions
+
+
+def print_summary(result: dict):
+    r = result["results"]
+    lat = r["latency_ms"]
+    print(f"\n🏁 {r['requests']} リクエスト / {r['elapsed_sec']} 秒（同時接続 {result['config']['concurrency']}）")
+    print(f"   スループット: {r['rps']} req/s")
+    print(f"   レイテンシ(ms): p50 {lat['p50']} / p95 {lat['p95']} / p99 {lat['p99']} / max {lat['max']}")
+    print(f"   成功 {r['ok']} / 失敗 {r['failed']}  ステータス: {r['statuses']}")
+    resources = result.get("resources")
+    if resources:
+        print(
+            f"   サーバー: RSS 最大 {resources['rss_mb_peak']} MB / スレッド最大 {resources['threads_peak']}"
+            f" / 子プロセス最大 {resources['children_peak']} / CPU {resources['cpu_sec']} 秒"
+        )
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    server = None if args.url else LocalServer(args)
+    try:
+        if server:
+            print("🚀 claude のスタブで cc-api を起動しています...")
+            server.start()
+            url, pid = server.url, server.process.pid
+        else:
+            url, pid = args.url.rstrip("/"), args.pid
+
+        generator = LoadGenerator(args, url)
+        warmup = args.concurrency if args.warmup is None else args.warmup
+        if warmup:
+            generator.run(limit=warmup, duration=None)
+
+        sampler = ResourceSampler(pid)
+        sampler.start()
+        print(f"🔥 {args.endpoint} に同時接続 {args.concurrency} で送信中...")
+        start = time.perf_counter()
+        results = generator.run(
+            limit=None if args.duration else args.requests, duration=args.duration or None
+        )
+        elapsed = time.perf_counter() - start
+        resources = sampler.stop()
+    finally:
+        if server:
+            server.stop()
+
+    result = {
+        "version": RESULT_VERSION,
+        "label": args.label,
+        "git": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "endpoint": args.endpoint,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "duration": args.duration,
+            "same_prompt": args.same_prompt,
+            "fake_claude": None if args.url else {
+                "startup_ms": args.startup_ms,
+                "latency_ms": args.latency_ms,
+                "jitter_ms": args.jitter_ms,
+                "output_bytes": args.output_bytes,
+                "events": args.events,
+                "error_rate": args.error_rate,
+            },
+            "server_env": args.server_env,
+        },
+        "results": summarize(results, elapsed),
+        "resources": resources,
+    }
+    print_summary(result)
+
+    if args.json == "-":
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    elif args.json:
+        Path(args.json).write_text(json.dumps(result, ensure_ascii=False, indent=2) + "\n")
+        print(f"💾 結果を保存しました: {args.json}")
+
+    if args.compare:
+        regressions = compare(json.loads(Path(args.compare).read_text()), result, args.tolerance)
+        if regressions:
+            print(f"⚠️ 劣化しています: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
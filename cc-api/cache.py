@@ -0,0 +1,124 @@
+"""
+claude 実行結果のキャッシュ
+
+同じプロンプト・システムプロンプト・cwd・許可ツール・モデル設定の実行結果を再利用する。
+メモリ上の LRU（件数とバイト数で上限）に加え、任意で SQLite のディスク層を持つ。
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+cache_lookups = registry.counter(
+    "claude_cache_lookups_total", "結果キャッシュの参照回数", ["result", "tier"]
+)
+
+
+def cache_key(**parts) -> str:
+    """キーとなる要素から SHA-256 のキャッシュキーを作る"""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """TTL 付きの2層キャッシュ（メモリ LRU + 任意の SQLite）
+
+    Args:
+        ttl_sec: エントリの有効期間
+        max_entries: メモリに保持するエントリ数の上限
+        max_bytes: メモリに保持する JSON の合計バイト数の上限
+        db_path: SQLite ファイルのパス（None ならディスク層なし）
+    """
+
+    def __init__(self, ttl_sec: float, max_entries: int, max_bytes: int, db_path: Optional[str] = None):
+        self.ttl_sec = ttl_sec
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self._memory: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+            logger.info(f"💾 結果キャッシュのディスク層: {db_path}")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._memory),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_sec": self.ttl_sec,
+            "disk": self._db is not None,
+        }
+
+    def _remember(self, key: str, value: bytes, created_at: float):
+        if len(value) > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old:
+            self._bytes -= len(old[0])
+        self._memory[key] = (value, created_at)
+        self._bytes += len(value)
+        while len(self._memory) > self.max_entries or self._bytes > self.max_bytes:
+            _, (evicted, _) = self._memory.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def get(self, key: str) -> Optional[Tuple[dict, float]]:
+        """キャッシュを参照する
+
+        Returns:
+            (stdout_json, 経過秒数)。見つからない・期限切れなら None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[1] <= self.ttl_sec:
+                self._memory.move_to_end(key)
+                cache_lookups.inc(result="hit", tier="memory")
+                return json.loads(entry[0]), now - entry[1]
+            if entry:
+                self._memory.pop(key)
+                self._bytes -= len(entry[0])
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[1] <= self.ttl_sec:
+                    self._remember(key, row[0], row[1])
+                    cache_lookups.inc(result="hit", tier="disk")
+                    return json.loads(row[0]), now - row[1]
+                if row:
+                    self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                    self._db.commit()
+
+        cache_lookups.inc(result="miss", tier="")
+        return None
+
+    def put(self, key: str, data: dict):
+        value = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, value, now),
+                )
+                self._db.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl_sec,))
+                self._db.commit()
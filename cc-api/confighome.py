@@ -0,0 +1,254 @@
+"""
+ジョブごとの Claude 設定ディレクトリ（CLAUDE_CONFIG_DIR）
+
+すべての実行が同じ ~/.claude を共有すると、セッションの記録（projects/）や todos への
+書き込みが並列実行の間で競合し、ディレクトリも際限なく大きくなる。
+そこで実行ごとに設定ディレクトリを作り、読み取り専用のベース（~/.claude）から
+設定・認証情報・スキルだけを持ち込む。作成先を tmpfs（/dev/shm など）にすればディスクにも書かない。
+
+実行が終わったらセッションの記録（projects/**/*.jsonl）だけを保管場所に移してディレクトリを削除する。
+保管した記録は --resume のときに新しい設定ディレクトリへ持ち込む。
+古い記録は gzip で圧縮し、保持期間や合計サイズの上限を超えたものは削除する。
+"""
+
+import asyncio
+import glob
+import gzip
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# 書き込まれ得るのでコピーして持ち込むファイル
+SEED_COPY = (".credentials.json", "settings.json", "settings.local.json")
+# CLI の状態ファイル（オンボーディング・プロジェクトごとの状態）。
+# CLAUDE_CONFIG_DIR を指定した場合はその中に、指定しない場合は ~/.claude ではなく ~/.claude.json にある
+STATE_FILE = ".claude.json"
+# 読むだけなのでシンボリックリンクで持ち込むもの
+SEED_LINK = ("CLAUDE.md", "skills", "commands", "agents", "plugins")
+
+transcripts_removed = registry.counter(
+    "claude_transcripts_removed_total", "保管期間・容量の上限で削除したセッション記録の数", ["reason"]
+)
+
+
+@dataclass
+class ConfigHome:
+    """1回の実行で使う設定ディレクトリ"""
+    path: str
+
+    def env(self) -> Dict[str, str]:
+        return {**os.environ, "CLAUDE_CONFIG_DIR": self.path}
+
+
+def default_state_file(base_dir: str) -> str:
+    """base_dir に対応する CLI の状態ファイル
+
+    ベースの中にあればそれを（CLAUDE_CONFIG_DIR で作られた設定ディレクトリ）、
+    なければベースと同じ階層の .claude.json（~/.claude に対する ~/.claude.json）を使う。
+    """
+    inside = os.path.join(base_dir, STATE_FILE)
+    if os.path.isfile(inside):
+        return inside
+    return os.path.join(os.path.dirname(os.path.abspath(base_dir)), STATE_FILE)
+
+
+def _transcripts(directory: str) -> List[str]:
+    return glob.glob(os.path.join(directory, "projects", "*", "*.jsonl")) + glob.glob(
+        os.path.join(directory, "projects", "*", "*.jsonl.gz")
+    )
+
+
+class ConfigHomeManager:
+    """実行ごとの設定ディレクトリの作成・回収と、セッション記録の保管
+
+    Args:
+        base_dir: 持ち込む設定の元になるディレクトリ（読み取りのみ）
+        state_file: 持ち込む CLI の状態ファイル（.claude.json）。None なら default_state_file(base_dir)
+        root: 設定ディレクトリを作る場所（tmpfs 推奨）
+        transcript_dir: セッション記録の保管場所
+        retention_sec: セッション記録を保管する秒数
+        compact_after_sec: この秒数以上更新されていない記録は gzip で圧縮する
+        max_bytes: 保管するセッション記録の合計サイズの上限
+    """
+
+    def __init__(
+        self,
+        base_dir: str,
+        root: str,
+        transcript_dir: str,
+        retention_sec: float = 7 * 86400,
+        compact_after_sec: float = 3600,
+        max_bytes: int = 1024 * 1024 * 1024,
+        state_file: Optional[str] = None,
+    ):
+        self.base_dir = base_dir
+        self.state_file = state_file or default_state_file(base_dir)
+        self.root = root
+        self.transcript_dir = transcript_dir
+        self.retention_sec = retention_sec
+        self.compact_after_sec = compact_after_sec
+        self.max_bytes = max_bytes
+        self.active = 0
+        self._transcript_stats = {"files": 0, "bytes": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    def stats(self) -> dict:
+        return {
+            "root": self.root,
+            "active": self.active,
+            "transcripts": dict(self._transcript_stats),
+            "retention_sec": self.retention_sec,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _seed(self, path: str):
+        os.makedirs(path)
+        # CLAUDE_CONFIG_DIR を指定すると、CLI は状態ファイルをその中から読む
+        if os.path.isfile(self.state_file):
+            shutil.copy2(self.state_file, os.path.join(path, STATE_FILE))
+        for name in SEED_COPY:
+            src = os.path.join(self.base_dir, name)
+            if os.path.isfile(src):
+                shutil.copy2(src, os.path.join(path, name))
+        for name in SEED_LINK:
+            src = os.path.join(self.base_dir, name)
+            if os.path.exists(src):
+                os.symlink(src, os.path.join(path, name))
+
+    def _restore(self, path: str, session_id: str):
+        """保管しているセッション記録を設定ディレクトリに持ち込む（--resume 用）
+
+        見つからなければ、この機能を有効にする前にベースに記録されたセッションを探す。
+        """
+        pattern = os.path.join("projects", "*", f"{session_id}.jsonl*")
+        found = glob.glob(os.path.join(self.transcript_dir, pattern)) or glob.glob(os.path.join(self.base_dir, pattern))
+        for stored in found:
+            project = os.path.basename(os.path.dirname(stored))
+            target_dir = os.path.join(path, "projects", project)
+            os.makedirs(target_dir, exist_ok=True)
+            target = os.path.join(target_dir, f"{session_id}.jsonl")
+            if stored.endswith(".gz"):
+                with gzip.open(stored, "rb") as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            else:
+                shutil.copy2(stored, target)
+
+    def _harvest(self, path: str):
+        """設定ディレクトリのセッション記録を保管場所に移す"""
+        for transcript in _transcripts(path):
+            project = os.path.basename(os.path.dirname(transcript))
+            target_dir = os.path.join(self.transcript_dir, "projects", project)
+            os.makedirs(target_dir, exist_ok=True)
+            target = os.path.join(target_dir, os.path.basename(transcript))
+            # 再開したセッションの記録は古い圧縮済みの記録を置き換える
+            if target.endswith(".jsonl") and os.path.exists(target + ".gz"):
+                os.remove(target + ".gz")
+            shutil.move(transcript, target)
+
+    async def create(self, resume_session_id: Optional[str] = None) -> ConfigHome:
+        home = ConfigHome(path=os.path.join(self.root, uuid.uuid4().hex))
+
+        def prepare():
+            self._seed(home.path)
+            if resume_session_id:
+                self._restore(home.path, resume_session_id)
+
+        await asyncio.to_thread(prepare)
+        self.active += 1
+        return home
+
+    async def release(self, home: ConfigHome):
+        def cleanup():
+            try:
+                self._harvest(home.path)
+            finally:
+                shutil.rmtree(home.path, ignore_errors=True)
+
+        try:
+            await asyncio.to_thread(cleanup)
+        except OSError as e:
+            logger.warning(f"セッション記録の回収に失敗: {home.path}: {e}")
+        finally:
+            self.active -= 1
+
+    @asynccontextmanager
+    async def home(self, resume_session_id: Optional[str] = None):
+        """設定ディレクトリを作り、終了時にセッション記録を回収して削除する"""
+        home = await self.create(resume_session_id)
+        try:
+            yield home
+        finally:
+            await asyncio.shield(self.release(home))
+
+    def compact(self):
+        """古い記録の圧縮、保管期間・合計サイズを超えた記録の削除"""
+        now = time.time()
+        files: List[Tuple[float, int, str]] = []
+        for transcript in _transcripts(self.transcript_dir):
+            try:
+                mtime = os.path.getmtime(transcript)
+                if now - mtime > self.retention_sec:
+                    os.remove(transcript)
+                    transcripts_removed.inc(reason="expired")
+                    continue
+                if transcript.endswith(".jsonl") and now - mtime > self.compact_after_sec:
+                    with open(transcript, "rb") as src, gzip.open(transcript + ".gz", "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.utime(transcript + ".gz", (mtime, mtime))
+                    os.remove(transcript)
+                    transcript += ".gz"
+                files.append((mtime, os.path.getsize(transcript), transcript))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, size, _ in files)
+        for _, size, transcript in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(transcript)
+            transcripts_removed.inc(reason="size")
+            total -= size
+            files = [f for f in files if f[2] != transcript]
+        self._transcript_stats = {"files": len(files), "bytes": total}
+
+    def _recover(self):
+        """前回の異常終了で残った設定ディレクトリから記録を回収して削除する"""
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                self._harvest(path)
+            except OSError as e:
+                logger.warning(f"セッション記録の回収に失敗: {path}: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+
+    async def _compact_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.compact)
+            except OSError as e:
+                logger.warning(f"セッション記録の整理に失敗: {e}")
+            await asyncio.sleep(min(600, self.compact_after_sec))
+
+    async def start(self):
+        os.makedirs(self.transcript_dir, exist_ok=True)
+        await asyncio.to_thread(self._recover)
+        os.makedirs(self.root, exist_ok=True)
+        if self._task is None:
+            self._task = asyncio.create_task(self._compact_loop())
+        logger.info(f"🏠 実行ごとの設定ディレクトリを有効化: {self.root}（ベース: {self.base_dir}）")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,311 @@
+"""
+ワークスペースの索引（context pack）
+
+cwd 以下のファイル構成・サイズ・言語・トップレベルのシンボル・最近の変更を索引にしておき、
+要約（digest）をシステムプロンプトに付け加える。
+エージェントが最初の数ターンを Read / Bash でディレクトリ構成の把握に使うのを減らすため。
+
+索引は mtime とサイズを比べる差分スキャンで更新する（変わったファイルだけシンボルを読み直す）。
+要約はトークン数の目安（1トークン ≒ 4文字）に収まるように切り詰める。
+"""
+
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Tuple
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# 索引に含めないディレクトリ
+IGNORED_DIRS = {
+    ".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", ".mypy_cache",
+    ".pytest_cache", ".tox", "dist", "build", ".next", ".cache", "target",
+}
+# シンボルを読むファイルの上限サイズと、読む先頭のバイト数
+MAX_SYMBOL_FILE_BYTES = 1024 * 1024
+SYMBOL_READ_BYTES = 256 * 1024
+MAX_SYMBOLS_PER_FILE = 12
+CHARS_PER_TOKEN = 4
+
+LANGUAGES = {
+    ".py": "python", ".js": "javascript", ".mjs": "javascript", ".cjs": "javascript", ".jsx": "javascript",
+    ".ts": "typescript", ".tsx": "typescript", ".go": "go", ".rs": "rust", ".java": "java",
+    ".kt": "kotlin", ".rb": "ruby", ".php": "php", ".c": "c", ".h": "c", ".cc": "cpp", ".cpp": "cpp",
+    ".hpp": "cpp", ".cs": "csharp", ".swift": "swift", ".sh": "shell", ".md": "markdown",
+    ".json": "json", ".yml": "yaml", ".yaml": "yaml", ".toml": "toml", ".html": "html", ".css": "css",
+    ".sql": "sql",
+}
+
+# 言語ごとのトップレベルのシンボル（行頭から始まる定義のみ）
+SYMBOL_PATTERNS = {
+    "python": re.compile(r"^(?:async\s+def|def|class)\s+([A-Za-z_]\w*)", re.M),
+    "javascript": re.compile(
+        r"^(?:export\s+(?:default\s+)?)?(?:async\s+)?(?:function\*?|class|const|let)\s+([A-Za-z_$][\w$]*)", re.M
+    ),
+    "typescript": re.compile(
+        r"^(?:export\s+(?:default\s+)?)?(?:async\s+)?(?:function\*?|class|const|let|interface|type|enum)\s+([A-Za-z_$][\w$]*)",
+        re.M,
+    ),
+    "go": re.compile(r"^(?:func(?:\s+\([^)]*\))?|type)\s+([A-Za-z_]\w*)", re.M),
+    "rust": re.compile(r"^(?:pub(?:\([^)]*\))?\s+)?(?:fn|struct|enum|trait|mod)\s+([A-Za-z_]\w*)", re.M),
+    "java": re.compile(r"^(?:public\s+)?(?:final\s+|abstract\s+)*(?:class|interface|enum|record)\s+([A-Za-z_]\w*)", re.M),
+    "ruby": re.compile(r"^(?:class|module|def)\s+([A-Za-z_][\w:.]*)", re.M),
+    "shell": re.compile(r"^(?:function\s+)?([A-Za-z_][\w-]*)\s*\(\)", re.M),
+    "markdown": re.compile(r"^#{1,2}\s+(.+?)\s*$", re.M),
+}
+
+CODE_FENCE = re.compile(r"^```.*?^```", re.M | re.S)
+
+scan_seconds = registry.histogram("claude_context_pack_scan_seconds", "ワークスペース索引の差分スキャンにかかった時間")
+
+
+@dataclass
+class FileEntry:
+    size: int
+    mtime: float
+    language: Optional[str]
+    symbols: List[str] = field(default_factory=list)
+
+
+def extract_symbols(path: str, language: Optional[str], size: int) -> List[str]:
+    pattern = SYMBOL_PATTERNS.get(language or "")
+    if pattern is None or size > MAX_SYMBOL_FILE_BYTES:
+        return []
+    try:
+        with open(path, "rb") as f:
+            text = f.read(SYMBOL_READ_BYTES).decode("utf-8", errors="replace")
+    except OSError:
+        return []
+    if language == "markdown":
+        # コードブロック内のシェルのコメントを見出しとして拾わない
+        text = CODE_FENCE.sub("", text)
+    symbols = []
+    for match in pattern.finditer(text):
+        name = match.group(1)[:60]
+        if name not in symbols:
+            symbols.append(name)
+        if len(symbols) >= MAX_SYMBOLS_PER_FILE:
+            break
+    return symbols
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size}{unit}"
+        size //= 1024
+    return f"{size}GB"
+
+
+class WorkspaceIndex:
+    """1つのディレクトリの索引
+
+    Args:
+        root: 索引を作るディレクトリ
+        max_files: 索引に含めるファイル数の上限（超えた分は数えるだけ）
+        max_changes: 覚えておく最近の変更の件数
+    """
+
+    def __init__(self, root: str, max_files: int = 5000, max_changes: int = 50):
+        self.root = root
+        self.max_files = max_files
+        self.files: Dict[str, FileEntry] = {}
+        self.changes: Deque[Tuple[float, str, str]] = deque(maxlen=max_changes)
+        self.skipped = 0
+        self.scanned_at: Optional[float] = None
+        self.last_used = time.monotonic()
+        self.version = 0
+        # _scan_lock は差分スキャンを1つずつ実行するため、_lock は files / changes の読み書き用
+        self._scan_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._digest: Optional[Tuple[int, int, str]] = None
+
+    def scan(self):
+        """差分スキャン（スレッドで実行する）。変わったファイルだけシンボルを読み直す
+
+        走査は _scan_lock の中で行い、結果の反映だけを _lock の中で行う（_render を待たせない）。
+        """
+        with self._scan_lock:
+            start = time.monotonic()
+            seen: Dict[str, FileEntry] = {}
+            changes: List[Tuple[float, str, str]] = []
+            skipped = 0
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                dirnames[:] = sorted(d for d in dirnames if d not in IGNORED_DIRS and not d.startswith("."))
+                for name in sorted(filenames):
+                    if len(seen) >= self.max_files:
+                        skipped += 1
+                        continue
+                    path = os.path.join(dirpath, name)
+                    rel = os.path.relpath(path, self.root)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    old = self.files.get(rel)
+                    if old and old.mtime == st.st_mtime and old.size == st.st_size:
+                        seen[rel] = old
+                        continue
+                    language = LANGUAGES.get(os.path.splitext(name)[1].lower())
+                    seen[rel] = FileEntry(st.st_size, st.st_mtime, language, extract_symbols(path, language, st.st_size))
+                    changes.append((st.st_mtime, rel, "modified" if old else "added"))
+
+            now = time.time()
+            deleted = [(now, rel, "deleted") for rel in self.files.keys() - seen.keys()]
+            with self._lock:
+                if self.scanned_at is not None:
+                    self.changes.extend(changes)
+                self.changes.extend(deleted)
+                self.files = seen
+                self.skipped = skipped
+                self.scanned_at = now
+                if changes or deleted:
+                    self.version += 1
+            scan_seconds.observe(time.monotonic() - start)
+
+    def digest(self, token_budget: int) -> str:
+        """索引の要約（token_budget トークン程度に収める）"""
+        self.last_used = time.monotonic()
+        if self._digest and self._digest[:2] == (self.version, token_budget):
+            return self._digest[2]
+        text = self._render(token_budget * CHARS_PER_TOKEN)
+        self._digest = (self.version, token_budget, text)
+        return text
+
+    def _render(self, max_chars: int) -> str:
+        # スキャン中のスレッドが changes に追加するので、コピーしてから使う
+        with self._lock:
+            files = dict(self.files)
+            recent = list(self.changes)[-10:][::-1]
+        languages: Dict[str, int] = {}
+        for entry in files.values():
+            if entry.language:
+                languages[entry.language] = languages.get(entry.language, 0) + 1
+        top_languages = ", ".join(f"{lang} {n}" for lang, n in sorted(languages.items(), key=lambda kv: -kv[1])[:6])
+        total = len(files) + self.skipped
+        lines = [
+            f"## ワークスペースの索引: {self.root}",
+            f"ファイル数: {total}（{top_languages or '言語不明'}）。必要な箇所だけ Read してください。",
+        ]
+
+        if recent:
+            lines.append("最近の変更:")
+            for mtime, rel, kind in recent:
+                lines.append(f"- {kind} {rel} ({time.strftime('%m-%d %H:%M', time.localtime(mtime))})")
+
+        lines.append("ファイル（パス サイズ: シンボル）:")
+        used = sum(len(line) + 1 for line in lines)
+        # 浅い階層のファイルから（ドットファイルは後に）並べ、予算を超えたら残りは件数だけ示す
+        ordered = sorted(
+            files.items(), key=lambda kv: (kv[0].count(os.sep), os.path.basename(kv[0]).startswith("."), kv[0])
+        )
+        shown = 0
+        for rel, entry in ordered:
+            line = f"{rel} {format_size(entry.size)}"
+            if entry.symbols and used + len(line) + 1 < max_chars:
+                # シンボルまで入らなければパスとサイズだけにする
+                with_symbols = line + ": " + ", ".join(entry.symbols)
+                if used + len(with_symbols) + 1 <= max_chars:
+                    line = with_symbols
+            if used + len(line) + 1 > max_chars:
+                break
+            lines.append(line)
+            used += len(line) + 1
+            shown += 1
+        if shown < total:
+            lines.append(f"...ほか {total - shown} ファイル")
+        return "\n".join(lines)
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self.files),
+            "skipped": self.skipped,
+            "version": self.version,
+            "scanned_at": self.scanned_at,
+        }
+
+
+class ContextPackManager:
+    """ディレクトリごとの索引を管理し、定期的に差分スキャンする
+
+    Args:
+        scan_interval_sec: 差分スキャンの間隔
+        token_budget: 要約のトークン数の目安
+        max_files: 1つの索引に含めるファイル数の上限
+        idle_ttl_sec: この秒数使われなかった索引は破棄する
+        roots: 起動時に索引を作っておくディレクトリ
+    """
+
+    def __init__(
+        self,
+        scan_interval_sec: float = 30,
+        token_budget: int = 1500,
+        max_files: int = 5000,
+        idle_ttl_sec: float = 3600,
+        roots: Optional[List[str]] = None,
+    ):
+        self.scan_interval_sec = scan_interval_sec
+        self.token_budget = token_budget
+        self.max_files = max_files
+        self.idle_ttl_sec = idle_ttl_sec
+        self.roots = roots or []
+        self._indexes: Dict[str, WorkspaceIndex] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _index(self, root: str) -> WorkspaceIndex:
+        root = os.path.realpath(root)
+        index = self._indexes.get(root)
+        if index is None:
+            index = WorkspaceIndex(root, max_files=self.max_files)
+            self._indexes[root] = index
+        if index.scanned_at is None:
+            await asyncio.to_thread(index.scan)
+            logger.info(f"🗂️ ワークスペースの索引を作成: {root} ({len(index.files)} ファイル)")
+        return index
+
+    async def digest(self, root: str) -> Optional[str]:
+        """root の索引の要約（ディレクトリがなければ None）"""
+        if not os.path.isdir(root):
+            return None
+        index = await self._index(root)
+        return index.digest(self.token_budget)
+
+    async def _scan_loop(self):
+        while True:
+            await asyncio.sleep(self.scan_interval_sec)
+            now = time.monotonic()
+            for root, index in list(self._indexes.items()):
+                if root not in self.roots and now - index.last_used > self.idle_ttl_sec:
+                    del self._indexes[root]
+                    continue
+                try:
+                    await asyncio.to_thread(index.scan)
+                except OSError as e:
+                    logger.warning(f"ワークスペースの索引の更新に失敗: {root}: {e}")
+
+    async def start(self):
+        for root in self.roots:
+            if os.path.isdir(root):
+                await self._index(root)
+        self.roots = [os.path.realpath(r) for r in self.roots]
+        if self._task is None:
+            self._task = asyncio.create_task(self._scan_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "token_budget": self.token_budget,
+            "scan_interval_sec": self.scan_interval_sec,
+            "indexes": {root: index.stats() for root, index in self._indexes.items()},
+        }
@@ -0,0 +1,130 @@
+"""
+非同期ジョブの永続化（SQLite, WAL）
+
+ジョブの受付内容・状態・結果（stdout_json を含む RunResponse）・トークン使用量を保存し、
+cc-api を再起動してもジョブの結果を取得できるようにする。
+再起動時に queued / running のままだったジョブは「中断」として返す。
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 終了していない状態（再起動時に中断扱いにする）
+UNFINISHED = ("queued", "running")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    caller TEXT,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    request TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    usage TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_caller ON jobs (caller, created_at);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+COLUMNS = ("id", "caller", "status", "created_at", "started_at", "finished_at", "request", "result", "error", "usage")
+JSON_COLUMNS = ("request", "result", "error", "usage")
+
+
+def _dumps(value) -> Optional[str]:
+    return None if value is None else json.dumps(value, ensure_ascii=False)
+
+
+class JobStore:
+    """ジョブを SQLite に保存する
+
+    行は dict（request / result / error / usage は JSON として保存し、dict で返す）。
+
+    Args:
+        db_path: SQLite ファイルのパス
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # WAL では NORMAL でもコミット済みのデータはプロセスの異常終了で失われない
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        logger.info(f"💾 ジョブの保存先: {db_path}")
+
+    def _row(self, row) -> dict:
+        record = dict(zip(COLUMNS, row))
+        for column in JSON_COLUMNS:
+            if record[column] is not None:
+                record[column] = json.loads(record[column])
+        return record
+
+    def save(self, record: dict):
+        """ジョブを保存する（同じ id があれば置き換える）"""
+        values = [_dumps(record.get(c)) if c in JSON_COLUMNS else record.get(c) for c in COLUMNS]
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                values,
+            )
+            self._db.commit()
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def list(self, caller: Optional[str], limit: int = 50) -> List[dict]:
+        """呼び出し元のジョブを新しい順に返す（caller が None なら全件）"""
+        query = f"SELECT {', '.join(COLUMNS)} FROM jobs"
+        params: list = []
+        if caller is not None:
+            query += " WHERE caller = ?"
+            params.append(caller)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return [self._row(r) for r in rows]
+
+    def interrupt_unfinished(self, error: dict, finished_at: float) -> List[dict]:
+        """終了していないジョブを中断扱いにして返す（起動時に1回呼ぶ）"""
+        placeholders = ", ".join("?" * len(UNFINISHED))
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE status IN ({placeholders})", UNFINISHED
+            ).fetchall()
+            self._db.execute(
+                f"UPDATE jobs SET status = 'interrupted', error = ?, finished_at = ? WHERE status IN ({placeholders})",
+                (_dumps(error), finished_at, *UNFINISHED),
+            )
+            self._db.commit()
+        return [self._row(r) for r in rows]
+
+    def purge(self, finished_before: float) -> int:
+        """finished_before より前に終了したジョブを削除する"""
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (finished_before,)
+            )
+            self._db.commit()
+        return cursor.rowcount
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {"db_path": self.db_path, "jobs": dict(rows)}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,172 @@
+"""
+シンプルなメトリクスレジストリ
+
+外部ライブラリに依存せず、ラベル付きのカウンターとヒストグラムを保持する。
+render() で Prometheus のテキスト形式（/metrics）に書き出せる。
+"""
+
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 秒単位のレイテンシ向けデフォルトバケット
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs: Sequence[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _header(self) -> List[str]:
+        help_text = self.help.replace("\\", "\\\\").replace("\n", "\\n")
+        return [f"# HELP {self.name} {help_text}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    """単調増加するカウンター"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            return [
+                {"labels": dict(zip(self.labelnames, key)), "value": value}
+                for key, value in self._values.items()
+            ]
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = _format_labels(list(zip(self.labelnames, key)))
+                lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """累積バケット付きのヒストグラム"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [bucket counts..., +Inf count, sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[len(self.buckets)] += 1
+            data[-1] += value
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            result = []
+            for key, data in self._values.items():
+                count = data[len(self.buckets)]
+                result.append({
+                    "labels": dict(zip(self.labelnames, key)),
+                    "count": count,
+                    "sum": data[-1],
+                    "avg": data[-1] / count if count else 0,
+                    "buckets": dict(zip([str(b) for b in self.buckets], data[: len(self.buckets)])),
+                })
+            return result
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            for key, data in sorted(self._values.items()):
+                pairs = list(zip(self.labelnames, key))
+                for bound, count in zip(self.buckets, data):
+                    labels = _format_labels(pairs + [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {_format_value(count)}")
+                count = data[len(self.buckets)]
+                lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', '+Inf')])} {_format_value(count)}")
+                lines.append(f"{self.name}_sum{_format_labels(pairs)} {_format_value(data[-1])}")
+                lines.append(f"{self.name}_count{_format_labels(pairs)} {_format_value(count)}")
+        return lines
+
+
+class Registry:
+    """メトリクスの登録先（同名のメトリクスは使い回す）"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, cls, name: str, help_text: str, labelnames: Sequence[str], **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = cls(name, help_text, labelnames, **kwargs)
+            self._metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, help_text, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Optional[Sequence[float]] = None,
+    ) -> Histogram:
+        return self._register(Histogram, name, help_text, labelnames, buckets=buckets or DEFAULT_BUCKETS)
+
+    def snapshot(self) -> dict:
+        return {name: {"type": m.type, "help": m.help, "values": m.snapshot()} for name, m in self._metrics.items()}
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式で書き出す"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# プロセス全体で共有するレジストリ
+registry = Registry()
@@ -0,0 +1,260 @@
+"""
+事前起動した claude CLI ワーカーのプール
+
+claude を `--input-format stream-json` で起動しておき、Node.js の起動と
+@anthropic-ai/claude-code の読み込みを済ませた状態で stdin からプロンプトを待たせる。
+リクエストが来たらワーカーを1つ取り出してプロンプトを渡し、使い終わったら破棄して
+バックグラウンドで補充する。
+
+ワーカーはコマンドライン（許可ツール・システムプロンプトなど）と cwd ごとに分けて管理する。
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Tuple
+
+from metrics import registry
+from runner import DEFAULT_MAX_LINE_BYTES, DEFAULT_TEXT_LIMIT, ProcessResult, kill_tree, parse_result_event, spawn_process
+
+logger = logging.getLogger(__name__)
+
+start_seconds = registry.histogram(
+    "claude_start_seconds",
+    "プロンプトを渡してから最初のイベントを受け取るまでの時間（cold: 新規起動, warm: 事前起動）",
+    ["mode"],
+)
+pool_workers = registry.counter(
+    "claude_pool_workers_total",
+    "プールのワーカー数の推移（spawned / reaped / retired / dead）",
+    ["event"],
+)
+
+WorkerKey = Tuple[Tuple[str, ...], Optional[str]]
+
+
+@dataclass(eq=False)
+class Worker:
+    """stdin でプロンプトを待っている claude プロセス"""
+    proc: asyncio.subprocess.Process
+    key: WorkerKey
+    spawned_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+    uses: int = 0
+    stderr_tail: Deque[bytes] = field(default_factory=lambda: deque(maxlen=200))
+    _stderr_task: Optional[asyncio.Task] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.returncode is None
+
+    async def _drain_stderr(self):
+        # stderr を読み続けないとパイプが詰まってプロセスが止まる
+        async for line in self.proc.stderr:
+            self.stderr_tail.append(line)
+
+    @property
+    def stderr(self) -> str:
+        return b"".join(self.stderr_tail).decode("utf-8", errors="replace")
+
+    async def close(self, reason: str = "pool"):
+        if self._stderr_task:
+            self._stderr_task.cancel()
+        await kill_tree(self.proc, reason)
+
+
+class ClaudeWorkerPool:
+    """事前起動ワーカーのプール
+
+    Args:
+        min_idle: キーごとに待機させておくワーカー数
+        max_idle: プール全体で待機させるワーカー数の上限
+        idle_ttl_sec: これ以上使われなかった待機ワーカーは終了させる
+        max_uses: 1ワーカーに渡すプロンプト数の上限（2以上にすると同じ CLI セッションに
+            続けて渡すため会話コンテキストが引き継がれる。通常は 1）
+    """
+
+    def __init__(self, min_idle: int = 1, max_idle: int = 4, idle_ttl_sec: float = 600, max_uses: int = 1):
+        self.min_idle = max(0, min_idle)
+        self.max_idle = max(0, max_idle)
+        self.idle_ttl_sec = idle_ttl_sec
+        self.max_uses = max(1, max_uses)
+        self._idle: Dict[WorkerKey, Deque[Worker]] = {}
+        self._spawning: Dict[WorkerKey, int] = {}
+        self._reaper: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+
+    @property
+    def idle_count(self) -> int:
+        return sum(len(workers) for workers in self._idle.values())
+
+    def stats(self) -> dict:
+        return {
+            "idle": self.idle_count,
+            "spawning": sum(self._spawning.values()),
+            "keys": len(self._idle),
+            "min_idle": self.min_idle,
+            "max_idle": self.max_idle,
+            "max_uses": self.max_uses,
+        }
+
+    async def spawn(self, cmd: List[str], cwd: Optional[str]) -> Worker:
+        proc = await spawn_process(
+            cmd,
+            "pool",
+            cwd=cwd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=DEFAULT_MAX_LINE_BYTES,
+        )
+        worker = Worker(proc=proc, key=(tuple(cmd), cwd))
+        worker._stderr_task = asyncio.create_task(worker._drain_stderr())
+        pool_workers.inc(event="spawned")
+        return worker
+
+    async def acquire(self, cmd: List[str], cwd: Optional[str]) -> Tuple[Worker, bool]:
+        """ワーカーを取り出す（待機ワーカーがなければ新規起動）
+
+        Returns:
+            (ワーカー, 事前起動済みだったか)
+        """
+        key = (tuple(cmd), cwd)
+        workers = self._idle.get(key)
+        worker = None
+        while workers:
+            candidate = workers.popleft()
+            if candidate.alive:
+                worker = candidate
+                break
+            pool_workers.inc(event="dead")
+            await candidate.close()
+
+        warm = worker is not None
+        if worker is None:
+            worker = await self.spawn(cmd, cwd)
+        self._replenish(key, cmd, cwd)
+        return worker, warm
+
+    async def release(self, worker: Worker):
+        """使い終わったワーカーを戻す（上限に達していれば破棄）"""
+        worker.last_used = time.monotonic()
+        if worker.alive and worker.uses < self.max_uses and self.idle_count < self.max_idle:
+            self._idle.setdefault(worker.key, deque()).append(worker)
+            return
+        pool_workers.inc(event="retired")
+        await worker.close()
+
+    def _replenish(self, key: WorkerKey, cmd: List[str], cwd: Optional[str]):
+        """キーの待機ワーカーが min_idle になるようにバックグラウンドで起動する"""
+        missing = self.min_idle - len(self._idle.get(key, ())) - self._spawning.get(key, 0)
+        missing = min(missing, self.max_idle - self.idle_count - sum(self._spawning.values()))
+        for _ in range(max(0, missing)):
+            self._spawning[key] = self._spawning.get(key, 0) + 1
+            task = asyncio.create_task(self._spawn_idle(key, cmd, cwd))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _spawn_idle(self, key: WorkerKey, cmd: List[str], cwd: Optional[str]):
+        try:
+            worker = await self.spawn(cmd, cwd)
+            self._idle.setdefault(key, deque()).append(worker)
+        except Exception as e:
+            logger.warning(f"ワーカーの事前起動に失敗: {e}")
+        finally:
+            self._spawning[key] -= 1
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(min(30, self.idle_ttl_sec))
+            await self.reap()
+
+    async def reap(self):
+        """idle_ttl_sec を超えて使われていない待機ワーカーを終了させる"""
+        now = time.monotonic()
+        for key in list(self._idle):
+            workers = self._idle[key]
+            keep = deque(w for w in workers if w.alive and now - w.last_used <= self.idle_ttl_sec)
+            for worker in workers:
+                if worker not in keep:
+                    pool_workers.inc(event="reaped")
+                    await worker.close()
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def start(self):
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def close(self):
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+        for task in list(self._tasks):
+            task.cancel()
+        for workers in self._idle.values():
+            for worker in workers:
+                await worker.close()
+        self._idle.clear()
+
+
+async def run_on_worker(pool: ClaudeWorkerPool, cmd: List[str], cwd: Optional[str], prompt: str, timeout_sec: float) -> ProcessResult:
+    """ワーカーにプロンプトを1つ渡し、最終的な result イベントを ProcessResult として返す
+
+    result には result イベント（--output-format json と同じ形）を解析して入れて返す。
+    """
+    start = time.monotonic()
+    worker, warm = await pool.acquire(cmd, cwd)
+    worker.uses += 1
+    message = {"type": "user", "message": {"role": "user", "content": [{"type": "text", "text": prompt}]}}
+    result_line = b""
+    result_event: Optional[dict] = None
+    first_event = True
+
+    try:
+        worker.proc.stdin.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+        await worker.proc.stdin.drain()
+        if worker.uses >= pool.max_uses:
+            # 最後のプロンプトなので stdin を閉じ、結果を出したら終了させる
+            worker.proc.stdin.close()
+
+        async def read_until_result():
+            nonlocal result_line, result_event, first_event
+            async for line in worker.proc.stdout:
+                if first_event:
+                    first_event = False
+                    start_seconds.observe(time.monotonic() - start, mode="warm" if warm else "cold")
+                event = parse_result_event(line)
+                if event is not None:
+                    result_line, result_event = line, event
+                    return
+
+        await asyncio.wait_for(read_until_result(), timeout=timeout_sec)
+        if worker.uses >= pool.max_uses:
+            await asyncio.wait_for(worker.proc.wait(), timeout=max(timeout_sec - (time.monotonic() - start), 1))
+    except BaseException as e:
+        reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "cancelled"
+        await asyncio.shield(worker.close(reason))
+        raise
+
+    returncode = worker.proc.returncode
+    if returncode is None:
+        # 次のプロンプトを待っている（max_uses > 1）。result イベントから終了コード相当を決める
+        returncode = 1 if result_event and result_event.get("is_error") else 0
+    elif not result_line and returncode == 0:
+        returncode = 1
+
+    await pool.release(worker)
+    return ProcessResult(
+        returncode=returncode,
+        stdout=result_line[:DEFAULT_TEXT_LIMIT].decode("utf-8", errors="replace"),
+        stderr=worker.stderr[-DEFAULT_TEXT_LIMIT:],
+        duration_sec=time.monotonic() - start,
+        result=result_event,
+        stdout_bytes=len(result_line),
+    )
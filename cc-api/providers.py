@@ -0,0 +1,260 @@
+"""
+API プロバイダーの切り替え（Anthropic / Z.AI など）
+
+プロバイダーごとに接続先・APIキー・モデルの対応（haiku / sonnet / opus → 実際のモデル）を持ち、
+claude に渡す環境変数（ANTHROPIC_BASE_URL など）を差し替える。
+
+プロバイダーごとにサーキットブレーカーで直近の失敗率と p95 実行時間を監視し、
+しきい値を超えたら一定時間そのプロバイダーを使わない（open）。
+待ち時間が過ぎたら1回だけ試し（half-open）、成功すれば元に戻す（closed）。
+失敗として数えるのは接続や API の障害だけで、ターン数の上限やツール・権限のエラーは数えない。
+
+設定例（CC_API_PROVIDERS または CC_API_PROVIDERS_FILE に JSON で指定。先頭が優先）:
+    [
+      {"name": "zai", "base_url": "https://api.z.ai/api/anthropic", "api_key_env": "ZAI_API_KEY",
+       "models": {"haiku": "glm-4.5-air", "sonnet": "glm-4.7", "opus": "glm-4.7"}},
+      {"name": "anthropic", "api_key_env": "ANTHROPIC_API_KEY"}
+    ]
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Tuple
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# プロバイダーごとに差し替える環境変数（プロファイルにないものはサーバーの設定を引き継がない）
+PROVIDER_ENV_KEYS = (
+    "ANTHROPIC_BASE_URL",
+    "ANTHROPIC_API_KEY",
+    "ANTHROPIC_AUTH_TOKEN",
+    "ANTHROPIC_MODEL",
+    "ANTHROPIC_DEFAULT_HAIKU_MODEL",
+    "ANTHROPIC_DEFAULT_SONNET_MODEL",
+    "ANTHROPIC_DEFAULT_OPUS_MODEL",
+)
+# models のキー → 環境変数
+MODEL_ENV_KEYS = {
+    "haiku": "ANTHROPIC_DEFAULT_HAIKU_MODEL",
+    "sonnet": "ANTHROPIC_DEFAULT_SONNET_MODEL",
+    "opus": "ANTHROPIC_DEFAULT_OPUS_MODEL",
+    "default": "ANTHROPIC_MODEL",
+}
+
+# result イベントの本文のうち、API の障害を表すもの（5xx・過負荷・レート制限）
+API_FAILURE_PATTERN = re.compile(r"API Error: (5\d\d|429)\b|overloaded|rate limit", re.IGNORECASE)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+provider_runs = registry.counter(
+    "claude_provider_runs_total", "プロバイダーごとの実行回数", ["provider", "outcome"]
+)
+provider_run_seconds = registry.histogram(
+    "claude_provider_run_seconds", "プロバイダーごとの claude の実行時間（成功のみ）", ["provider"]
+)
+circuit_transitions = registry.counter(
+    "claude_circuit_transitions_total", "サーキットブレーカーの状態遷移", ["provider", "state"]
+)
+
+
+class ProviderConfigError(ValueError):
+    """プロバイダー設定の誤り"""
+
+
+def is_provider_failure(result: Optional[dict]) -> bool:
+    """プロバイダー側（接続・API）の失敗か（result は claude の最後の result イベント）
+
+    result イベントがない（イベントを出す前に異常終了した場合を含む）か、
+    is_error の本文が API の障害を表すときだけ True。
+    ターン数の上限やツール・権限のエラーはプロバイダーを替えても変わらないので False。
+    """
+    if result is None:
+        return True
+    if not result.get("is_error"):
+        return False
+    if str(result.get("subtype", "")).startswith("error_max_"):
+        return False
+    return bool(API_FAILURE_PATTERN.search(str(result.get("result") or "")))
+
+
+class CircuitBreaker:
+    """直近 window_sec 秒の結果からプロバイダーを止めるか決める
+
+    Args:
+        window_sec: 失敗率・p95 を計算する期間
+        min_requests: 判定に必要な最小の実行回数
+        error_rate: この割合以上失敗したら open にする
+        p95_sec: 成功した実行の p95 がこの秒数を超えたら open にする（0 なら見ない）
+        cooldown_sec: open にしてから half-open で試すまでの秒数
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window_sec: float = 60,
+        min_requests: int = 5,
+        error_rate: float = 0.5,
+        p95_sec: float = 0,
+        cooldown_sec: float = 30,
+    ):
+        self.name = name
+        self.window_sec = window_sec
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.p95_sec = p95_sec
+        self.cooldown_sec = cooldown_sec
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._probing = False
+        self._results: Deque[Tuple[float, bool, float]] = deque()
+
+    def _set_state(self, state: str, reason: str = ""):
+        if state == self.state:
+            return
+        self.state = state
+        circuit_transitions.inc(provider=self.name, state=state)
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            logger.warning(f"⛔ プロバイダー {self.name} を一時停止します ({reason})")
+        elif state == CLOSED:
+            self._results.clear()
+            logger.info(f"✅ プロバイダー {self.name} を再開しました")
+
+    def available(self) -> bool:
+        """今このプロバイダーに送れるか（状態は変えない）"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.cooldown_sec
+        return not self._probing
+
+    def allow(self) -> bool:
+        """送ってよければ True（open の待ち時間が過ぎていれば half-open にして1回だけ許可する）"""
+        if not self.available():
+            return False
+        if self.state != CLOSED:
+            self._set_state(HALF_OPEN)
+            self._probing = True
+        return True
+
+    def abandon(self):
+        """許可した実行を結果なしで取りやめた（キャンセルなど）"""
+        self._probing = False
+
+    def _prune(self, now: float):
+        while self._results and now - self._results[0][0] > self.window_sec:
+            self._results.popleft()
+
+    def p95(self) -> Optional[float]:
+        latencies = sorted(latency for _, ok, latency in self._results if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def record(self, ok: bool, latency: float):
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            self._probing = False
+            if ok:
+                self._set_state(CLOSED)
+            else:
+                self._set_state(OPEN, "再開の試行に失敗")
+            return
+
+        self._results.append((now, ok, latency))
+        self._prune(now)
+        if len(self._results) < self.min_requests:
+            return
+        failures = sum(1 for _, ok, _ in self._results if not ok)
+        rate = failures / len(self._results)
+        if rate >= self.error_rate:
+            self._set_state(OPEN, f"失敗率 {rate:.0%}")
+            return
+        p95 = self.p95()
+        if self.p95_sec and p95 is not None and p95 > self.p95_sec:
+            self._set_state(OPEN, f"p95 {p95:.1f}秒")
+
+    def stats(self) -> dict:
+        self._prune(time.monotonic())
+        failures = sum(1 for _, ok, _ in self._results if not ok)
+        return {
+            "state": self.state,
+            "requests": len(self._results),
+            "failures": failures,
+            "p95_sec": self.p95(),
+        }
+
+
+@dataclass
+class Provider:
+    """プロバイダーのプロファイル"""
+    name: str
+    overrides: Dict[str, str]
+    breaker: CircuitBreaker
+    base_url: Optional[str] = None
+    models: Dict[str, str] = field(default_factory=dict)
+
+    def env(self, base: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """claude に渡す環境変数（base の接続先・モデル設定をこのプロバイダーのもので置き換える）"""
+        env = {k: v for k, v in (base if base is not None else os.environ).items() if k not in PROVIDER_ENV_KEYS}
+        env.update(self.overrides)
+        return env
+
+    def stats(self) -> dict:
+        return {"name": self.name, "base_url": self.base_url, "models": self.models, **self.breaker.stats()}
+
+
+def load_providers(text: str, **breaker_options) -> List[Provider]:
+    """JSON のプロバイダー設定を読む
+
+    各要素のキー: name（必須）, base_url, api_key / api_key_env, auth_token / auth_token_env,
+    models（haiku / sonnet / opus / default → モデル名）, env（その他の環境変数）
+
+    Raises:
+        ProviderConfigError: 設定が不正
+    """
+    try:
+        profiles = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ProviderConfigError(f"プロバイダー設定を JSON として読めません: {e}")
+    if not isinstance(profiles, list) or not profiles:
+        raise ProviderConfigError("プロバイダー設定は1件以上のリストで指定してください")
+
+    providers = []
+    for profile in profiles:
+        if not isinstance(profile, dict) or not profile.get("name"):
+            raise ProviderConfigError(f"name のないプロバイダー設定があります: {profile}")
+        overrides: Dict[str, str] = {}
+        if profile.get("base_url"):
+            overrides["ANTHROPIC_BASE_URL"] = profile["base_url"]
+        for key, env_name in (("api_key", "ANTHROPIC_API_KEY"), ("auth_token", "ANTHROPIC_AUTH_TOKEN")):
+            value = profile.get(key)
+            if profile.get(f"{key}_env"):
+                value = os.getenv(profile[f"{key}_env"])
+                if not value:
+                    logger.warning(f"プロバイダー {profile['name']}: 環境変数 {profile[f'{key}_env']} が空です")
+            if value:
+                overrides[env_name] = value
+        models = profile.get("models") or {}
+        for alias, model in models.items():
+            if alias not in MODEL_ENV_KEYS:
+                raise ProviderConfigError(f"プロバイダー {profile['name']}: 不明なモデル指定 {alias}")
+            overrides[MODEL_ENV_KEYS[alias]] = model
+        overrides.update({k: str(v) for k, v in (profile.get("env") or {}).items()})
+        providers.append(Provider(
+            name=profile["name"],
+            overrides=overrides,
+            breaker=CircuitBreaker(profile["name"], **breaker_options),
+            base_url=profile.get("base_url"),
+            models=models,
+        ))
+    return providers
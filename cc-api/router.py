@@ -0,0 +1,144 @@
+"""
+モデルの振り分け（model tiering）
+
+リクエストごとに使うモデルの階層（fast / standard / heavy）を決め、claude --model に渡すモデルに変換する。
+既定の変換先は CLI のエイリアス（haiku / sonnet / opus）なので、
+ANTHROPIC_DEFAULT_HAIKU_MODEL などの設定がそのまま使われる。
+
+判定の順序:
+1. リクエストの model（階層名・エイリアス・モデル名）
+2. プロンプト（context を含む）が長い → heavy
+3. task レーンでファイルを書き換えるツールを許可 → heavy
+4. task 以外のレーンで短いプロンプト、書き換えツールなし → fast
+5. レーンごとの既定の階層（書き換えツールがあれば fast にはしない）
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+TIERS = ("fast", "standard", "heavy")
+DEFAULT_TIER_MODELS = {"fast": "haiku", "standard": "sonnet", "heavy": "opus"}
+DEFAULT_LANE_TIERS = {"interactive": "standard", "task": "standard", "background": "fast"}
+DEFAULT_HEAVY_TOOLS = ("Edit", "MultiEdit", "Write", "NotebookEdit", "Bash")
+
+routes = registry.counter("claude_model_routes_total", "モデル階層の振り分け結果", ["tier", "reason"])
+tier_run_seconds = registry.histogram(
+    "claude_tier_run_seconds", "モデル階層ごとの claude の実行時間", ["tier"]
+)
+tier_tokens = registry.counter(
+    "claude_tier_tokens_total", "モデル階層ごとの使用トークン数", ["tier", "type"]
+)
+
+
+def parse_mapping(value: str, defaults: Dict[str, str]) -> Dict[str, str]:
+    """"fast=haiku,standard=sonnet" 形式の対応表を読む（defaults にないキーは無視）"""
+    mapping = dict(defaults)
+    for item in value.split(","):
+        name, _, target = item.partition("=")
+        if name.strip() in mapping and target.strip():
+            mapping[name.strip()] = target.strip()
+    return mapping
+
+
+@dataclass
+class Route:
+    tier: str
+    reason: str
+
+
+class ModelRouter:
+    """リクエストの内容からモデルの階層を選ぶ
+
+    Args:
+        enabled: False ならリクエストで model を指定した場合だけ --model を付ける
+        tier_models: 階層 → --model に渡すモデル
+        lane_tiers: レーン → 既定の階層
+        fast_max_chars: これ以下の長さのプロンプトは fast にする
+        heavy_min_chars: これ以上の長さのプロンプトは heavy にする
+        heavy_tools: fast にしない（task レーンでは heavy にする）ツール。ファイルの書き換えとコマンド実行
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        tier_models: Optional[Dict[str, str]] = None,
+        lane_tiers: Optional[Dict[str, str]] = None,
+        fast_max_chars: int = 1000,
+        heavy_min_chars: int = 20000,
+        heavy_tools: tuple = DEFAULT_HEAVY_TOOLS,
+    ):
+        self.enabled = enabled
+        self.tier_models = tier_models or dict(DEFAULT_TIER_MODELS)
+        self.lane_tiers = lane_tiers or dict(DEFAULT_LANE_TIERS)
+        self.fast_max_chars = fast_max_chars
+        self.heavy_min_chars = heavy_min_chars
+        self.heavy_tools = set(heavy_tools)
+
+    def tier_of(self, model: Optional[str]) -> str:
+        """メトリクス用の階層名（指定なしは default、階層外のモデル名は custom）"""
+        if model is None:
+            return "default"
+        if model in self.tier_models:
+            return model
+        for tier, name in self.tier_models.items():
+            if name == model:
+                return tier
+        return "custom"
+
+    def model_for(self, model: Optional[str]) -> Optional[str]:
+        """--model に渡す値（階層名ならモデルに変換する）"""
+        if model is None:
+            return None
+        return self.tier_models.get(model, model)
+
+    def route(
+        self,
+        model: Optional[str],
+        lane: str,
+        prompt: str,
+        allowed_tools: List[str],
+        skip_permissions: bool,
+    ) -> Optional[str]:
+        """使う階層（またはリクエストで指定されたモデル）を返す。None なら CLI の既定のモデル
+
+        prompt は claude に実際に渡すプロンプト（context を付加したもの）を渡す。
+        """
+        if model:
+            decision = Route(self.tier_of(model), "request")
+            chosen = model
+        elif not self.enabled:
+            return None
+        else:
+            decision = self._decide(lane, len(prompt), allowed_tools, skip_permissions)
+            chosen = decision.tier
+        routes.inc(tier=decision.tier, reason=decision.reason)
+        logger.info(f"🎚️ モデル階層: {decision.tier} ({decision.reason}) → --model {self.model_for(chosen)}")
+        return chosen
+
+    def _decide(self, lane: str, prompt_chars: int, allowed_tools: List[str], skip_permissions: bool) -> Route:
+        writes = skip_permissions or bool(self.heavy_tools & set(allowed_tools or []))
+        if prompt_chars >= self.heavy_min_chars:
+            return Route("heavy", "long_prompt")
+        if lane == "task" and writes:
+            return Route("heavy", "tools")
+        if lane != "task" and prompt_chars <= self.fast_max_chars and not writes:
+            return Route("fast", "short_prompt")
+        tier = self.lane_tiers.get(lane, "standard")
+        if tier == "fast" and writes:
+            return Route("standard", "tools")
+        return Route(tier, "lane")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "tier_models": self.tier_models,
+            "lane_tiers": self.lane_tiers,
+            "fast_max_chars": self.fast_max_chars,
+            "heavy_min_chars": self.heavy_min_chars,
+            "heavy_tools": sorted(self.heavy_tools),
+        }
@@ -0,0 +1,428 @@
+"""
+Claude Code CLI 実行エンジン
+
+asyncio.create_subprocess_exec で claude を起動し、
+イベントループ（およびスレッドプール）をブロックせずに完了を待つ。
+
+stdout/stderr は全体を文字列として保持せず、一定量を超えた分は一時ファイルに書き出す。
+JSON は1行ずつ解析し、最終的な result イベントだけを保持する。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# 1回の read で読み込むバイト数
+READ_CHUNK = 64 * 1024
+# 出力をメモリに保持する上限（超えた分は一時ファイルへ）
+DEFAULT_MEMORY_LIMIT = 1024 * 1024
+# JSON として解析する1行の上限（stream-json の1行（ツール結果）は大きくなり得る）
+DEFAULT_MAX_LINE_BYTES = 16 * 1024 * 1024
+# ProcessResult の stdout/stderr に入れる文字列の上限
+DEFAULT_TEXT_LIMIT = 64 * 1024
+# SIGTERM を送ってから SIGKILL するまでの猶予
+DEFAULT_KILL_GRACE_SEC = 5.0
+
+spawn_seconds = registry.histogram(
+    "claude_spawn_seconds",
+    "claude プロセスの起動（fork/exec）にかかった時間（run / stream / pool）",
+    ["mode"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+reaped_processes = registry.counter(
+    "claude_processes_reaped_total",
+    "終了させたプロセス数（claude と Bash などの孫プロセス。reason: timeout / cancelled / exited / pool）",
+    ["reason", "signal"],
+)
+orphaned_processes = registry.counter(
+    "claude_processes_orphaned_total", "SIGKILL 後も終了しなかったプロセス数", ["reason"]
+)
+
+
+class LineTooLongError(Exception):
+    """stream-json の1行が上限を超えた（ProcessStream はそれ以上読み進められない）"""
+
+
+@dataclass
+class ProcessResult:
+    """claude プロセスの実行結果
+
+    stdout は先頭、stderr は末尾を text_limit まで切り詰めたもの。
+    """
+    returncode: int
+    stdout: str
+    stderr: str
+    duration_sec: float
+    result: Optional[dict] = None  # 最後の result イベント（見つからなければ None）
+    stdout_bytes: int = 0
+
+
+class OutputSpool:
+    """プロセス出力の保存先
+
+    memory_limit バイトまではメモリに置き、超えた分は一時ファイルに書き出す。
+    """
+
+    def __init__(self, memory_limit: int = DEFAULT_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self.size = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=memory_limit)
+
+    @property
+    def spilled(self) -> bool:
+        return self.size > self.memory_limit
+
+    def write(self, data: bytes):
+        self._file.write(data)
+        self.size += len(data)
+
+    def _read(self, offset: int, limit: int) -> str:
+        self._file.seek(offset)
+        data = self._file.read(limit)
+        self._file.seek(0, os.SEEK_END)
+        return data.decode("utf-8", errors="replace")
+
+    def head(self, limit: int) -> str:
+        return self._read(0, limit)
+
+    def tail(self, limit: int) -> str:
+        return self._read(max(0, self.size - limit), limit)
+
+    def close(self):
+        self._file.close()
+
+
+def parse_result_event(line: bytes) -> Optional[dict]:
+    """1行を JSON として解析し、result イベントであれば返す"""
+    if b'"result"' not in line:
+        return None
+    try:
+        event = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(event, dict) and event.get("type") == "result":
+        return event
+    return None
+
+
+async def pump(
+    reader: asyncio.StreamReader,
+    spool: OutputSpool,
+    on_line: Optional[Callable[[bytes], None]] = None,
+    max_line_bytes: int = DEFAULT_MAX_LINE_BYTES,
+):
+    """reader の出力を spool に書き出しながら、1行ずつ on_line に渡す
+
+    max_line_bytes を超える行は on_line に渡さずに読み飛ばす（spool には残る）。
+    """
+    buffer = bytearray()
+    oversized = False
+
+    def feed(data: bytes):
+        nonlocal oversized
+        if oversized:
+            return
+        buffer.extend(data)
+        if len(buffer) > max_line_bytes:
+            logger.warning(f"⚠️ {max_line_bytes} バイトを超える出力行を読み飛ばします")
+            buffer.clear()
+            oversized = True
+
+    while True:
+        chunk = await reader.read(READ_CHUNK)
+        if not chunk:
+            break
+        spool.write(chunk)
+        if on_line is None:
+            continue
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                feed(chunk[start:])
+                break
+            feed(chunk[start:end])
+            if not oversized:
+                on_line(bytes(buffer))
+            buffer.clear()
+            oversized = False
+            start = end + 1
+
+    if on_line is not None and buffer and not oversized:
+        on_line(bytes(buffer))
+
+
+async def spawn_process(cmd: List[str], mode: str, **kwargs) -> asyncio.subprocess.Process:
+    """claude を新しいプロセスグループで起動し、起動にかかった時間を記録する"""
+    start = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(*cmd, start_new_session=True, **kwargs)
+    spawn_seconds.observe(time.monotonic() - start, mode=mode)
+    return proc
+
+
+def group_members(pgid: int) -> List[int]:
+    """プロセスグループに属する生きているプロセスの pid 一覧（/proc がない環境では空）"""
+    members = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return members
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm に空白や括弧が含まれ得るので、最後の ')' より後ろを分割する（state, ppid, pgrp, ...）
+        fields = stat[stat.rfind(b")") + 2:].split()
+        if len(fields) > 2 and int(fields[2]) == pgid and fields[0] != b"Z":
+            members.append(int(entry))
+    return members
+
+
+def _signal_group(pgid: int, sig: int):
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _reap_zombies(pgid: int):
+    """グループ内で自分の子になったプロセス（PID 1 で動いている場合の孤児）を回収する"""
+    while True:
+        try:
+            pid, _ = os.waitpid(-pgid, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+async def kill_tree(proc: asyncio.subprocess.Process, reason: str, grace_sec: float = DEFAULT_KILL_GRACE_SEC):
+    """プロセスグループごと終了させて回収する
+
+    claude は start_new_session=True で起動しているので、pgid == pid のグループに
+    Bash などの孫プロセスも含まれる。SIGTERM を送り、grace_sec 以内に終わらなければ SIGKILL する。
+    claude が正常終了していても、グループに残っているプロセスがあれば同様に終了させる。
+    """
+    pgid = proc.pid
+    members = set(group_members(pgid))
+    if proc.returncode is None:
+        members.add(pgid)
+    if not members:
+        return
+
+    _signal_group(pgid, signal.SIGTERM)
+    signal_name = "SIGTERM"
+    deadline = time.monotonic() + grace_sec
+    while time.monotonic() < deadline:
+        if proc.returncode is None:
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=0.1)
+            except asyncio.TimeoutError:
+                continue
+        elif not group_members(pgid):
+            break
+        else:
+            await asyncio.sleep(0.1)
+    else:
+        signal_name = "SIGKILL"
+        _signal_group(pgid, signal.SIGKILL)
+
+    await proc.wait()
+    _reap_zombies(pgid)
+    reaped_processes.inc(len(members), reason=reason, signal=signal_name)
+
+    remaining = group_members(pgid)
+    if remaining:
+        await asyncio.sleep(0.1)
+        remaining = group_members(pgid)
+    if remaining:
+        orphaned_processes.inc(len(remaining), reason=reason)
+        logger.warning(f"⚠️ 終了しなかったプロセスがあります (pgid={pgid}, pids={remaining})")
+    else:
+        logger.info(f"🧹 プロセスグループ {pgid} を終了しました ({len(members)} プロセス, {signal_name}, reason={reason})")
+
+
+async def run_process(
+    cmd: List[str],
+    cwd: Optional[str],
+    timeout_sec: float,
+    memory_limit: int = DEFAULT_MEMORY_LIMIT,
+    max_line_bytes: int = DEFAULT_MAX_LINE_BYTES,
+    text_limit: int = DEFAULT_TEXT_LIMIT,
+    kill_grace_sec: float = DEFAULT_KILL_GRACE_SEC,
+    env: Optional[Dict[str, str]] = None,
+    on_line: Optional[Callable[[bytes], None]] = None,
+) -> ProcessResult:
+    """コマンドを実行して stdout/stderr を収集する
+
+    stdout は1行ずつ解析して最後の result イベントを ProcessResult.result に入れる（on_line にも渡す）。
+    出力全体は memory_limit を超えると一時ファイルに書き出し、終了後に破棄する。
+    env を省略するとサーバーの環境変数をそのまま引き継ぐ。
+
+    Raises:
+        FileNotFoundError: コマンドが見つからない
+        asyncio.TimeoutError: timeout_sec を超えた（プロセスグループは終了済み）
+    """
+    start = time.monotonic()
+    proc = await spawn_process(
+        cmd,
+        "run",
+        cwd=cwd,
+        env=env,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    stdout = OutputSpool(memory_limit)
+    stderr = OutputSpool(memory_limit)
+    result: Optional[dict] = None
+
+    def on_stdout_line(line: bytes):
+        nonlocal result
+        event = parse_result_event(line)
+        if event is not None:
+            result = event
+        if on_line is not None:
+            on_line(line)
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                pump(proc.stdout, stdout, on_stdout_line, max_line_bytes),
+                pump(proc.stderr, stderr),
+                proc.wait(),
+            ),
+            timeout=timeout_sec,
+        )
+        # claude が終了した後に残った孫プロセスも止める
+        await kill_tree(proc, "exited", kill_grace_sec)
+        if stdout.spilled or stderr.spilled:
+            logger.info(f"💾 出力を一時ファイルに退避しました (stdout: {stdout.size} バイト, stderr: {stderr.size} バイト)")
+        return ProcessResult(
+            returncode=proc.returncode,
+            stdout=stdout.head(text_limit),
+            stderr=stderr.tail(text_limit),
+            duration_sec=time.monotonic() - start,
+            result=result,
+            stdout_bytes=stdout.size,
+        )
+    except asyncio.TimeoutError:
+        await kill_tree(proc, "timeout", kill_grace_sec)
+        raise
+    except asyncio.CancelledError:
+        await asyncio.shield(kill_tree(proc, "cancelled", kill_grace_sec))
+        raise
+    finally:
+        stdout.close()
+        stderr.close()
+
+
+class ProcessStream:
+    """claude プロセスの stdout を1行ずつ読み出す（stream-json 用）
+
+    stderr はバックグラウンドで読み続けて（一定量を超えたら一時ファイルに退避）パイプ詰まりを防ぐ。
+
+    使用例:
+        async with ProcessStream(cmd, cwd, timeout_sec) as stream:
+            async for line in stream.lines():
+                ...
+        stream.returncode, stream.stderr
+    """
+
+    def __init__(
+        self,
+        cmd: List[str],
+        cwd: Optional[str],
+        timeout_sec: float,
+        text_limit: int = DEFAULT_TEXT_LIMIT,
+        kill_grace_sec: float = DEFAULT_KILL_GRACE_SEC,
+        env: Optional[Dict[str, str]] = None,
+        max_line_bytes: int = DEFAULT_MAX_LINE_BYTES,
+    ):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.timeout_sec = timeout_sec
+        self.text_limit = text_limit
+        self.kill_grace_sec = kill_grace_sec
+        self.max_line_bytes = max_line_bytes
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.returncode: Optional[int] = None
+        self.stderr = ""
+        self.start = 0.0
+        self._stderr_task: Optional[asyncio.Task] = None
+        self._stderr_spool = OutputSpool()
+
+    @property
+    def duration_sec(self) -> float:
+        return time.monotonic() - self.start
+
+    async def __aenter__(self) -> "ProcessStream":
+        self.start = time.monotonic()
+        self.proc = await spawn_process(
+            self.cmd,
+            "stream",
+            cwd=self.cwd,
+            env=self.env,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=self.max_line_bytes,
+        )
+        self._stderr_task = asyncio.create_task(pump(self.proc.stderr, self._stderr_spool))
+        return self
+
+    async def lines(self):
+        """stdout を1行ずつ返す
+
+        Raises:
+            asyncio.TimeoutError: timeout_sec を超えた
+            LineTooLongError: 1行が max_line_bytes を超えた（プロセスは __aexit__ で終了させる）
+        """
+        deadline = self.start + self.timeout_sec
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                line = await asyncio.wait_for(self.proc.stdout.readline(), timeout=remaining)
+            except ValueError as e:
+                # readline は limit を超えると ValueError（LimitOverrunError から変換）を送出する
+                raise LineTooLongError(f"{self.max_line_bytes} バイトを超える出力行を受け取りました") from e
+            if not line:
+                break
+            yield line.decode("utf-8", errors="replace")
+
+        remaining = max(deadline - time.monotonic(), 0.1)
+        self.returncode = await asyncio.wait_for(self.proc.wait(), timeout=remaining)
+        await self._stderr_task
+        self.stderr = self._stderr_spool.tail(self.text_limit)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # 途中終了（タイムアウト・クライアント切断）の場合はプロセスグループごと止める
+        if self.proc is not None:
+            if self.proc.returncode is None:
+                logger.warning("🛑 ストリーミング中断のため claude プロセスを終了します")
+            reason = "timeout" if exc_type is asyncio.TimeoutError else "cancelled"
+            if self.proc.returncode is not None:
+                reason = "exited"
+            await asyncio.shield(kill_tree(self.proc, reason, self.kill_grace_sec))
+        if self._stderr_task is not None and not self._stderr_task.done():
+            self._stderr_task.cancel()
+        self._stderr_spool.close()
+        return False
@@ -1,13 +1,37 @@
+import asyncio
 import json
 import logging
 import os
-import subprocess
-from typing import Optional, List
+import re
+import time
+import urllib.request
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable, Dict, List, Literal, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
 
+from admission import LANES, AdmissionController, AdmissionError, QueueFullError
+from cache import ResultCache, cache_key
+from confighome import ConfigHomeManager
+from contextpack import ContextPackManager
+from jobstore import JobStore
+from metrics import registry
+from pool import ClaudeWorkerPool, run_on_worker
+from providers import Provider, is_provider_failure, load_providers, provider_run_seconds, provider_runs
+from router import DEFAULT_HEAVY_TOOLS, DEFAULT_LANE_TIERS, DEFAULT_TIER_MODELS, ModelRouter, parse_mapping, tier_run_seconds, tier_tokens
+from runner import LineTooLongError, ProcessResult, ProcessStream, orphaned_processes, reaped_processes, run_process
+from sessions import SessionStore
+from singleflight import SingleFlight
+from workspace import MODES as WORKSPACE_MODES, WorkspaceError, WorkspaceManager
+
 # ロギング設定
 logging.basicConfig(
     level=logging.DEBUG,
@@ -15,7 +39,32 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Local Claude Code HTTP Wrapper")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if worker_pool:
+        worker_pool.start()
+        logger.info(f"🔥 事前起動ワーカープールを有効化: {worker_pool.stats()}")
+    workspaces.start()
+    if config_homes:
+        await config_homes.start()
+    await context_packs.start()
+    if job_store:
+        recover_jobs()
+    yield
+    # claude は別のプロセスグループで動くので、先にジョブを止めて kill_tree させる（孤児にしない）
+    await cancel_jobs()
+    await close_job_store()
+    await workspaces.close()
+    await context_packs.close()
+    if config_homes:
+        await config_homes.close()
+    if worker_pool:
+        await worker_pool.close()
+
+
+app = FastAPI(title="Local Claude Code HTTP Wrapper", lifespan=lifespan)
 
 # CORS設定（環境変数で制御、デフォルトでは空リストで明示的な指定を要求）
 ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "").split(",")
@@ -40,36 +89,432 @@ class RunRequest(BaseModel):
     skip_permissions: bool = Field(
         False, description="--dangerously-skip-permissions を使用するか"
     )
+    cache: bool = Field(
+        False, description="結果キャッシュを使うか（副作用のない実行のみ指定すること）"
+    )
+    conversation_key: Optional[str] = Field(
+        None, description="会話キー（Discord のスレッドIDなど）。同じキーの2回目以降は --resume で前回のセッションを再開する"
+    )
+    context: Optional[str] = Field(
+        None, description="新しいセッションを開始するときだけプロンプトに付加する文脈（会話履歴など）"
+    )
+    isolate: bool = Field(
+        False, description="cwd の隔離ワークスペース（overlay / reflink / git worktree）で実行するか"
+    )
+    merge_back: bool = Field(
+        False, description="isolate 時、ワークスペースの変更を cwd に書き戻すか"
+    )
+    lane: Literal["interactive", "task", "background"] = Field(
+        "interactive", description="優先度レーン（interactive > task > background）"
+    )
+    caller_id: Optional[str] = Field(
+        None, description="呼び出し元ID（ギルドIDなど）。X-Caller-Id ヘッダーでも指定できる"
+    )
+    model: Optional[str] = Field(
+        None, description="モデルの階層（fast / standard / heavy）またはモデル名。省略時は振り分け設定に従う"
+    )
+    hedge: Optional[bool] = Field(
+        None,
+        description="interactive レーンでヘッジ実行するか（省略時は読み取り専用のツールだけを許可している場合のみ）",
+    )
+    context_pack: bool = Field(
+        False, description="cwd の索引（ファイル構成・シンボル・最近の変更）の要約をシステムプロンプトに付加するか"
+    )
 
 
 class RunResponse(BaseModel):
     exit_code: int
     stdout_json: dict
+    session_id: Optional[str] = Field(None, description="claude のセッションID")
+    resumed: bool = Field(False, description="既存のセッションを --resume で再開したか")
+    cached: bool = Field(False, description="結果キャッシュから返したか")
+    model_tier: Optional[str] = Field(
+        None, description="使ったモデルの階層（fast / standard / heavy / custom / default）"
+    )
+    workspace: Optional[dict] = Field(
+        None, description="isolate 時の隔離ワークスペースの情報 {mode, changed, deleted, merged}"
+    )
+
+
+class BatchRequest(BaseModel):
+    requests: List[RunRequest] = Field(..., min_length=1, description="並列に実行する RunRequest のリスト")
+    max_parallel: Optional[int] = Field(
+        None, ge=1, description="このバッチで同時に実行する数の上限（省略時は CC_API_MAX_CONCURRENCY）"
+    )
+
+
+class JobStatus(str, Enum):
+    """非同期ジョブの状態
+
+    queued → running → succeeded / failed / cancelled
+    （queued のままキャンセル・失敗することもある）
+    interrupted は cc-api の再起動で実行が中断されたジョブ（再起動時に設定する）
+    """
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+    cancelled = "cancelled"
+    interrupted = "interrupted"
+
+
+# 許可される状態遷移（終了状態からは遷移しない）
+JOB_TRANSITIONS: Dict[JobStatus, set] = {
+    JobStatus.queued: {JobStatus.running, JobStatus.failed, JobStatus.cancelled},
+    JobStatus.running: {JobStatus.succeeded, JobStatus.failed, JobStatus.cancelled},
+}
+
+
+class JobRequest(RunRequest):
+    webhook_url: Optional[str] = Field(
+        None, description="ジョブ完了時に JobResponse を POST する URL（省略可）"
+    )
+
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: JobStatus
+    caller_id: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[RunResponse] = None
+    error: Optional[dict] = Field(None, description="失敗時の {status_code, detail}")
+
+
+@dataclass
+class Job:
+    """ジョブの実行状態（メモリ上で管理）"""
+    id: str
+    request: JobRequest
+    status: JobStatus = JobStatus.queued
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[RunResponse] = None
+    error: Optional[dict] = None
+    task: Optional[asyncio.Task] = None
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status not in JOB_TRANSITIONS
+
+    def transition(self, status: JobStatus):
+        """状態を遷移させる（不正な遷移は ValueError）"""
+        if status not in JOB_TRANSITIONS.get(self.status, set()):
+            raise ValueError(f"invalid job transition: {self.status.value} -> {status.value}")
+        self.status = status
+        if status == JobStatus.running:
+            self.started_at = time.time()
+        elif self.is_finished:
+            self.finished_at = time.time()
+            self.done.set()
+
+    def to_response(self) -> JobResponse:
+        return JobResponse(
+            job_id=self.id,
+            status=self.status,
+            caller_id=self.request.caller_id,
+            created_at=self.created_at,
+            started_at=self.started_at,
+            finished_at=self.finished_at,
+            result=self.result,
+            error=self.error,
+        )
+
+    def to_record(self) -> dict:
+        """JobStore に保存する形にする"""
+        usage = None
+        if self.result and self.result.stdout_json:
+            data = self.result.stdout_json
+            if data.get("usage") or data.get("total_cost_usd") is not None:
+                usage = {**(data.get("usage") or {}), "total_cost_usd": data.get("total_cost_usd")}
+        return {
+            "id": self.id,
+            "caller": self.request.caller_id,
+            "status": self.status.value,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "request": self.request.model_dump(mode="json"),
+            "result": self.result.model_dump(mode="json") if self.result else None,
+            "error": self.error,
+            "usage": usage,
+        }
+
+    @classmethod
+    def from_record(cls, record: dict) -> "Job":
+        """JobStore から読み込んだジョブ（終了済みとして扱う）"""
+        job = cls(
+            id=record["id"],
+            request=JobRequest.model_validate(record["request"]),
+            status=JobStatus(record["status"]),
+            created_at=record["created_at"],
+            started_at=record["started_at"],
+            finished_at=record["finished_at"],
+            result=RunResponse.model_validate(record["result"]) if record["result"] else None,
+            error=record["error"],
+        )
+        job.done.set()
+        return job
+
+
+# 同時実行数の制御（環境変数で調整可能）
+MAX_CONCURRENCY = int(os.getenv("CC_API_MAX_CONCURRENCY", "4"))
+MAX_QUEUE = int(os.getenv("CC_API_MAX_QUEUE", "16"))
+QUEUE_TIMEOUT_SEC = float(os.getenv("CC_API_QUEUE_TIMEOUT_SEC", "600"))
+RETRY_AFTER_SEC = int(os.getenv("CC_API_RETRY_AFTER_SEC", "10"))
+# 呼び出し元（ギルド・ユーザー）ごとの同時実行数の上限（0 なら無制限）
+CALLER_MAX_CONCURRENCY = int(os.getenv("CC_API_CALLER_MAX_CONCURRENCY", "0"))
+
+
+def parse_lane_limits(value: str) -> Dict[str, int]:
+    """"interactive=4,task=3,background=1" 形式のレーン別上限を読む"""
+    limits = {
+        "interactive": MAX_CONCURRENCY,
+        "task": max(1, MAX_CONCURRENCY - 1),
+        "background": max(1, MAX_CONCURRENCY // 4),
+    }
+    for item in value.split(","):
+        name, _, limit = item.partition("=")
+        if name.strip() in LANES and limit.strip():
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+# レーンごとの同時実行数の上限（background が実行枠を使い切らないようにする）
+LANE_LIMITS = parse_lane_limits(os.getenv("CC_API_LANE_LIMITS", ""))
+
+# モデルの振り分け（リクエストのレーン・プロンプトの長さ・許可ツールから fast / standard / heavy を選ぶ）
+model_router = ModelRouter(
+    enabled=os.getenv("CC_API_MODEL_ROUTING", "").lower() in ("1", "true", "yes"),
+    tier_models=parse_mapping(os.getenv("CC_API_MODEL_TIERS", ""), DEFAULT_TIER_MODELS),
+    lane_tiers=parse_mapping(os.getenv("CC_API_ROUTE_LANE_TIERS", ""), DEFAULT_LANE_TIERS),
+    fast_max_chars=int(os.getenv("CC_API_ROUTE_FAST_MAX_CHARS", "1000")),
+    heavy_min_chars=int(os.getenv("CC_API_ROUTE_HEAVY_MIN_CHARS", "20000")),
+    heavy_tools=tuple(
+        t.strip() for t in os.getenv("CC_API_ROUTE_HEAVY_TOOLS", ",".join(DEFAULT_HEAVY_TOOLS)).split(",") if t.strip()
+    ),
+)
+
+# API プロバイダー（Anthropic / Z.AI など）の切り替え。未指定ならサーバーの環境変数をそのまま使う
+PROVIDERS_FILE = os.getenv("CC_API_PROVIDERS_FILE")
+PROVIDERS_CONFIG = os.getenv("CC_API_PROVIDERS") or (open(PROVIDERS_FILE).read() if PROVIDERS_FILE else "")
+providers: List[Provider] = []
+if PROVIDERS_CONFIG:
+    providers = load_providers(
+        PROVIDERS_CONFIG,
+        window_sec=float(os.getenv("CC_API_BREAKER_WINDOW_SEC", "60")),
+        min_requests=int(os.getenv("CC_API_BREAKER_MIN_REQUESTS", "5")),
+        error_rate=float(os.getenv("CC_API_BREAKER_ERROR_RATE", "0.5")),
+        p95_sec=float(os.getenv("CC_API_BREAKER_P95_SEC", "0")),
+        cooldown_sec=float(os.getenv("CC_API_BREAKER_COOLDOWN_SEC", "30")),
+    )
+    logger.info(f"🔌 API プロバイダー: {', '.join(p.name for p in providers)}")
+
+# interactive レーンのヘッジ実行: 最初のイベントがこの秒数出なければ次のプロバイダーでも実行する（0 なら無効）
+HEDGE_AFTER_SEC = float(os.getenv("CC_API_HEDGE_AFTER_SEC", "0"))
+# 副作用のないツール（自動でヘッジ・別プロバイダーで実行し直してよく、同じ内容の実行の合流・結果キャッシュの対象にしてよいもの）
+HEDGE_SAFE_TOOLS = {
+    t.strip() for t in os.getenv("CC_API_HEDGE_SAFE_TOOLS", "Read,Grep,Glob,WebSearch,WebFetch").split(",") if t.strip()
+}
+
+# 事前起動ワーカープール（--input-format stream-json で起動して stdin で待機させる）
+POOL_ENABLED = os.getenv("CC_API_POOL_ENABLED", "").lower() in ("1", "true", "yes")
+worker_pool: Optional[ClaudeWorkerPool] = None
+if POOL_ENABLED:
+    worker_pool = ClaudeWorkerPool(
+        min_idle=int(os.getenv("CC_API_POOL_MIN_IDLE", "1")),
+        max_idle=int(os.getenv("CC_API_POOL_MAX_IDLE", "4")),
+        idle_ttl_sec=float(os.getenv("CC_API_POOL_IDLE_TTL_SEC", "600")),
+        max_uses=int(os.getenv("CC_API_POOL_MAX_USES", "1")),
+    )
+
+# 会話キー → セッションIDの対応表（--resume 用）
+sessions = SessionStore(
+    max_entries=int(os.getenv("CC_API_SESSION_MAX_ENTRIES", "1000")),
+    ttl_sec=float(os.getenv("CC_API_SESSION_TTL_SEC", "86400")),
+)
+
+# 結果キャッシュ（リクエストで cache=true を指定した場合のみ使用）
+CACHE_ENABLED = os.getenv("CC_API_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+result_cache: Optional[ResultCache] = None
+if CACHE_ENABLED:
+    result_cache = ResultCache(
+        ttl_sec=float(os.getenv("CC_API_CACHE_TTL_SEC", "600")),
+        max_entries=int(os.getenv("CC_API_CACHE_MAX_ENTRIES", "512")),
+        max_bytes=int(os.getenv("CC_API_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+        db_path=os.getenv("CC_API_CACHE_DB") or None,
+    )
+
+# 実行中の同一リクエストへの合流（single-flight）
+COALESCE_ENABLED = os.getenv("CC_API_COALESCE_ENABLED", "1").lower() in ("1", "true", "yes")
+inflight = SingleFlight()
+
+# claude の出力の扱い（メモリ上限を超えた出力は一時ファイルへ退避する）
+OUTPUT_MEMORY_BYTES = int(os.getenv("CC_API_OUTPUT_MEMORY_BYTES", str(1024 * 1024)))
+MAX_EVENT_BYTES = int(os.getenv("CC_API_MAX_EVENT_BYTES", str(16 * 1024 * 1024)))
+# クライアントに返す stdout_json の上限（超えた場合は result を切り詰める）
+MAX_RESULT_BYTES = int(os.getenv("CC_API_MAX_RESULT_BYTES", str(2 * 1024 * 1024)))
+
+# ジョブごとの隔離ワークスペース（リクエストで isolate=true を指定した場合のみ使用）
+workspaces = WorkspaceManager(
+    root=os.getenv("CC_API_WORKSPACE_ROOT", "/tmp/cc-api-workspaces"),
+    modes=[m.strip() for m in os.getenv("CC_API_WORKSPACE_MODES", ",".join(WORKSPACE_MODES)).split(",") if m.strip()],
+    gc_ttl_sec=float(os.getenv("CC_API_WORKSPACE_GC_SEC", "3600")),
+)
+
+# 実行ごとの Claude 設定ディレクトリ（CLAUDE_CONFIG_DIR）
+# 共有の ~/.claude をベースに実行ごとのディレクトリを作り、セッション記録だけを保管場所に回収する
+CONFIG_HOME_ENABLED = os.getenv("CC_API_CONFIG_HOME_ENABLED", "").lower() in ("1", "true", "yes")
+config_homes: Optional[ConfigHomeManager] = None
+if CONFIG_HOME_ENABLED:
+    config_base = os.getenv("CC_API_CONFIG_HOME_BASE") or os.getenv("CLAUDE_CONFIG_DIR") or os.path.expanduser("~/.claude")
+    config_homes = ConfigHomeManager(
+        base_dir=config_base,
+        root=os.getenv(
+            "CC_API_CONFIG_HOME_ROOT", "/dev/shm/cc-api-homes" if os.path.isdir("/dev/shm") else "/tmp/cc-api-homes"
+        ),
+        transcript_dir=os.getenv("CC_API_TRANSCRIPT_DIR", os.path.join(config_base, "cc-api-transcripts")),
+        retention_sec=float(os.getenv("CC_API_TRANSCRIPT_RETENTION_SEC", str(7 * 86400))),
+        compact_after_sec=float(os.getenv("CC_API_TRANSCRIPT_COMPACT_SEC", "3600")),
+        max_bytes=int(os.getenv("CC_API_TRANSCRIPT_MAX_BYTES", str(1024 * 1024 * 1024))),
+        state_file=os.getenv("CC_API_CONFIG_HOME_STATE_FILE") or None,
+    )
+
+# ワークスペースの索引（context_pack: true のリクエストでシステムプロンプトに要約を付加する）
+context_packs = ContextPackManager(
+    scan_interval_sec=float(os.getenv("CC_API_CONTEXT_PACK_SCAN_SEC", "30")),
+    token_budget=int(os.getenv("CC_API_CONTEXT_PACK_TOKENS", "1500")),
+    max_files=int(os.getenv("CC_API_CONTEXT_PACK_MAX_FILES", "5000")),
+    roots=[r.strip() for r in os.getenv("CC_API_CONTEXT_PACK_ROOTS", "").split(",") if r.strip()],
+)
+
+# 中断時に SIGTERM を送ってから SIGKILL するまでの猶予（claude と孫プロセスのグループ全体）
+KILL_GRACE_SEC = float(os.getenv("CC_API_KILL_GRACE_SEC", "5"))
+# クライアントの切断を確認する間隔
+DISCONNECT_POLL_SEC = 1.0
+
+# バッチ実行（/v1/claude/batch）で受け付ける件数の上限
+BATCH_MAX_ITEMS = int(os.getenv("CC_API_BATCH_MAX_ITEMS", "32"))
+
+# 非同期ジョブの保持設定
+JOB_TTL_SEC = int(os.getenv("CC_API_JOB_TTL_SEC", "3600"))  # 終了後に結果を保持する秒数
+JOB_MAX_WAIT_SEC = 60  # GET /v1/jobs/{id}?wait= の上限
+JOB_LIST_LIMIT = 50  # GET /v1/jobs で返す件数の上限
+# ジョブの保存先（SQLite）。指定すると再起動後も結果を取得でき、中断されたジョブは interrupted になる
+JOB_DB = os.getenv("CC_API_JOB_DB") or None
+WEBHOOK_TIMEOUT_SEC = 10
+
+admission = AdmissionController(
+    max_concurrency=MAX_CONCURRENCY,
+    max_queue=MAX_QUEUE,
+    queue_timeout_sec=QUEUE_TIMEOUT_SEC if QUEUE_TIMEOUT_SEC > 0 else None,
+    retry_after_sec=RETRY_AFTER_SEC,
+    lane_limits=LANE_LIMITS,
+    caller_limit=CALLER_MAX_CONCURRENCY or None,
+)
+
+# 実行結果のメトリクス（/metrics で Prometheus 形式で公開）
+run_seconds = registry.histogram(
+    "claude_run_seconds", "claude プロセスの実行時間（起動から終了まで）", ["lane", "mode"]
+)
+exit_codes = registry.counter("claude_exit_codes_total", "claude の終了コード", ["code"])
+run_timeouts = registry.counter("claude_timeouts_total", "claude 実行のタイムアウト回数", ["lane"])
+json_parse_failures = registry.counter(
+    "claude_json_parse_failures_total", "claude の出力を JSON として解析できなかった回数", ["mode"]
+)
+tokens_used = registry.counter(
+    "claude_tokens_total", "使用トークン数（input / output / cache_read / cache_creation）", ["caller", "model", "type"]
+)
+cost_usd = registry.counter("claude_cost_usd_total", "claude が報告した費用（USD）", ["caller", "model"])
+provider_failovers = registry.counter(
+    "claude_provider_failovers_total", "失敗したため次のプロバイダーで実行し直した回数", ["provider"]
+)
+hedged_runs = registry.counter("claude_hedged_runs_total", "ヘッジ実行の回数（先に成功した側）", ["winner"])
+
+# stdout_json.usage のフィールド → claude_tokens_total の type ラベル
+USAGE_TOKEN_FIELDS = {
+    "input_tokens": "input",
+    "output_tokens": "output",
+    "cache_read_input_tokens": "cache_read",
+    "cache_creation_input_tokens": "cache_creation",
+}
+# stdout_json.modelUsage（モデル別）のフィールド → type ラベル
+MODEL_USAGE_TOKEN_FIELDS = {
+    "inputTokens": "input",
+    "outputTokens": "output",
+    "cacheReadInputTokens": "cache_read",
+    "cacheCreationInputTokens": "cache_creation",
+}
+
+# システムプロンプト：discordスキルを使うように指示
+SYSTEM_PROMPT = """discord skills を使用してユーザーに返信して。sudo を パスワード無しで使用できるので必要であれば使用して。また、パッケージも必要であればインストールして。
+"""
 
 
 @app.get("/health")
 def health():
-    return {"ok": True}
+    return {"ok": True, "queue": admission.stats()}
 
 
-@app.post("/v1/claude/run", response_model=RunResponse)
-def run(req: RunRequest):
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus のテキスト形式でメトリクスを返す"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/v1/stats")
+def stats():
+    """実行状況とメトリクスのスナップショット"""
+    return {
+        "queue": admission.stats(),
+        "pool": worker_pool.stats() if worker_pool else None,
+        "sessions": sessions.stats(),
+        "cache": result_cache.stats() if result_cache else None,
+        "coalescing": inflight.stats() if COALESCE_ENABLED else None,
+        "model_routing": model_router.stats(),
+        "providers": [p.stats() for p in providers] or None,
+        "workspaces": workspaces.stats(),
+        "jobs": {"active": len(jobs), "store": job_store.stats() if job_store else None},
+        "config_homes": config_homes.stats() if config_homes else None,
+        "context_packs": context_packs.stats(),
+        "processes": {
+            "reaped": sum(v["value"] for v in reaped_processes.snapshot()),
+            "orphaned": sum(v["value"] for v in orphaned_processes.snapshot()),
+        },
+        "metrics": registry.snapshot(),
+    }
+
+
+async def system_prompt_for(req: RunRequest) -> str:
+    """追加のシステムプロンプト（context_pack 指定時は cwd の索引の要約を付加する）"""
+    if not req.context_pack or not req.cwd:
+        return SYSTEM_PROMPT
+    digest = await context_packs.digest(req.cwd)
+    return f"{SYSTEM_PROMPT}\n{digest}\n" if digest else SYSTEM_PROMPT
+
+
+def build_command(
+    req: RunRequest,
+    output_format: str = "json",
+    resume_session_id: Optional[str] = None,
+    system_prompt: str = SYSTEM_PROMPT,
+) -> List[str]:
+    """claude CLI のコマンドライン（プロンプトを除く）を組み立てる"""
     # --dangerously-skip-permissions を使用するかどうか
     # 環境変数 CLAUDE_SKIP_PERMISSIONS またはリクエストパラメータで制御
     skip_permissions_env = os.getenv("CLAUDE_SKIP_PERMISSIONS", "").lower() in ("1", "true", "yes")
     skip_permissions = skip_permissions_env or req.skip_permissions
 
-    # システムプロンプト：discordスキルを使うように指示
-    system_prompt = """discord skills を使用してユーザーに返信して。sudo を パスワード無しで使用できるので必要であれば使用して。また、パッケージも必要であればインストールして。
-"""
-
     cmd = [
         "claude",
         "--print",
         "--append-system-prompt",
         system_prompt,
         "--output-format",
-        "json",
+        output_format,
     ]
 
     # skip_permissions が有効でない場合のみ、allowedTools を追加
@@ -85,6 +530,14 @@ def run(req: RunRequest):
     if skip_permissions:
         cmd.append("--dangerously-skip-permissions")
 
+    model = model_router.model_for(req.model)
+    if model:
+        cmd.extend(["--model", model])
+
+    # 同じ会話の2回目以降は前回のセッションを再開する
+    if resume_session_id:
+        cmd.extend(["--resume", resume_session_id])
+
     skip_perms_info = " --dangerously-skip-permissions" if skip_permissions else ""
     allowed_tools_info = f" --allowedTools {allowed_tools_str}" if not skip_permissions else ""
 
@@ -92,56 +545,387 @@ def run(req: RunRequest):
     logger.info("=" * 60)
     logger.info("📝 Claude Code実行リクエスト")
     logger.info("=" * 60)
-    logger.info(f"🔧 コマンド: claude --print --append-system-prompt <...> <prompt> --output-format json{allowed_tools_info}{skip_perms_info}")
+    logger.info(f"🔧 コマンド: claude --print --append-system-prompt <...> <prompt> --output-format {output_format}{allowed_tools_info}{skip_perms_info}")
     logger.info(f"📁 作業ディレクトリ: {req.cwd or 'default'}")
     logger.info(f"⏱️ タイムアウト: {req.timeout_sec}秒")
     logger.info(f"🔓 Skip permissions: {skip_permissions}")
+    logger.info(f"🚦 レーン: {req.lane} (呼び出し元: {req.caller_id or '不明'})")
+    logger.info(f"🎚️ モデル: {model or 'default'}")
+    if req.conversation_key:
+        logger.info(f"🧵 会話キー: {req.conversation_key} (resume: {resume_session_id or 'なし'})")
     logger.info(f"📝 プロンプト (最初の500文字):\n{req.prompt[:500]}")
     logger.debug(f"📝 プロンプト (全体):\n{req.prompt}")
     logger.info("=" * 60)
 
+    return cmd
+
+
+def admission_http_error(e: AdmissionError) -> HTTPException:
+    """AdmissionError を Retry-After 付きの HTTPException に変換する"""
+    return HTTPException(
+        e.status_code,
+        {"error": str(e), "queue": admission.stats()},
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+# stdout_json が大きすぎる場合に残すフィールド
+RESULT_SUMMARY_FIELDS = (
+    "type", "subtype", "is_error", "session_id", "duration_ms", "num_turns", "total_cost_usd", "usage",
+)
+
+
+def cap_stdout_json(data: dict) -> dict:
+    """クライアントに返す stdout_json を MAX_RESULT_BYTES 以内に収める
+
+    result（本文）を切り詰め、それでも収まらなければ要約フィールドだけを返す。
+    """
+    size = len(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+    if size <= MAX_RESULT_BYTES:
+        return data
+
+    logger.warning(f"✂️ stdout_json が {size} バイトのため {MAX_RESULT_BYTES} バイトに切り詰めます")
+    result = data.get("result")
+    if isinstance(result, str):
+        encoded = result.encode("utf-8")
+        keep = max(0, len(encoded) - (size - MAX_RESULT_BYTES) - 1024)
+        capped = {**data, "result": encoded[:keep].decode("utf-8", errors="ignore"), "truncated": True}
+        if len(json.dumps(capped, ensure_ascii=False).encode("utf-8")) <= MAX_RESULT_BYTES:
+            return capped
+
+    summary = {name: data[name] for name in RESULT_SUMMARY_FIELDS if name in data}
+    return {**summary, "result": "", "truncated": True}
+
+
+def record_usage(data: dict, caller: Optional[str], model: Optional[str] = None, tier: str = "default"):
+    """result イベントのトークン数と費用をメトリクスに加算する
+
+    modelUsage（モデル別の内訳）があればそれを使い、なければ usage / total_cost_usd を使う。
+    モデル階層ごとのトークン数は usage（全モデルの合計）から加算する。
+    """
+    caller = caller or "unknown"
+    for field_name, token_type in USAGE_TOKEN_FIELDS.items():
+        if (data.get("usage") or {}).get(field_name):
+            tier_tokens.inc(data["usage"][field_name], tier=tier, type=token_type)
+    model_usage = data.get("modelUsage")
+    if isinstance(model_usage, dict) and model_usage:
+        for name, usage in model_usage.items():
+            for field_name, token_type in MODEL_USAGE_TOKEN_FIELDS.items():
+                if usage.get(field_name):
+                    tokens_used.inc(usage[field_name], caller=caller, model=name, type=token_type)
+            if usage.get("costUSD"):
+                cost_usd.inc(usage["costUSD"], caller=caller, model=name)
+        return
+
+    model = model or data.get("model") or "unknown"
+    usage = data.get("usage") or {}
+    for field_name, token_type in USAGE_TOKEN_FIELDS.items():
+        if usage.get(field_name):
+            tokens_used.inc(usage[field_name], caller=caller, model=model, type=token_type)
+    if data.get("total_cost_usd"):
+        cost_usd.inc(data["total_cost_usd"], caller=caller, model=model)
+
+
+def compose_prompt(req: RunRequest, resumed: bool) -> str:
+    """実際に claude に渡すプロンプト（新規セッションのときだけ context を付加する）"""
+    if req.context and not resumed:
+        return f"{req.prompt}\n\n{req.context}"
+    return req.prompt
+
+
+@asynccontextmanager
+async def run_directory(req: RunRequest):
+    """claude の実行ディレクトリを返す（isolate 指定時は隔離ワークスペース）
+
+    Yields:
+        (cwd, Workspace または None)
+    """
+    if not req.isolate:
+        yield req.cwd, None
+        return
+    if not req.cwd:
+        raise HTTPException(422, "isolate を使うには cwd の指定が必要です")
+    try:
+        async with workspaces.isolated(req.cwd, merge_back=req.merge_back) as ws:
+            yield ws.path, ws
+    except WorkspaceError as e:
+        logger.error(f"隔離ワークスペースの作成に失敗: {e}")
+        raise HTTPException(500, str(e))
+
+
+@asynccontextmanager
+async def run_env(resume_session_id: Optional[str]):
+    """claude に渡す環境変数を返す（設定ディレクトリを分ける場合のみ。それ以外は None）"""
+    if config_homes is None:
+        yield None
+        return
+    async with config_homes.home(resume_session_id) as home:
+        yield home.env()
+
+
+def run_failed(p: ProcessResult) -> bool:
+    """プロバイダーの失敗とみなす結果か（result イベントがない、または API の障害）
+
+    ターン数の上限やツール・権限のエラーは claude の結果としてそのまま返す。
+    """
+    return is_provider_failure(p.result)
+
+
+def run_outcome(result: Optional[dict]) -> str:
+    """メトリクス用の実行結果（failure だけがサーキットブレーカーの失敗）"""
+    if is_provider_failure(result):
+        return "failure"
+    return "error" if result.get("is_error") else "success"
+
+
+def should_hedge(req: RunRequest, resume_session_id: Optional[str]) -> bool:
+    """ヘッジ実行するか（同じセッションを2つのプロセスで再開しないよう --resume 時はしない）"""
+    if HEDGE_AFTER_SEC <= 0 or len(providers) < 2 or req.lane != "interactive":
+        return False
+    if resume_session_id or req.hedge is False:
+        return False
+    if req.hedge:
+        return True
+    return not req.skip_permissions and set(req.allowed_tools or ["Read"]) <= HEDGE_SAFE_TOOLS
+
+
+def record_provider(provider: Provider, ok: bool, duration_sec: float, outcome: str):
+    provider.breaker.record(ok, duration_sec)
+    provider_runs.inc(provider=provider.name, outcome=outcome)
+    if ok:
+        provider_run_seconds.observe(duration_sec, provider=provider.name)
+
+
+def pick_provider() -> Optional[Provider]:
+    """使えるプロバイダーのうち優先順位の最も高いもの（すべて停止中なら先頭）"""
+    if not providers:
+        return None
+    for provider in providers:
+        if provider.breaker.allow():
+            return provider
+    return providers[0]
+
+
+async def run_on_provider(
+    provider: Provider,
+    req: RunRequest,
+    cmd: List[str],
+    cwd: Optional[str],
+    env: Optional[Dict[str, str]],
+    on_line: Optional[Callable[[bytes], None]] = None,
+) -> ProcessResult:
+    """プロバイダーの環境変数で claude を実行し、結果をサーキットブレーカーに記録する"""
+    start = time.monotonic()
     try:
-        # -pを使ってプロンプトを渡す
-        p = subprocess.run(
-            cmd + [req.prompt],
-            cwd=req.cwd,
-            capture_output=True,
-            text=True,
-            timeout=req.timeout_sec,
-            check=False,
+        p = await run_process(
+            cmd,
+            cwd=cwd,
+            timeout_sec=req.timeout_sec,
+            memory_limit=OUTPUT_MEMORY_BYTES,
+            max_line_bytes=MAX_EVENT_BYTES,
+            kill_grace_sec=KILL_GRACE_SEC,
+            env=provider.env(env),
+            on_line=on_line,
         )
+    except asyncio.TimeoutError:
+        record_provider(provider, False, time.monotonic() - start, "timeout")
+        raise
+    except BaseException:
+        provider.breaker.abandon()
+        raise
+    outcome = run_outcome(p.result)
+    record_provider(provider, outcome != "failure", p.duration_sec, outcome)
+    return p
+
+
+def is_progress_event(line: bytes) -> bool:
+    """stream-json の行が init 以外のイベント（プロバイダーが応答し始めた印）か"""
+    try:
+        event = json.loads(line)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(event, dict) and event.get("type") not in (None, "system")
+
+
+async def run_hedged(
+    primary: Provider,
+    secondary: Provider,
+    req: RunRequest,
+    cmd: List[str],
+    cwd: Optional[str],
+    env: Optional[Dict[str, str]],
+) -> ProcessResult:
+    """primary で実行し、HEDGE_AFTER_SEC 秒たっても最初のイベントが出なければ secondary でも実行する
+
+    先に成功した方の結果を返し、もう一方はプロセスグループごと終了させる。
+    """
+    responded = asyncio.Event()
+
+    def on_line(line: bytes):
+        if not responded.is_set() and is_progress_event(line):
+            responded.set()
+
+    tasks = {asyncio.create_task(run_on_provider(primary, req, cmd, cwd, env, on_line)): "primary"}
+    waiter = asyncio.create_task(responded.wait())
+    try:
+        done, _ = await asyncio.wait({*tasks, waiter}, timeout=HEDGE_AFTER_SEC, return_when=asyncio.FIRST_COMPLETED)
+        if not done and secondary.breaker.allow():
+            logger.info(f"🪁 {primary.name} から {HEDGE_AFTER_SEC:g}秒応答がないため {secondary.name} でも実行します")
+            tasks[asyncio.create_task(run_on_provider(secondary, req, cmd, cwd, env))] = "secondary"
+        waiter.cancel()
+
+        pending = set(tasks)
+        failed: Optional[ProcessResult] = None
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = error or task.exception()
+                    continue
+                if not run_failed(task.result()):
+                    if len(tasks) > 1:
+                        hedged_runs.inc(winner=tasks[task])
+                        logger.info(f"🪁 ヘッジ実行: {tasks[task]} の結果を使います")
+                    return task.result()
+                failed = task.result()
+        if len(tasks) > 1:
+            hedged_runs.inc(winner="none")
+        if failed is not None:
+            return failed
+        raise error
+    finally:
+        waiter.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_with_providers(
+    req: RunRequest, cmd: List[str], cwd: Optional[str], env: Optional[Dict[str, str]], hedge: bool
+) -> ProcessResult:
+    """優先順位の高いプロバイダーから実行し、失敗したら次のプロバイダーで実行し直す
+
+    サーキットブレーカーが止めているプロバイダー（half-open でほかのリクエストが試行中のものを含む）は飛ばし、
+    すべて止まっていれば先頭を使う。
+    タイムアウトと、ファイルや外部に書き込みうる実行（has_side_effects）は実行し直さない。
+    """
+    candidates = list(providers)
+    p: Optional[ProcessResult] = None
+    while candidates:
+        provider = candidates.pop(0)
+        if not provider.breaker.allow():
+            continue
+        secondary = next((c for c in candidates if c.breaker.available()), None) if hedge else None
+        if secondary:
+            # ヘッジに使ったプロバイダーはこの後のフェイルオーバーでは使わない
+            candidates.remove(secondary)
+            p = await run_hedged(provider, secondary, req, cmd, cwd, env)
+        else:
+            p = await run_on_provider(provider, req, cmd, cwd, env)
+        if not run_failed(p):
+            return p
+        if candidates and has_side_effects(req):
+            logger.warning(f"{provider.name} での実行に失敗しました（書き込みうる実行なので実行し直しません）")
+            return p
+        if candidates:
+            provider_failovers.inc(provider=provider.name)
+            logger.warning(f"🔁 {provider.name} での実行に失敗したため次のプロバイダーで実行し直します")
+
+    if p is None:
+        logger.warning("すべてのプロバイダーが停止中のため、先頭のプロバイダーで実行します")
+        p = await run_on_provider(providers[0], req, cmd, cwd, env)
+    return p
+
+
+async def execute_once(
+    req: RunRequest,
+    resume_session_id: Optional[str] = None,
+    on_start: Optional[Callable[[], None]] = None,
+) -> RunResponse:
+    """claude を1回実行して RunResponse を返す（失敗時は HTTPException）"""
+    prompt = compose_prompt(req, resumed=resume_session_id is not None)
+    # --resume は実行ごとにコマンドラインが、隔離ワークスペースは cwd が、
+    # 実行ごとの設定ディレクトリとプロバイダーの切り替えは環境変数が、索引の要約はシステムプロンプトが変わるので
+    # 事前起動ワーカーは使わない
+    use_pool = (
+        worker_pool is not None and resume_session_id is None and not req.isolate
+        and config_homes is None and not providers and not req.context_pack
+    )
+    hedge = should_hedge(req, resume_session_id)
+    system_prompt = await system_prompt_for(req)
+    if use_pool:
+        cmd = build_command(req, output_format="stream-json") + ["--verbose", "--input-format", "stream-json"]
+    elif hedge:
+        # 最初のイベントが出たかを見るため stream-json で実行する（最後の result イベントは同じ形）
+        cmd = build_command(
+            req, output_format="stream-json", resume_session_id=resume_session_id, system_prompt=system_prompt
+        ) + ["--verbose"]
+    else:
+        cmd = build_command(req, resume_session_id=resume_session_id, system_prompt=system_prompt)
+
+    try:
+        async with admission.slot(req.lane, req.caller_id):
+            if on_start:
+                on_start()
+            async with run_directory(req) as (cwd, ws), run_env(resume_session_id) as env:
+                if use_pool:
+                    # 事前起動ワーカーに stdin でプロンプトを渡す
+                    p = await run_on_worker(worker_pool, cmd, cwd, prompt, timeout_sec=req.timeout_sec)
+                elif providers:
+                    p = await run_with_providers(req, cmd + [prompt], cwd, env, hedge)
+                else:
+                    # -pを使ってプロンプトを渡す
+                    p = await run_process(
+                        cmd + [prompt],
+                        cwd=cwd,
+                        timeout_sec=req.timeout_sec,
+                        memory_limit=OUTPUT_MEMORY_BYTES,
+                        max_line_bytes=MAX_EVENT_BYTES,
+                        kill_grace_sec=KILL_GRACE_SEC,
+                        env=env,
+                    )
+
+        run_seconds.observe(p.duration_sec, lane=req.lane, mode="pool" if use_pool else "run")
+        tier_run_seconds.observe(p.duration_sec, tier=model_router.tier_of(req.model))
+        exit_codes.inc(code=p.returncode)
 
         # 実行結果を詳細にログ
         logger.info(f"📊 実行結果")
         logger.info(f"   - Exit code: {p.returncode}")
+        logger.info(f"   - 実行時間: {p.duration_sec:.1f}秒")
+        logger.info(f"   - 出力サイズ: {p.stdout_bytes} バイト")
 
-        try:
-            data = json.loads(p.stdout)
-            result = data.get("result", "")
+        if p.result is not None:
+            result = p.result.get("result") or ""
             result_preview = result[:300] + "..." if len(result) > 300 else result
             logger.info(f"   - 結果プレビュー:\n{result_preview}")
 
             # 使用ツールを表示
-            usage = data.get("usage", {})
+            usage = p.result.get("usage", {})
             if usage:
                 logger.info(f"   - 使用トークン: {usage.get('input_tokens', 0)} input / {usage.get('output_tokens', 0)} output")
-        except:
+        else:
             logger.info(f"   - 出力 (最初の500文字): {p.stdout[:500]}")
 
         if p.stderr:
             logger.debug(f"   - Stderr: {p.stderr}")
 
+    except AdmissionError as e:
+        raise admission_http_error(e)
     except FileNotFoundError as e:
         logger.error(f"claude command not found: {e}")
         raise HTTPException(500, "claude コマンドが見つかりません（PATHを確認）")
-    except subprocess.TimeoutExpired as e:
+    except asyncio.TimeoutError:
         logger.error(f"Command timeout after {req.timeout_sec} seconds")
+        run_timeouts.inc(lane=req.lane)
         raise HTTPException(504, "claude 実行がタイムアウトしました")
 
     if p.returncode != 0:
         # stdout/stderr を返す（デバッグ用）
         error_detail = {
             "exit_code": p.returncode,
+            "has_result": p.result is not None,
             "stderr": p.stderr.strip(),
             "stdout": p.stdout.strip()[:2000],  # 最初の2000文字
         }
@@ -149,18 +933,655 @@ def run(req: RunRequest):
         logger.error(f"Error detail: {error_detail}")
         raise HTTPException(500, error_detail)
 
-    # claude --output-format json の出力を JSON としてパース
-    try:
-        data = json.loads(p.stdout)
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse JSON from claude output: {e}")
+    # claude --output-format json の出力（result イベント）は実行中に1行ずつ解析済み
+    if p.result is None:
+        json_parse_failures.inc(mode="run")
+        logger.error(f"No result event in claude output ({p.stdout_bytes} bytes)")
         logger.error(f"Raw stdout (first 1000 chars): {p.stdout[:1000]}")
         raise HTTPException(
             500,
             {"error": "claude のstdoutがJSONとして解析できませんでした", "stdout": p.stdout[:2000]},
         )
+    record_usage(p.result, req.caller_id, tier=model_router.tier_of(req.model))
+    data = cap_stdout_json(p.result)
 
     logger.info("=" * 60)
     logger.info("✅ コマンド実行成功")
     logger.info("=" * 60)
-    return RunResponse(exit_code=p.returncode, stdout_json=data)
+    return RunResponse(
+        exit_code=p.returncode,
+        stdout_json=data,
+        session_id=data.get("session_id"),
+        resumed=resume_session_id is not None,
+        workspace=ws.summary() if ws else None,
+        model_tier=model_router.tier_of(req.model),
+    )
+
+
+# --resume に渡したセッションが見つからないときの CLI のエラー
+SESSION_NOT_FOUND_PATTERN = re.compile(r"No conversation found|session .*not found", re.IGNORECASE)
+
+
+def resume_failed(e: HTTPException) -> bool:
+    """--resume そのものが失敗したか（セッションが見つからない、または result イベントが出ていない）
+
+    result イベントまで進んだ実行はツールを実行し終えているので、再開の失敗とはみなさない。
+    """
+    if e.status_code != 500 or not isinstance(e.detail, dict):
+        return False
+    output = f"{e.detail.get('stderr', '')}\n{e.detail.get('stdout', '')}"
+    return bool(SESSION_NOT_FOUND_PATTERN.search(output)) or not e.detail.get("has_result", False)
+
+
+def has_side_effects(req: RunRequest) -> bool:
+    """ファイルや外部に書き込みうる実行か（isolate・権限確認のスキップ・読み取り専用でないツール）
+
+    こうした実行は同じ内容でも結果を使い回さず（合流・キャッシュしない）、毎回実行する。
+    """
+    return req.isolate or req.skip_permissions or not set(req.allowed_tools or ["Read"]) <= HEDGE_SAFE_TOOLS
+
+
+def run_cache_key(req: RunRequest) -> str:
+    """結果に影響する要素（プロンプト・システムプロンプト・cwd・許可ツール・モデル設定・隔離）からキーを作る"""
+    model_env = {
+        name: value for name, value in os.environ.items()
+        if name.startswith("ANTHROPIC_") and name not in ("ANTHROPIC_API_KEY", "ANTHROPIC_AUTH_TOKEN")
+    }
+    return cache_key(
+        prompt=compose_prompt(req, resumed=False),
+        system_prompt=SYSTEM_PROMPT,
+        cwd=req.cwd,
+        allowed_tools=sorted(req.allowed_tools or ["Read"]),
+        skip_permissions=req.skip_permissions,
+        model=model_router.model_for(req.model),
+        context_pack=req.context_pack,
+        isolate=req.isolate,
+        merge_back=req.merge_back,
+        model_env=model_env,
+    )
+
+
+async def execute_cached(req: RunRequest, on_start: Optional[Callable[[], None]] = None) -> RunResponse:
+    """結果キャッシュを参照し、なければ実行して成功した結果を保存する"""
+    key = run_cache_key(req)
+    hit = await asyncio.to_thread(result_cache.get, key)
+    if hit:
+        data, age = hit
+        logger.info(f"⚡ 結果キャッシュにヒット ({age:.0f}秒前の結果)")
+        if on_start:
+            on_start()
+        return RunResponse(
+            exit_code=0,
+            stdout_json=data,
+            session_id=data.get("session_id"),
+            cached=True,
+            model_tier=model_router.tier_of(req.model),
+        )
+
+    response = await execute_once(req, on_start=on_start)
+    if not response.stdout_json.get("is_error"):
+        await asyncio.to_thread(result_cache.put, key, response.stdout_json)
+    return response
+
+
+async def execute_run(req: RunRequest, on_start: Optional[Callable[[], None]] = None) -> RunResponse:
+    """claude を実行して RunResponse を返す（失敗時は HTTPException）
+
+    同じ内容のリクエストが実行中であれば、新しく起動せずにその結果を待つ。
+
+    Args:
+        req: 実行リクエスト
+        on_start: 実行枠を確保してプロセスを起動する直前に呼ばれるコールバック
+            （実行中のリクエストに合流した場合は呼ばれない）
+    """
+    apply_model_route(req)
+    if not COALESCE_ENABLED or has_side_effects(req):
+        return await execute_session(req, on_start)
+
+    key = cache_key(
+        run=run_cache_key(req),
+        conversation_key=req.conversation_key,
+        timeout_sec=req.timeout_sec,
+        cache=req.cache,
+        lane=req.lane,
+        hedge=req.hedge,
+    )
+    return await inflight.do(key, lambda: execute_session(req, on_start))
+
+
+async def execute_session(req: RunRequest, on_start: Optional[Callable[[], None]] = None) -> RunResponse:
+    """claude を実行する（conversation_key があればセッションを再開する）
+
+    conversation_key が指定されていれば、前回のセッションを --resume で再開する。
+    再開に失敗した場合（セッションが消えていた等）は新しいセッションで1回だけやり直す。
+    ファイルや外部に書き込みうる実行（has_side_effects）はやり直さず、セッションを忘れて失敗を返す。
+    """
+    if not req.conversation_key:
+        if req.cache and result_cache and not has_side_effects(req):
+            return await execute_cached(req, on_start)
+        return await execute_once(req, on_start=on_start)
+
+    started = False
+
+    def start_once():
+        nonlocal started
+        if on_start and not started:
+            started = True
+            on_start()
+
+    key = req.conversation_key
+    # 同じ会話のターンは直列に実行する（同じセッションを同時に再開しない）
+    async with sessions.lock(key):
+        session_id = sessions.get(key)
+        response = None
+        if session_id:
+            try:
+                response = await execute_once(req, resume_session_id=session_id, on_start=start_once)
+            except HTTPException as e:
+                if not resume_failed(e):
+                    raise
+                sessions.forget(key)
+                if has_side_effects(req):
+                    logger.warning(f"セッション {session_id} の再開に失敗しました（書き込みうる実行なのでやり直しません）")
+                    raise
+                logger.warning(f"セッション {session_id} の再開に失敗したため新しいセッションで実行します")
+
+        if response is None:
+            response = await execute_once(req, on_start=start_once)
+
+        if response.session_id:
+            sessions.set(key, response.session_id)
+        return response
+
+
+def apply_model_route(req: RunRequest):
+    """使うモデルの階層を決めて req.model に入れる（リクエストごとに1回だけ呼ぶ）
+
+    長さは context を含めた新規セッションのプロンプトで測る。
+    """
+    prompt = compose_prompt(req, resumed=False)
+    req.model = model_router.route(req.model, req.lane, prompt, req.allowed_tools, req.skip_permissions)
+
+
+def apply_caller_header(req: RunRequest, caller_id: Optional[str]):
+    """X-Caller-Id ヘッダーを呼び出し元IDとして使う（ボディの指定を優先）"""
+    if not req.caller_id and caller_id:
+        req.caller_id = caller_id
+
+
+async def cancel_on_disconnect(request: Request, awaitable):
+    """クライアントが切断したら実行をキャンセルする（claude のプロセスグループも終了させる）"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SEC)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.warning("🔌 クライアントが切断したため claude の実行を中止します")
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                raise HTTPException(499, "クライアントが切断しました")
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+@app.post("/v1/claude/run", response_model=RunResponse)
+async def run(req: RunRequest, request: Request, response: Response, x_caller_id: Optional[str] = Header(None)):
+    apply_caller_header(req, x_caller_id)
+    result = await cancel_on_disconnect(request, execute_run(req))
+    if req.cache and result_cache:
+        response.headers["X-Cache"] = "HIT" if result.cached else "MISS"
+    return result
+
+
+def translate_stream_event(event: dict) -> List[dict]:
+    """claude の stream-json イベントをクライアント向けのイベントに変換する"""
+    event_type = event.get("type")
+
+    if event_type == "system" and event.get("subtype") == "init":
+        return [{"event": "start", "session_id": event.get("session_id"), "model": event.get("model")}]
+
+    if event_type == "assistant":
+        events = []
+        for block in event.get("message", {}).get("content", []):
+            if block.get("type") == "text" and block.get("text"):
+                events.append({"event": "text", "text": block["text"]})
+            elif block.get("type") == "tool_use":
+                events.append({
+                    "event": "tool_use",
+                    "id": block.get("id"),
+                    "name": block.get("name"),
+                    "input": block.get("input"),
+                })
+        return events
+
+    if event_type == "user":
+        # ツール結果は本文が巨大になり得るので、完了通知のみ転送する
+        return [
+            {"event": "tool_result", "tool_use_id": block.get("tool_use_id"), "is_error": block.get("is_error", False)}
+            for block in event.get("message", {}).get("content", [])
+            if isinstance(block, dict) and block.get("type") == "tool_result"
+        ]
+
+    if event_type == "result":
+        # 最終結果は --output-format json と同じ形なので stdout_json としてそのまま返す
+        return [
+            {"event": "result", "stdout_json": cap_stdout_json(event)},
+            {"event": "usage", "usage": event.get("usage", {}), "total_cost_usd": event.get("total_cost_usd")},
+        ]
+
+    return []
+
+
+def ndjson(event: dict) -> bytes:
+    return (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+async def stream_run_events(cmd: List[str], req: RunRequest, resume_session_id: Optional[str], release):
+    """claude を stream-json で実行し、NDJSON イベントを逐次返す
+
+    クライアントが切断するとジェネレーターが閉じられ、ProcessStream が claude を終了させる。
+    """
+    prompt = compose_prompt(req, resumed=resume_session_id is not None)
+    model = None
+    ws = None
+    # ストリーミングは途中で実行し直せないので、プロバイダーは最初に1つ選ぶだけ
+    provider = pick_provider()
+    result_event: Optional[dict] = None
+    recorded = False
+    start = time.monotonic()
+    try:
+        async with run_directory(req) as (cwd, ws), run_env(resume_session_id) as env, ProcessStream(
+            cmd + [prompt],
+            cwd=cwd,
+            timeout_sec=req.timeout_sec,
+            kill_grace_sec=KILL_GRACE_SEC,
+            env=provider.env(env) if provider else env,
+            max_line_bytes=MAX_EVENT_BYTES,
+        ) as stream:
+            async for line in stream.lines():
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    json_parse_failures.inc(mode="stream")
+                    logger.debug(f"stream-json 以外の出力を無視: {line[:200]}")
+                    continue
+                if event.get("type") == "system" and event.get("subtype") == "init":
+                    model = event.get("model")
+                if event.get("type") == "result":
+                    result_event = event
+                    record_usage(event, req.caller_id, model, tier=model_router.tier_of(req.model))
+                    if req.conversation_key and event.get("session_id"):
+                        sessions.set(req.conversation_key, event["session_id"])
+                for out in translate_stream_event(event):
+                    yield ndjson(out)
+
+        run_seconds.observe(stream.duration_sec, lane=req.lane, mode="stream")
+        tier_run_seconds.observe(stream.duration_sec, tier=model_router.tier_of(req.model))
+        exit_codes.inc(code=stream.returncode)
+        if provider:
+            outcome = run_outcome(result_event)
+            record_provider(provider, outcome != "failure", stream.duration_sec, outcome)
+            recorded = True
+        logger.info(f"📊 ストリーミング実行結果: exit code {stream.returncode} ({stream.duration_sec:.1f}秒)")
+        if stream.returncode != 0:
+            logger.error(f"Command failed with exit code {stream.returncode}")
+            if resume_session_id:
+                # 再開できなかったセッションは次回から使わない
+                sessions.forget(req.conversation_key)
+            yield ndjson({"event": "error", "error": "claude が異常終了しました", "stderr": stream.stderr.strip()[-2000:]})
+        if ws:
+            yield ndjson({"event": "workspace", **ws.summary()})
+        yield ndjson({"event": "end", "exit_code": stream.returncode, "duration_sec": round(stream.duration_sec, 3)})
+
+    except HTTPException as e:
+        yield ndjson({"event": "error", "error": e.detail})
+    except FileNotFoundError as e:
+        logger.error(f"claude command not found: {e}")
+        yield ndjson({"event": "error", "error": "claude コマンドが見つかりません（PATHを確認）"})
+    except asyncio.TimeoutError:
+        logger.error(f"Command timeout after {req.timeout_sec} seconds")
+        run_timeouts.inc(lane=req.lane)
+        if provider:
+            record_provider(provider, False, time.monotonic() - start, "timeout")
+            recorded = True
+        yield ndjson({"event": "error", "error": "claude 実行がタイムアウトしました"})
+    except LineTooLongError as e:
+        # ProcessStream の __aexit__ でプロセスグループは終了済み
+        logger.error(f"Stream aborted: {e}")
+        yield ndjson({"event": "error", "error": f"claude の出力が大きすぎるため中断しました（{e}）"})
+    finally:
+        if provider and not recorded:
+            provider.breaker.abandon()
+        release()
+
+
+@app.post("/v1/claude/run/stream")
+async def run_stream(req: RunRequest, x_caller_id: Optional[str] = Header(None)):
+    """claude の実行経過を NDJSON（1行1イベント）で逐次返す
+
+    イベント: start / text / tool_use / tool_result / result / usage / workspace / error / end
+    """
+    apply_caller_header(req, x_caller_id)
+    apply_model_route(req)
+    resume_session_id = sessions.get(req.conversation_key) if req.conversation_key else None
+    system_prompt = await system_prompt_for(req)
+    cmd = build_command(
+        req, output_format="stream-json", resume_session_id=resume_session_id, system_prompt=system_prompt
+    ) + ["--verbose"]
+
+    # 実行枠はレスポンス開始前に確保し、満杯なら通常のエラーレスポンスを返す
+    try:
+        ticket = await admission.acquire(req.lane, req.caller_id)
+    except AdmissionError as e:
+        raise admission_http_error(e)
+
+    released = False
+
+    def release_once():
+        nonlocal released
+        if not released:
+            released = True
+            admission.release(ticket)
+
+    return StreamingResponse(
+        stream_run_events(cmd, req, resume_session_id, release_once),
+        media_type="application/x-ndjson",
+        # ストリームが一度も読まれずに終わった場合でも実行枠を返却する
+        background=BackgroundTask(release_once),
+    )
+
+
+# ========================================
+# バッチ実行 API
+# ========================================
+
+async def run_batch_item(index: int, req: RunRequest, limit: asyncio.Semaphore) -> dict:
+    """バッチの1件を実行し、結果イベントを返す（失敗してもイベントとして返す）"""
+    async with limit:
+        start = time.monotonic()
+        try:
+            result = await execute_run(req)
+            return {
+                "event": "result",
+                "index": index,
+                "duration_sec": round(time.monotonic() - start, 3),
+                "result": result.model_dump(),
+            }
+        except HTTPException as e:
+            return {
+                "event": "error",
+                "index": index,
+                "duration_sec": round(time.monotonic() - start, 3),
+                "status_code": e.status_code,
+                "detail": e.detail,
+            }
+        except Exception as e:
+            # 1件の想定外の失敗でストリーム全体（残りの結果と end イベント）を止めない
+            logger.error(f"Batch item {index} crashed: {e}", exc_info=True)
+            return {
+                "event": "error",
+                "index": index,
+                "duration_sec": round(time.monotonic() - start, 3),
+                "status_code": 500,
+                "detail": f"{type(e).__name__}: {e}",
+            }
+
+
+async def stream_batch_events(batch: BatchRequest):
+    """バッチの各件を並列に実行し、終わった順に NDJSON イベントを返す
+
+    クライアントが切断するとジェネレーターが閉じられ、残りの実行をキャンセルする。
+    """
+    start = time.monotonic()
+    limit = asyncio.Semaphore(batch.max_parallel or MAX_CONCURRENCY)
+    tasks = [
+        asyncio.create_task(run_batch_item(index, req, limit))
+        for index, req in enumerate(batch.requests)
+    ]
+    succeeded = 0
+    durations: List[float] = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            event = await next_done
+            durations.append(event["duration_sec"])
+            if event["event"] == "result":
+                succeeded += 1
+            yield ndjson(event)
+
+        elapsed = time.monotonic() - start
+        logger.info(f"📚 バッチ実行完了: {succeeded}/{len(tasks)} 件成功 ({elapsed:.1f}秒)")
+        yield ndjson({
+            "event": "end",
+            "total": len(tasks),
+            "succeeded": succeeded,
+            "failed": len(tasks) - succeeded,
+            "duration_sec": round(elapsed, 3),
+            "sum_duration_sec": round(sum(durations), 3),
+            "max_duration_sec": max(durations),
+        })
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/v1/claude/batch")
+async def run_batch(batch: BatchRequest, x_caller_id: Optional[str] = Header(None)):
+    """複数の RunRequest を並列に実行し、終わった順に NDJSON（1行1イベント）で返す
+
+    イベント: result / error（いずれも index 付き）/ end（全体の集計）
+    """
+    if len(batch.requests) > BATCH_MAX_ITEMS:
+        raise HTTPException(422, f"バッチの件数が多すぎます（上限: {BATCH_MAX_ITEMS} 件）")
+    # 実行枠・待ち行列がすでに満杯なら開始しない
+    if admission.is_full():
+        raise admission_http_error(QueueFullError("実行待ちのリクエストが多すぎます", admission.retry_after_sec))
+
+    for req in batch.requests:
+        apply_caller_header(req, x_caller_id)
+    logger.info(f"📚 バッチ実行: {len(batch.requests)} 件")
+    return StreamingResponse(stream_batch_events(batch), media_type="application/x-ndjson")
+
+
+# ========================================
+# 非同期ジョブ API
+# ========================================
+
+jobs: Dict[str, Job] = {}
+job_store: Optional[JobStore] = JobStore(JOB_DB) if JOB_DB else None
+# SQLite への書き込みはイベントループを止めないよう1本のスレッドで受け付け順に行う（状態の遷移順を保つ）
+job_writer: Optional[ThreadPoolExecutor] = (
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store") if job_store else None
+)
+
+
+def log_write_error(future: Future):
+    if future.exception() is not None:
+        logger.error(f"ジョブの保存に失敗しました: {future.exception()}")
+
+
+def write_job_store(fn: Callable, *args) -> Optional[Future]:
+    """job_store への書き込みを書き込み用スレッドに渡す（完了は待たない。保存先がなければ None）"""
+    if not job_writer:
+        return None
+    future = job_writer.submit(fn, *args)
+    future.add_done_callback(log_write_error)
+    return future
+
+
+def save_job(job: Job) -> Optional[Future]:
+    """ジョブの現在の状態を保存先に書き込む（その時点の内容を書き込み用スレッドに渡す）"""
+    if job_store:
+        return write_job_store(job_store.save, job.to_record())
+    return None
+
+
+async def close_job_store():
+    """書き込み待ちのジョブを書き終えてから閉じる（サーバーの終了時に呼ぶ）"""
+    if job_writer:
+        await asyncio.to_thread(job_writer.shutdown)
+        job_store.close()
+
+
+def recover_jobs():
+    """前回の起動で終わらなかったジョブを interrupted にする"""
+    interrupted = job_store.interrupt_unfinished(
+        {"status_code": 503, "detail": "cc-api の再起動によりジョブが中断されました"}, time.time()
+    )
+    for record in interrupted:
+        logger.warning(f"⚠️ 中断されたジョブ: {record['id']} ({record['status']}, caller: {record['caller']})")
+    if interrupted:
+        logger.info(f"💾 再起動前のジョブ {len(interrupted)} 件を interrupted にしました")
+
+
+async def cancel_jobs():
+    """終了していないジョブをキャンセルして、終了するまで待つ（サーバーの終了時に呼ぶ）"""
+    tasks = [job.task for job in jobs.values() if job.task and not job.task.done()]
+    if not tasks:
+        return
+    logger.info(f"🛑 終了していないジョブ {len(tasks)} 件をキャンセルします")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def purge_jobs():
+    """保持期間を過ぎた終了済みジョブを削除する"""
+    now = time.time()
+    expired = [
+        job_id for job_id, job in jobs.items()
+        if job.is_finished and job.finished_at and now - job.finished_at > JOB_TTL_SEC
+    ]
+    for job_id in expired:
+        del jobs[job_id]
+    if job_store:
+        write_job_store(job_store.purge, now - JOB_TTL_SEC)
+    if expired:
+        logger.info(f"🧹 期限切れのジョブを {len(expired)} 件削除しました")
+
+
+def post_webhook(url: str, payload: dict):
+    """ジョブ完了を Webhook で通知する（スレッドで実行）"""
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    request = urllib.request.Request(
+        url, data=body, headers={"Content-Type": "application/json"}, method="POST"
+    )
+    with urllib.request.urlopen(request, timeout=WEBHOOK_TIMEOUT_SEC) as response:
+        return response.status
+
+
+async def run_job(job: Job):
+    """ジョブを実行し、結果に応じて状態を遷移させる"""
+    def on_start():
+        job.transition(JobStatus.running)
+        save_job(job)
+
+    try:
+        job.result = await execute_run(job.request, on_start=on_start)
+        if job.status == JobStatus.queued:
+            # 実行中の同一リクエストに合流した場合は on_start が呼ばれない
+            job.transition(JobStatus.running)
+        job.transition(JobStatus.succeeded)
+    except HTTPException as e:
+        job.error = {"status_code": e.status_code, "detail": e.detail}
+        job.transition(JobStatus.failed)
+    except asyncio.CancelledError:
+        job.error = {"status_code": 499, "detail": "ジョブはキャンセルされました"}
+        job.transition(JobStatus.cancelled)
+    except Exception as e:
+        logger.error(f"Job {job.id} crashed: {e}", exc_info=True)
+        job.error = {"status_code": 500, "detail": f"{type(e).__name__}: {e}"}
+        job.transition(JobStatus.failed)
+
+    logger.info(f"📦 ジョブ {job.id} 終了: {job.status.value}")
+    save_job(job)
+
+    if job.request.webhook_url:
+        try:
+            status = await asyncio.to_thread(
+                post_webhook, job.request.webhook_url, job.to_response().model_dump(mode="json")
+            )
+            logger.info(f"🔔 Webhook 送信完了: {job.request.webhook_url} (status: {status})")
+        except Exception as e:
+            logger.warning(f"Webhook 送信に失敗: {job.request.webhook_url}: {e}")
+
+
+async def get_job_or_404(job_id: str) -> Job:
+    job = jobs.get(job_id)
+    if not job and job_store:
+        # 再起動前に終了したジョブ
+        record = await asyncio.to_thread(job_store.get, job_id)
+        if record and record["status"] not in ("queued", "running"):
+            job = Job.from_record(record)
+    if not job:
+        raise HTTPException(404, f"ジョブが見つかりません: {job_id}")
+    return job
+
+
+@app.post("/v1/jobs", response_model=JobResponse, status_code=202)
+async def submit_job(req: JobRequest, x_caller_id: Optional[str] = Header(None)):
+    """ジョブを登録して即座に job_id を返す"""
+    apply_caller_header(req, x_caller_id)
+    purge_jobs()
+
+    # 実行枠・待ち行列がすでに満杯なら登録せずに拒否する
+    if admission.is_full():
+        raise admission_http_error(QueueFullError("実行待ちのリクエストが多すぎます", admission.retry_after_sec))
+
+    job = Job(id=uuid.uuid4().hex, request=req)
+    jobs[job.id] = job
+    saved = save_job(job)
+    if saved:
+        # 一覧は保存先から読むので、登録の書き込みだけは終わるのを待つ
+        await asyncio.wrap_future(saved)
+    job.task = asyncio.create_task(run_job(job))
+    logger.info(f"📦 ジョブ登録: {job.id}")
+    return job.to_response()
+
+
+@app.get("/v1/jobs", response_model=List[JobResponse])
+async def list_jobs(
+    caller_id: Optional[str] = Query(None, description="呼び出し元ID（省略時は X-Caller-Id）"),
+    limit: int = Query(20, ge=1, le=JOB_LIST_LIMIT),
+    x_caller_id: Optional[str] = Header(None),
+):
+    """呼び出し元のジョブを新しい順に返す（result は含めない。GET /v1/jobs/{job_id} で取得する）"""
+    caller = caller_id or x_caller_id
+    if job_store:
+        found = [Job.from_record(r) for r in await asyncio.to_thread(job_store.list, caller, limit)]
+        # 実行中のジョブはメモリ上の状態を返す
+        found = [jobs.get(job.id, job) for job in found]
+    else:
+        found = [job for job in jobs.values() if caller is None or job.request.caller_id == caller]
+        found = sorted(found, key=lambda job: job.created_at, reverse=True)[:limit]
+    return [job.to_response().model_copy(update={"result": None}) for job in found]
+
+
+@app.get("/v1/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str, wait: float = Query(0, ge=0, le=JOB_MAX_WAIT_SEC, description="終了まで待つ最大秒数（ロングポーリング）")):
+    """ジョブの状態を返す（wait 指定時は終了するか wait 秒経過するまで待つ）"""
+    job = await get_job_or_404(job_id)
+    if wait and not job.is_finished:
+        try:
+            await asyncio.wait_for(asyncio.shield(job.done.wait()), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+    return job.to_response()
+
+
+@app.delete("/v1/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    """ジョブをキャンセルする（実行中なら claude のプロセスグループを kill する）"""
+    job = await get_job_or_404(job_id)
+    if not job.is_finished and job.task:
+        job.task.cancel()
+        await job.done.wait()
+    return job.to_response()
@@ -0,0 +1,66 @@
+"""
+会話キー → Claude セッションIDの対応表
+
+呼び出し側が指定した会話キー（Discord のスレッドIDなど）ごとに、
+直前の実行で claude が返した session_id を保持し、次のターンで --resume に使う。
+TTL と LRU で件数を制限し、無限に増えないようにする。
+"""
+
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore:
+    """会話キーごとのセッションIDを保持する（TTL + LRU）
+
+    Args:
+        max_entries: 保持する会話数の上限（超えたら最も古く使われたものから削除）
+        ttl_sec: 最後に使われてからこの秒数を過ぎたセッションは破棄する
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_sec: float = 86400):
+        self.max_entries = max(1, max_entries)
+        self.ttl_sec = ttl_sec
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        session_id, last_used = entry
+        if time.monotonic() - last_used > self.ttl_sec:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return session_id
+
+    def set(self, key: str, session_id: str):
+        self._entries[key] = (session_id, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            logger.debug(f"セッション対応表から削除 (LRU): {evicted}")
+
+    def forget(self, key: str):
+        self._entries.pop(key, None)
+
+    def lock(self, key: str) -> asyncio.Lock:
+        """同じ会話のターンを直列化するためのロック"""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "ttl_sec": self.ttl_sec}
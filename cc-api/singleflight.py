@@ -0,0 +1,67 @@
+"""
+実行中リクエストの合流（single-flight）
+
+同じ内容のリクエストが実行中の場合、新しく claude を起動せず実行中の結果を待つ。
+待っている呼び出し元がすべていなくなった場合のみ、実行中の処理をキャンセルする。
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, TypeVar
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+coalesced_requests = registry.counter(
+    "claude_coalesced_requests_total", "実行中の同一リクエストに合流した回数"
+)
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """キーごとに実行中の処理を1つだけにする"""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight, "coalesced": coalesced_requests.get()}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """key が実行中ならその結果を待ち、そうでなければ fn() を実行する"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            coalesced_requests.inc()
+            logger.info(f"🔗 実行中の同一リクエストに合流します (waiters: {flight.waiters + 1})")
+        else:
+            flight = _Flight(asyncio.create_task(fn()))
+            self._flights[key] = flight
+
+            def forget(_task, key=key, flight=flight):
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+            flight.task.add_done_callback(forget)
+
+        flight.waiters += 1
+        try:
+            # 1人の呼び出し元がキャンセルされても、他の待ち手がいる限り実行は続ける
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+アドミッションコントロール（admission.py）のテスト
+
+優先度レーン・呼び出し元ごとのラウンドロビン・上限・待ち行列の拒否を確認する。
+
+    python -m pytest tests/test_admission.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from admission import AdmissionController, QueueFullError, QueueTimeoutError  # noqa: E402
+
+
+async def enqueue(admission: AdmissionController, order: list, lane: str, caller: str):
+    """実行枠を確保した順に order へ記録し、すぐに返却する"""
+    async with admission.slot(lane, caller):
+        order.append((lane, caller))
+        await asyncio.sleep(0)
+
+
+def test_higher_priority_lane_runs_first():
+    async def main():
+        admission = AdmissionController(max_concurrency=1, max_queue=10)
+        blocker = await admission.acquire("interactive", "x")
+        order = []
+        tasks = [
+            asyncio.create_task(enqueue(admission, order, "background", "a")),
+            asyncio.create_task(enqueue(admission, order, "task", "a")),
+            asyncio.create_task(enqueue(admission, order, "interactive", "a")),
+        ]
+        await asyncio.sleep(0)
+        admission.release(blocker)
+        await asyncio.gather(*tasks)
+        assert [lane for lane, _ in order] == ["interactive", "task", "background"]
+
+    asyncio.run(main())
+
+
+def test_callers_are_served_round_robin():
+    async def main():
+        admission = AdmissionController(max_concurrency=1, max_queue=10)
+        blocker = await admission.acquire("task", "x")
+        order = []
+        tasks = [asyncio.create_task(enqueue(admission, order, "task", "busy")) for _ in range(3)]
+        tasks.append(asyncio.create_task(enqueue(admission, order, "task", "quiet")))
+        await asyncio.sleep(0)
+        admission.release(blocker)
+        await asyncio.gather(*tasks)
+        # 先に3件並べた呼び出し元がいても、後から来た呼び出し元は2番目に実行される
+        assert [caller for _, caller in order][:2] == ["busy", "quiet"]
+
+    asyncio.run(main())
+
+
+def test_lane_and_caller_limits():
+    async def main():
+        admission = AdmissionController(
+            max_concurrency=4, max_queue=10, lane_limits={"background": 1}, caller_limit=2
+        )
+        await admission.acquire("background", "a")
+        waiting = asyncio.create_task(admission.acquire("background", "b"))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        await admission.acquire("interactive", "c")
+        await admission.acquire("interactive", "c")
+        over_caller = asyncio.create_task(admission.acquire("interactive", "c"))
+        await asyncio.sleep(0)
+        assert not over_caller.done()
+        assert admission.stats()["running"] == 3
+
+        waiting.cancel()
+        over_caller.cancel()
+        await asyncio.gather(waiting, over_caller, return_exceptions=True)
+        assert admission.stats()["waiting"] == 0
+
+    asyncio.run(main())
+
+
+def test_full_queue_is_rejected():
+    async def main():
+        admission = AdmissionController(max_concurrency=1, max_queue=1, retry_after_sec=7)
+        await admission.acquire()
+        queued = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError) as error:
+            await admission.acquire()
+        assert error.value.status_code == 429
+        assert error.value.retry_after == 7
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_removes_ticket():
+    async def main():
+        admission = AdmissionController(max_concurrency=1, max_queue=5, queue_timeout_sec=0.05)
+        await admission.acquire()
+        with pytest.raises(QueueTimeoutError):
+            await admission.acquire()
+        assert admission.stats()["waiting"] == 0
+        assert admission.rejected == 1
+
+    asyncio.run(main())
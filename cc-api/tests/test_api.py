@@ -9,6 +9,7 @@ FastAPI サーバーが正常に動作しているか確認します。
 import requests
 import json
 import subprocess
+import time
 from datetime import datetime
 from pathlib import Path
 
@@ -258,6 +259,55 @@ def test_dice_roll(reporter: TestReporter):
     reporter.add_result("サイコロアプリテスト", status, details)
 
 
+def test_job_api(reporter: TestReporter):
+    """非同期ジョブ API（登録 → ロングポーリング → 結果取得）"""
+    print("=== 非同期ジョブ API テスト ===")
+    details = ""
+    status = "PASS"
+
+    try:
+        response = requests.post(
+            "http://127.0.0.1:8081/v1/jobs",
+            json={
+                "prompt": "1+1の答えだけを返して",
+                "cwd": "/workspace",
+                "allowed_tools": ["Read"],
+                "timeout_sec": 60,
+            },
+        )
+        print(f"Status: {response.status_code}")
+        assert response.status_code == 202, f"登録に失敗: {response.text}"
+
+        job_id = response.json()["job_id"]
+        print(f"Job ID: {job_id}")
+        details += f"- **Job ID**: `{job_id}`\n"
+
+        # 終了するまでロングポーリング
+        job = response.json()
+        deadline = time.time() + 90
+        while job["status"] in ("queued", "running") and time.time() < deadline:
+            job = requests.get(
+                f"http://127.0.0.1:8081/v1/jobs/{job_id}", params={"wait": 30}, timeout=40
+            ).json()
+            print(f"  status: {job['status']}")
+
+        details += f"- **Final Status**: {job['status']}\n"
+        if job["status"] == "succeeded":
+            result = job["result"]["stdout_json"].get("result", "N/A")
+            details += f"- **Result**: `{result[:200]}`\n"
+            print("✅ 非同期ジョブ API テスト成功\n")
+        else:
+            status = "FAIL"
+            details += f"- **Error**: {job.get('error')}\n"
+            print(f"❌ 非同期ジョブ API テスト失敗: {job}\n")
+    except Exception as e:
+        status = "FAIL"
+        details += f"- **エラー**: {e}\n"
+        print(f"❌ 非同期ジョブ API テスト失敗: {e}\n")
+
+    reporter.add_result("非同期ジョブ API テスト", status, details)
+
+
 def test_cinderella_user_config(reporter: TestReporter):
     """cinderella ユーザー設定を確認"""
     print("=== cinderella ユーザー設定テスト ===")
@@ -391,6 +441,7 @@ if __name__ == "__main__":
         test_simple_prompt(reporter)
         test_with_bash_tool(reporter)
         test_dice_roll(reporter)
+        test_job_api(reporter)
 
         failed = sum(1 for r in reporter.results if r["status"] == "FAIL")
         if failed == 0:
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+バッチ実行（server.py の stream_batch_events）のテスト
+
+claude は起動せず、execute_run を差し替えて完了順・失敗の扱い・並列数・切断時のキャンセルを確認する。
+
+    python -m pytest tests/test_batch.py
+"""
+
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from server import BatchRequest, RunRequest  # noqa: E402
+
+
+def fake_execute_run(running: list, peak: list, cancelled: list):
+    """プロンプトの数字をミリ秒として待つ execute_run（"fail" / "crash" は失敗させる）"""
+
+    async def execute_run(req, on_start=None):
+        running.append(req.prompt)
+        peak.append(len(running))
+        try:
+            if req.prompt == "fail":
+                raise HTTPException(504, "timeout")
+            if req.prompt == "crash":
+                raise RuntimeError("boom")
+            await asyncio.sleep(int(req.prompt) / 1000)
+            return server.RunResponse(exit_code=0, stdout_json={"result": req.prompt})
+        except asyncio.CancelledError:
+            cancelled.append(req.prompt)
+            raise
+        finally:
+            running.remove(req.prompt)
+
+    return execute_run
+
+
+def read_batch(monkeypatch, prompts, max_parallel=None, stop_after=0):
+    running, peak, cancelled = [], [], []
+    monkeypatch.setattr(server, "execute_run", fake_execute_run(running, peak, cancelled))
+    batch = BatchRequest(requests=[RunRequest(prompt=p) for p in prompts], max_parallel=max_parallel)
+
+    async def main():
+        events = []
+        stream = server.stream_batch_events(batch)
+        async for chunk in stream:
+            events.append(json.loads(chunk))
+            if stop_after and len(events) >= stop_after:
+                await stream.aclose()
+                break
+        # キャンセルされたタスクが後始末を終えるまで待つ
+        await asyncio.sleep(0.01)
+        return events
+
+    return asyncio.run(main()), max(peak), cancelled
+
+
+def test_results_stream_in_completion_order(monkeypatch):
+    events, _, _ = read_batch(monkeypatch, ["80", "10", "40"])
+    assert [e["index"] for e in events[:-1]] == [1, 2, 0]
+    assert [e["result"]["stdout_json"]["result"] for e in events[:-1]] == ["10", "40", "80"]
+    end = events[-1]
+    assert end["event"] == "end"
+    assert (end["total"], end["succeeded"], end["failed"]) == (3, 3, 0)
+
+
+def test_failures_become_error_events(monkeypatch):
+    events, _, _ = read_batch(monkeypatch, ["fail", "crash", "10"])
+    errors = {e["index"]: e for e in events if e["event"] == "error"}
+    assert errors[0]["status_code"] == 504 and errors[0]["detail"] == "timeout"
+    # 想定外の例外でも残りの結果と end は返す
+    assert errors[1]["status_code"] == 500 and "RuntimeError" in errors[1]["detail"]
+    assert events[-1]["succeeded"] == 1 and events[-1]["failed"] == 2
+
+
+def test_max_parallel_limits_concurrent_runs(monkeypatch):
+    _, peak, _ = read_batch(monkeypatch, ["20"] * 6, max_parallel=2)
+    assert peak == 2
+
+
+def test_disconnect_cancels_remaining_runs(monkeypatch):
+    events, _, cancelled = read_batch(monkeypatch, ["10", "500", "500"], stop_after=1)
+    assert [e["index"] for e in events] == [0]
+    assert sorted(cancelled) == ["500", "500"]
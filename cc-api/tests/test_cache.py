@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+結果キャッシュ（cache.py）のテスト
+
+サーバーを起動せずに ResultCache だけを動かす。
+
+    python -m pytest tests/test_cache.py
+"""
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import cache as cache_module  # noqa: E402
+from cache import ResultCache, cache_key  # noqa: E402
+
+
+def test_cache_key_ignores_argument_order():
+    assert cache_key(prompt="a", cwd="/w") == cache_key(cwd="/w", prompt="a")
+    assert cache_key(prompt="a", cwd="/w") != cache_key(prompt="b", cwd="/w")
+
+
+def test_hit_returns_stored_result():
+    cache = ResultCache(ttl_sec=60, max_entries=10, max_bytes=10_000)
+    cache.put("k", {"result": "ok"})
+    data, age = cache.get("k")
+    assert data == {"result": "ok"}
+    assert 0 <= age < 1
+    assert cache.get("missing") is None
+
+
+def test_expired_entry_is_dropped(monkeypatch):
+    cache = ResultCache(ttl_sec=10, max_entries=10, max_bytes=10_000)
+    now = time.time()
+    monkeypatch.setattr(cache_module.time, "time", lambda: now)
+    cache.put("k", {"result": "ok"})
+    monkeypatch.setattr(cache_module.time, "time", lambda: now + 11)
+    assert cache.get("k") is None
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["bytes"] == 0
+
+
+def test_lru_evicts_least_recently_used():
+    cache = ResultCache(ttl_sec=60, max_entries=2, max_bytes=10_000)
+    cache.put("a", {"v": 1})
+    cache.put("b", {"v": 2})
+    cache.get("a")
+    cache.put("c", {"v": 3})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_byte_limit_evicts_and_skips_oversized():
+    cache = ResultCache(ttl_sec=60, max_entries=100, max_bytes=30)
+    cache.put("a", {"v": "x" * 10})
+    cache.put("b", {"v": "y" * 10})
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    cache.put("huge", {"v": "z" * 100})
+    assert cache.get("huge") is None
+    assert cache.stats()["bytes"] <= 30
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    db = str(tmp_path / "cache.db")
+    ResultCache(ttl_sec=60, max_entries=10, max_bytes=10_000, db_path=db).put("k", {"result": "ok"})
+    data, _ = ResultCache(ttl_sec=60, max_entries=10, max_bytes=10_000, db_path=db).get("k")
+    assert data == {"result": "ok"}
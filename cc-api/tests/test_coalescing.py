@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+server.py の合流・結果キャッシュの対象判定のテスト
+
+claude は起動せず、execute_session を差し替えて execute_run の合流だけを確認する。
+
+    python -m pytest tests/test_coalescing.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from server import RunRequest  # noqa: E402
+
+
+def run_concurrently(monkeypatch, *requests: RunRequest) -> int:
+    """requests を同時に execute_run に渡し、実際に実行された回数を返す"""
+    calls = 0
+
+    async def fake_session(req, on_start=None):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return server.RunResponse(exit_code=0, stdout_json={"result": "ok"})
+
+    monkeypatch.setattr(server, "execute_session", fake_session)
+    monkeypatch.setattr(server, "COALESCE_ENABLED", True)
+
+    async def main():
+        await asyncio.gather(*(server.execute_run(req) for req in requests))
+
+    asyncio.run(main())
+    return calls
+
+
+def test_identical_read_only_requests_coalesce(monkeypatch):
+    assert run_concurrently(monkeypatch, RunRequest(prompt="同じ質問"), RunRequest(prompt="同じ質問")) == 1
+
+
+def test_isolated_request_does_not_join_shared_run(monkeypatch):
+    requests = RunRequest(prompt="同じ質問", cwd="/tmp", isolate=True), RunRequest(prompt="同じ質問", cwd="/tmp")
+    assert run_concurrently(monkeypatch, *requests) == 2
+
+
+def test_write_capable_requests_never_coalesce(monkeypatch):
+    tools = ["Read", "Edit", "Bash"]
+    requests = RunRequest(prompt="直して", allowed_tools=tools), RunRequest(prompt="直して", allowed_tools=tools)
+    assert run_concurrently(monkeypatch, *requests) == 2
+
+
+def test_hedge_setting_is_part_of_coalescing_key(monkeypatch):
+    requests = RunRequest(prompt="同じ質問", hedge=True), RunRequest(prompt="同じ質問", hedge=False)
+    assert run_concurrently(monkeypatch, *requests) == 2
+
+
+def test_cache_key_includes_isolation():
+    base = RunRequest(prompt="同じ質問", cwd="/tmp")
+    isolated = RunRequest(prompt="同じ質問", cwd="/tmp", isolate=True)
+    merged = RunRequest(prompt="同じ質問", cwd="/tmp", isolate=True, merge_back=True)
+    keys = {server.run_cache_key(r) for r in (base, isolated, merged)}
+    assert len(keys) == 3
+
+
+def test_side_effect_detection():
+    assert not server.has_side_effects(RunRequest(prompt="p"))
+    assert not server.has_side_effects(RunRequest(prompt="p", allowed_tools=["Read", "Grep"]))
+    assert server.has_side_effects(RunRequest(prompt="p", allowed_tools=["Read", "Edit"]))
+    assert server.has_side_effects(RunRequest(prompt="p", skip_permissions=True))
+    assert server.has_side_effects(RunRequest(prompt="p", cwd="/tmp", isolate=True))
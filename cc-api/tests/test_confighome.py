@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+実行ごとの設定ディレクトリ（confighome.py）のテスト
+
+CLI の状態ファイル .claude.json がどこから種まきされるかを確認する。
+
+    python -m pytest tests/test_confighome.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from confighome import ConfigHomeManager, default_state_file  # noqa: E402
+
+
+def make_home(tmp_path: Path) -> Path:
+    base = tmp_path / ".claude"
+    base.mkdir()
+    (base / "settings.json").write_text("{}")
+    return base
+
+
+def test_state_file_next_to_base_dir(tmp_path):
+    base = make_home(tmp_path)
+    assert default_state_file(str(base)) == str(tmp_path / ".claude.json")
+
+
+def test_state_file_inside_base_dir_wins(tmp_path):
+    base = make_home(tmp_path)
+    (base / ".claude.json").write_text("{}")
+    assert default_state_file(str(base)) == str(base / ".claude.json")
+
+
+def test_seed_copies_state_file(tmp_path):
+    base = make_home(tmp_path)
+    (tmp_path / ".claude.json").write_text('{"hasCompletedOnboarding": true}')
+    manager = ConfigHomeManager(str(base), str(tmp_path / "homes"), str(tmp_path / "templates"))
+
+    async def main():
+        home = await manager.create()
+        copied = Path(home.path) / ".claude.json"
+        assert copied.read_text() == '{"hasCompletedOnboarding": true}'
+        assert (Path(home.path) / "settings.json").exists()
+        await manager.release(home)
+
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+ワークスペースの索引（contextpack.py）のテスト
+
+一時ディレクトリに索引を作り、差分スキャン・最近の変更・要約の切り詰めを確認する。
+
+    python -m pytest tests/test_contextpack.py
+"""
+
+import os
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from contextpack import CHARS_PER_TOKEN, WorkspaceIndex  # noqa: E402
+
+
+def make_tree(root: Path):
+    (root / "pkg").mkdir()
+    (root / "node_modules").mkdir()
+    (root / "main.py").write_text("def run():\n    pass\n\nclass App:\n    pass\n")
+    (root / "pkg" / "util.ts").write_text("export function helper() {}\nexport interface Options {}\n")
+    (root / "node_modules" / "dep.js").write_text("function ignored() {}\n")
+
+
+def test_digest_lists_files_and_symbols(tmp_path):
+    make_tree(tmp_path)
+    index = WorkspaceIndex(str(tmp_path))
+    index.scan()
+    digest = index.digest(1500)
+    assert "main.py" in digest and "run, App" in digest
+    assert os.path.join("pkg", "util.ts") in digest and "helper, Options" in digest
+    assert "dep.js" not in digest
+    assert "最近の変更" not in digest
+
+
+def test_rescan_records_changes_and_bumps_version(tmp_path):
+    make_tree(tmp_path)
+    index = WorkspaceIndex(str(tmp_path))
+    index.scan()
+    version = index.version
+    index.scan()
+    assert index.version == version
+
+    (tmp_path / "new.py").write_text("def added():\n    pass\n")
+    (tmp_path / "main.py").unlink()
+    index.scan()
+    assert index.version == version + 1
+    assert {(rel, kind) for _, rel, kind in index.changes} == {("new.py", "added"), ("main.py", "deleted")}
+    assert "- added new.py" in index.digest(1500)
+
+
+def test_digest_respects_token_budget(tmp_path):
+    for i in range(200):
+        (tmp_path / f"module_{i:03}.py").write_text(f"def function_{i}():\n    pass\n")
+    index = WorkspaceIndex(str(tmp_path))
+    index.scan()
+    digest = index.digest(100)
+    assert len(digest) <= 100 * CHARS_PER_TOKEN + 40
+    assert "...ほか" in digest
+
+
+def test_render_while_scanning(tmp_path):
+    make_tree(tmp_path)
+    index = WorkspaceIndex(str(tmp_path), max_changes=1000)
+    index.scan()
+    stop = threading.Event()
+
+    def churn():
+        i = 0
+        while not stop.is_set():
+            (tmp_path / f"churn_{i % 50}.py").write_text(f"x = {i}\n")
+            index.scan()
+            i += 1
+
+    thread = threading.Thread(target=churn)
+    thread.start()
+    try:
+        for _ in range(200):
+            index._render(6000)
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+非同期ジョブ（server.py の run_job / cancel_jobs）のテスト
+
+claude は起動せず、execute_run を差し替えて状態の遷移とサーバー終了時のキャンセルを確認する。
+
+    python -m pytest tests/test_jobs.py
+"""
+
+import asyncio
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from server import Job, JobRequest, JobStatus  # noqa: E402
+
+
+def test_shutdown_cancels_unfinished_jobs(monkeypatch):
+    stopped = []
+
+    async def fake_execute_run(req, on_start=None):
+        on_start()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            # 本物の実行ではここで claude のプロセスグループを kill_tree する
+            stopped.append(req.prompt)
+            raise
+
+    monkeypatch.setattr(server, "execute_run", fake_execute_run)
+    monkeypatch.setattr(server, "jobs", {})
+    monkeypatch.setattr(server, "job_store", None)
+
+    async def main():
+        job = Job(id="j1", request=JobRequest(prompt="長い作業"))
+        server.jobs[job.id] = job
+        job.task = asyncio.create_task(server.run_job(job))
+        await asyncio.sleep(0.01)
+        assert job.status == JobStatus.running
+
+        await server.cancel_jobs()
+        assert job.task.done()
+        assert job.status == JobStatus.cancelled
+        assert stopped == ["長い作業"]
+
+    asyncio.run(main())
+
+
+def test_finished_job_is_left_alone(monkeypatch):
+    async def fake_execute_run(req, on_start=None):
+        on_start()
+        return server.RunResponse(exit_code=0, stdout_json={"result": "ok"})
+
+    monkeypatch.setattr(server, "execute_run", fake_execute_run)
+    monkeypatch.setattr(server, "jobs", {})
+    monkeypatch.setattr(server, "job_store", None)
+
+    async def main():
+        job = Job(id="j2", request=JobRequest(prompt="短い作業"))
+        server.jobs[job.id] = job
+        job.task = asyncio.create_task(server.run_job(job))
+        await job.task
+        await server.cancel_jobs()
+        assert job.status == JobStatus.succeeded
+
+    asyncio.run(main())
+
+
+class RecordingStore:
+    """書き込んだスレッドと状態を記録する JobStore の代わり"""
+
+    def __init__(self):
+        self.saved = []
+
+    def save(self, record):
+        self.saved.append((threading.current_thread().name, record["status"]))
+
+    def close(self):
+        self.saved.append(("closed", None))
+
+
+def test_job_state_is_written_off_loop_in_order(monkeypatch):
+    async def fake_execute_run(req, on_start=None):
+        on_start()
+        return server.RunResponse(exit_code=0, stdout_json={"result": "ok"})
+
+    store = RecordingStore()
+    monkeypatch.setattr(server, "execute_run", fake_execute_run)
+    monkeypatch.setattr(server, "jobs", {})
+    monkeypatch.setattr(server, "job_store", store)
+    monkeypatch.setattr(server, "job_writer", ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store"))
+
+    async def main():
+        job = Job(id="j3", request=JobRequest(prompt="保存する作業"))
+        server.jobs[job.id] = job
+        server.save_job(job)
+        job.task = asyncio.create_task(server.run_job(job))
+        await job.task
+        # 終了時に書き込み待ちを流してから閉じる
+        await server.close_job_store()
+
+    asyncio.run(main())
+    assert [status for _, status in store.saved] == ["queued", "running", "succeeded", None]
+    assert all(name.startswith("job-store") for name, _ in store.saved[:-1])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+非同期ジョブの永続化（jobstore.py）のテスト
+
+    python -m pytest tests/test_jobstore.py
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from jobstore import JobStore  # noqa: E402
+
+
+def job(job_id: str, status: str, caller="a", created_at=1.0, **fields) -> dict:
+    return {"id": job_id, "caller": caller, "status": status, "created_at": created_at, "request": {"prompt": "p"},
+            **fields}
+
+
+def test_result_survives_restart(tmp_path):
+    db = str(tmp_path / "jobs.db")
+    store = JobStore(db)
+    store.save(job("done", "succeeded", result={"exit_code": 0, "stdout_json": {"result": "ok"}}, finished_at=2.0))
+    store.close()
+
+    record = JobStore(db).get("done")
+    assert record["status"] == "succeeded"
+    assert record["result"]["stdout_json"] == {"result": "ok"}
+    assert record["request"] == {"prompt": "p"}
+
+
+def test_unfinished_jobs_are_interrupted_on_restart(tmp_path):
+    db = str(tmp_path / "jobs.db")
+    store = JobStore(db)
+    store.save(job("queued", "queued"))
+    store.save(job("running", "running", started_at=1.5))
+    store.save(job("done", "succeeded", finished_at=2.0))
+    store.close()
+
+    store = JobStore(db)
+    interrupted = store.interrupt_unfinished({"detail": "restarted"}, finished_at=10.0)
+    assert sorted(r["id"] for r in interrupted) == ["queued", "running"]
+    assert store.get("running")["status"] == "interrupted"
+    assert store.get("running")["error"] == {"detail": "restarted"}
+    assert store.get("done")["status"] == "succeeded"
+    assert store.interrupt_unfinished({"detail": "again"}, finished_at=11.0) == []
+
+
+def test_list_and_purge(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    store.save(job("old", "succeeded", created_at=1.0, finished_at=1.0))
+    store.save(job("new", "succeeded", created_at=5.0, finished_at=5.0))
+    store.save(job("other", "running", caller="b", created_at=3.0))
+    assert [r["id"] for r in store.list("a")] == ["new", "old"]
+    assert len(store.list(None)) == 3
+    assert store.purge(finished_before=2.0) == 1
+    assert store.get("old") is None
+    assert store.get("other") is not None
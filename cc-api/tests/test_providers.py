@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+プロバイダーの切り替え（providers.py）と server.py のフェイルオーバーのテスト
+
+claude は起動せず、run_process を差し替えてプロバイダーごとの結果を返す。
+
+    python -m pytest tests/test_providers.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import providers as providers_module  # noqa: E402
+import server  # noqa: E402
+from providers import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, is_provider_failure, load_providers  # noqa: E402
+from runner import ProcessResult  # noqa: E402
+from server import RunRequest  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(providers_module.time, "monotonic", clock)
+    return clock
+
+
+def test_provider_failure_classification():
+    assert is_provider_failure(None)
+    assert is_provider_failure({"is_error": True, "result": "API Error: 529 {\"type\":\"overloaded_error\"}"})
+    assert is_provider_failure({"is_error": True, "result": "API Error: 500 Internal server error"})
+    assert not is_provider_failure({"is_error": False, "result": "ok"})
+    assert not is_provider_failure({"is_error": True, "subtype": "error_max_turns"})
+    assert not is_provider_failure({"is_error": True, "result": "Permission to use Bash has been denied"})
+    assert not is_provider_failure({"is_error": True, "result": "API Error: 400 invalid request"})
+
+
+def test_breaker_opens_on_error_rate(clock):
+    breaker = CircuitBreaker("p", min_requests=4, error_rate=0.5, cooldown_sec=30)
+    for ok in (True, False, True):
+        breaker.record(ok, 1)
+    assert breaker.state == CLOSED
+    breaker.record(False, 1)
+    assert breaker.state == OPEN
+    assert not breaker.available()
+
+
+def test_breaker_half_open_allows_one_probe(clock):
+    breaker = CircuitBreaker("p", min_requests=1, cooldown_sec=30)
+    breaker.record(False, 1)
+    clock.now += 31
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record(True, 1)
+    assert breaker.state == CLOSED
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker("p", min_requests=1, cooldown_sec=30)
+    breaker.record(False, 1)
+    clock.now += 31
+    breaker.allow()
+    breaker.record(False, 1)
+    assert breaker.state == OPEN
+    clock.now += 10
+    assert not breaker.available()
+
+
+def test_abandoned_probe_can_be_retried(clock):
+    breaker = CircuitBreaker("p", min_requests=1, cooldown_sec=30)
+    breaker.record(False, 1)
+    clock.now += 31
+    breaker.allow()
+    breaker.abandon()
+    assert breaker.allow()
+
+
+def test_breaker_opens_on_slow_p95(clock):
+    breaker = CircuitBreaker("p", min_requests=3, p95_sec=10)
+    for latency in (1, 2, 30):
+        breaker.record(True, latency)
+    assert breaker.state == OPEN
+
+
+def make_providers():
+    return load_providers('[{"name": "first", "base_url": "https://first"}, {"name": "second"}]')
+
+
+def run_with_results(monkeypatch, req: RunRequest, results: dict, configured=None) -> tuple:
+    """プロバイダー名 → result イベントを返すように run_process を差し替えて実行する"""
+    configured = configured or make_providers()
+    calls = []
+
+    async def fake_run_process(cmd, env=None, **kwargs):
+        name = "first" if env.get("ANTHROPIC_BASE_URL") == "https://first" else "second"
+        calls.append(name)
+        result = results[name]
+        return ProcessResult(returncode=0 if result else 1, stdout="", stderr="", duration_sec=0.1, result=result)
+
+    monkeypatch.setattr(server, "providers", configured)
+    monkeypatch.setattr(server, "run_process", fake_run_process)
+    p = asyncio.run(server.run_with_providers(req, ["claude"], None, {}, hedge=False))
+    return p, calls, configured
+
+
+def test_overloaded_provider_fails_over(monkeypatch):
+    overloaded = {"is_error": True, "result": "API Error: 529 overloaded"}
+    p, calls, configured = run_with_results(
+        monkeypatch, RunRequest(prompt="p"), {"first": overloaded, "second": {"result": "ok"}}
+    )
+    assert calls == ["first", "second"]
+    assert p.result == {"result": "ok"}
+    assert configured[0].breaker.stats()["failures"] == 1
+
+
+def test_max_turns_is_returned_without_failover(monkeypatch):
+    max_turns = {"is_error": True, "subtype": "error_max_turns"}
+    p, calls, configured = run_with_results(
+        monkeypatch, RunRequest(prompt="p"), {"first": max_turns, "second": {"result": "ok"}}
+    )
+    assert calls == ["first"]
+    assert p.result == max_turns
+    assert configured[0].breaker.stats()["failures"] == 0
+
+
+def test_write_capable_run_does_not_fail_over(monkeypatch):
+    req = RunRequest(prompt="p", allowed_tools=["Read", "Edit"])
+    p, calls, _ = run_with_results(monkeypatch, req, {"first": None, "second": {"result": "ok"}})
+    assert calls == ["first"]
+    assert p.result is None
+
+
+def test_half_open_provider_gets_one_probe_on_failover(monkeypatch):
+    configured = make_providers()
+    breaker = configured[1].breaker
+    breaker.state, breaker.opened_at = OPEN, 0.0
+    calls = []
+
+    async def fake_run_process(cmd, env=None, **kwargs):
+        name = "first" if env.get("ANTHROPIC_BASE_URL") == "https://first" else "second"
+        calls.append(name)
+        await asyncio.sleep(0.01)
+        result = {"result": "ok"} if name == "second" else {"is_error": True, "result": "API Error: 529 overloaded"}
+        return ProcessResult(returncode=0, stdout="", stderr="", duration_sec=0.01, result=result)
+
+    monkeypatch.setattr(server, "providers", configured)
+    monkeypatch.setattr(server, "run_process", fake_run_process)
+
+    async def main():
+        req = RunRequest(prompt="p")
+        await asyncio.gather(*(server.run_with_providers(req, ["claude"], None, {}, hedge=False) for _ in range(3)))
+
+    asyncio.run(main())
+    # 3件とも first で失敗しても、待ち時間が過ぎた second には1件だけ試しに送る
+    assert calls.count("first") == 3
+    assert calls.count("second") == 1
+    assert breaker.state == CLOSED
+
+
+def test_all_providers_down_falls_back_to_first(monkeypatch, clock):
+    configured = make_providers()
+    for provider in configured:
+        provider.breaker.min_requests = 1
+        provider.breaker.record(False, 1)
+    _, calls, _ = run_with_results(
+        monkeypatch, RunRequest(prompt="p"), {"first": {"result": "ok"}, "second": {"result": "ok"}}, configured
+    )
+    assert calls == ["first"]
+    assert configured[1].breaker.state == OPEN
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+会話セッションの再開（server.py の execute_session）のテスト
+
+claude は起動せず、execute_once を差し替えて --resume の失敗時のやり直しを確認する。
+
+    python -m pytest tests/test_resume.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from server import RunRequest  # noqa: E402
+from sessions import SessionStore  # noqa: E402
+
+NOT_FOUND = HTTPException(500, {"exit_code": 1, "has_result": False, "stderr": "No conversation found with session ID: s1"})
+FAILED_LATE = HTTPException(500, {"exit_code": 1, "has_result": True, "stderr": "", "stdout": "{...}"})
+
+
+def run_session(monkeypatch, req: RunRequest, resume_error: HTTPException) -> list:
+    """保存済みのセッションの再開が resume_error で失敗するとして実行し、execute_once の呼び出しを返す"""
+    calls = []
+
+    async def fake_execute_once(req, resume_session_id=None, on_start=None):
+        calls.append(resume_session_id)
+        if resume_session_id:
+            raise resume_error
+        return server.RunResponse(exit_code=0, stdout_json={"result": "ok"}, session_id="s2")
+
+    store = SessionStore()
+    store.set("thread", "s1")
+    monkeypatch.setattr(server, "sessions", store)
+    monkeypatch.setattr(server, "execute_once", fake_execute_once)
+    try:
+        asyncio.run(server.execute_session(req))
+    finally:
+        calls.append(store.get("thread"))
+    return calls
+
+
+def test_missing_session_is_retried_in_new_session(monkeypatch):
+    calls = run_session(monkeypatch, RunRequest(prompt="p", conversation_key="thread"), NOT_FOUND)
+    assert calls == ["s1", None, "s2"]
+
+
+def test_late_failure_is_not_retried(monkeypatch):
+    with pytest.raises(HTTPException):
+        run_session(monkeypatch, RunRequest(prompt="p", conversation_key="thread"), FAILED_LATE)
+
+
+def test_write_capable_run_is_not_retried(monkeypatch):
+    req = RunRequest(prompt="p", conversation_key="thread", allowed_tools=["Read", "Bash"])
+    with pytest.raises(HTTPException):
+        run_session(monkeypatch, req, NOT_FOUND)
+    # やり直さず、次のターンのためにセッションは忘れる
+    assert server.sessions.get("thread") is None
+
+
+def test_resume_failure_classification():
+    assert server.resume_failed(NOT_FOUND)
+    assert server.resume_failed(HTTPException(500, {"error": "claude のstdoutがJSONとして解析できませんでした"}))
+    assert not server.resume_failed(FAILED_LATE)
+    assert not server.resume_failed(HTTPException(504, "claude 実行がタイムアウトしました"))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+モデルの振り分け（router.py）のテスト
+
+サーバーを起動せずに ModelRouter の判定と、server.py が判定に渡すプロンプトを確認する。
+
+    python -m pytest tests/test_router.py
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from router import DEFAULT_TIER_MODELS, ModelRouter, parse_mapping  # noqa: E402
+
+
+def decide(lane="interactive", prompt="短い質問", tools=("Read",), skip_permissions=False, **kwargs):
+    return ModelRouter(enabled=True, **kwargs).route(None, lane, prompt, list(tools), skip_permissions)
+
+
+def test_disabled_router_keeps_cli_default():
+    assert ModelRouter(enabled=False).route(None, "interactive", "p", ["Read"], False) is None
+
+
+def test_requested_model_wins():
+    assert ModelRouter(enabled=False).route("heavy", "background", "p", ["Read"], False) == "heavy"
+    assert ModelRouter().model_for("heavy") == "opus"
+    assert ModelRouter().model_for("claude-x") == "claude-x"
+
+
+def test_short_read_only_prompt_is_fast():
+    assert decide() == "fast"
+
+
+def test_long_prompt_is_heavy():
+    assert decide(prompt="x" * 20000) == "heavy"
+    assert decide(prompt="x" * 2000) == "standard"
+
+
+def test_edit_and_bash_keep_requests_off_fast():
+    for tool in ("Edit", "Bash", "Write"):
+        assert decide(tools=("Read", tool)) == "standard"
+        assert decide(lane="task", tools=("Read", tool)) == "heavy"
+        assert decide(lane="background", tools=("Read", tool)) == "standard"
+
+
+def test_skip_permissions_counts_as_writing():
+    assert decide(lane="task", skip_permissions=True) == "heavy"
+
+
+def test_task_lane_without_writes_uses_lane_default():
+    assert decide(lane="task") == "standard"
+
+
+def test_parse_mapping_ignores_unknown_tiers():
+    mapping = parse_mapping("fast=claude-fast, huge=x, heavy=", DEFAULT_TIER_MODELS)
+    assert mapping == {"fast": "claude-fast", "standard": "sonnet", "heavy": "opus"}
+
+
+def test_server_measures_prompt_with_context(monkeypatch):
+    monkeypatch.setattr(server.model_router, "enabled", True)
+    req = server.RunRequest(prompt="短い質問", context="x" * 30000)
+    server.apply_model_route(req)
+    assert req.model == "heavy"
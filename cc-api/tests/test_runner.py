@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+claude 実行エンジン（runner.py）のテスト
+
+claude の代わりに python の子プロセスを起動し、出力の退避・行の分割・プロセスグループの回収を確認する。
+
+    python -m pytest tests/test_runner.py
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from runner import LineTooLongError, OutputSpool, ProcessStream, group_members, pump, run_process  # noqa: E402
+
+# 孫プロセス（Bash から起動されたコマンドに相当）を起動して pid を出力し、そのまま待つ
+SPAWN_GRANDCHILD = (
+    "import subprocess, sys, time;"
+    "child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)']);"
+    "print(child.pid, flush=True);"
+    "time.sleep(60)"
+)
+
+
+def alive(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return False
+    return stat[stat.rfind(b")") + 2:].split()[0] != b"Z"
+
+
+def test_spool_spills_to_disk_and_keeps_head_and_tail():
+    spool = OutputSpool(memory_limit=10)
+    for chunk in (b"0123456789", b"abcdefghij", b"KLMNO"):
+        spool.write(chunk)
+    assert spool.spilled
+    assert spool.size == 25
+    assert spool.head(4) == "0123"
+    assert spool.tail(3) == "MNO"
+    spool.close()
+
+
+def test_pump_splits_lines_and_skips_oversized():
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'{"a": 1}\n' + b"x" * 100 + b"\n" + b'{"b"')
+        reader.feed_data(b": 2}")
+        reader.feed_eof()
+        spool = OutputSpool()
+        lines = []
+        await pump(reader, spool, lines.append, max_line_bytes=50)
+        assert lines == [b'{"a": 1}', b'{"b": 2}']
+        assert spool.size == 9 + 101 + 8
+        spool.close()
+
+    asyncio.run(main())
+
+
+def test_run_process_collects_result_event():
+    script = "import json; print(json.dumps({'type': 'system'})); print(json.dumps({'type': 'result', 'result': 'ok'}))"
+
+    async def main():
+        p = await run_process([sys.executable, "-c", script], cwd=None, timeout_sec=10)
+        assert p.returncode == 0
+        assert p.result == {"type": "result", "result": "ok"}
+
+    asyncio.run(main())
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="/proc がない環境ではプロセスグループを調べられない")
+def test_timeout_reaps_whole_process_group():
+    grandchildren = []
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await run_process(
+                [sys.executable, "-c", SPAWN_GRANDCHILD], cwd=None, timeout_sec=1, kill_grace_sec=1,
+                on_line=lambda line: grandchildren.append(int(line)),
+            )
+
+    asyncio.run(main())
+    assert len(grandchildren) == 1
+    assert not alive(grandchildren[0])
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="/proc がない環境ではプロセスグループを調べられない")
+def test_cancelled_stream_reaps_grandchildren():
+    async def main():
+        async with ProcessStream([sys.executable, "-c", SPAWN_GRANDCHILD], cwd=None, timeout_sec=10,
+                                 kill_grace_sec=1) as stream:
+            async for line in stream.lines():
+                grandchild = int(line)
+                pgid = stream.proc.pid
+                break
+        return grandchild, pgid
+
+    grandchild, pgid = asyncio.run(main())
+    assert not alive(grandchild)
+    assert group_members(pgid) == []
+
+
+def test_oversized_stream_line_raises_and_stops_process():
+    script = "import sys, time; sys.stdout.write('x' * 5000 + '\\n'); sys.stdout.flush(); time.sleep(60)"
+
+    async def main():
+        stream = ProcessStream([sys.executable, "-c", script], cwd=None, timeout_sec=10, kill_grace_sec=1,
+                               max_line_bytes=1024)
+        with pytest.raises(LineTooLongError):
+            async with stream:
+                async for _ in stream.lines():
+                    pass
+        assert stream.proc.returncode is not None
+
+    asyncio.run(main())
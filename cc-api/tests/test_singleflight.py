@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+single-flight（実行中の同一リクエストへの合流）のテスト
+
+サーバーを起動せずに singleflight.py だけを動かす。
+
+    python -m pytest tests/test_singleflight.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from singleflight import SingleFlight  # noqa: E402
+
+
+def test_concurrent_calls_share_one_run():
+    async def main():
+        flights = SingleFlight()
+        calls = 0
+
+        async def fn():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return "result"
+
+        results = await asyncio.gather(*(flights.do("key", fn) for _ in range(5)))
+        assert results == ["result"] * 5
+        assert calls == 1
+        assert flights.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_different_keys_run_separately():
+    async def main():
+        flights = SingleFlight()
+        calls = []
+
+        async def fn(name):
+            calls.append(name)
+            await asyncio.sleep(0.01)
+            return name
+
+        results = await asyncio.gather(flights.do("a", lambda: fn("a")), flights.do("b", lambda: fn("b")))
+        assert results == ["a", "b"]
+        assert sorted(calls) == ["a", "b"]
+
+    asyncio.run(main())
+
+
+def test_finished_key_runs_again():
+    async def main():
+        flights = SingleFlight()
+        calls = 0
+
+        async def fn():
+            nonlocal calls
+            calls += 1
+            return calls
+
+        assert await flights.do("key", fn) == 1
+        assert await flights.do("key", fn) == 2
+
+    asyncio.run(main())
+
+
+def test_one_waiter_cancelled_keeps_run_for_others():
+    async def main():
+        flights = SingleFlight()
+        started = asyncio.Event()
+        cancelled = False
+
+        async def fn():
+            nonlocal cancelled
+            started.set()
+            try:
+                await asyncio.sleep(0.1)
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            return "done"
+
+        first = asyncio.create_task(flights.do("key", fn))
+        await started.wait()
+        second = asyncio.create_task(flights.do("key", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == "done"
+        assert not cancelled
+        assert first.cancelled()
+
+    asyncio.run(main())
+
+
+def test_last_waiter_cancelled_cancels_run():
+    async def main():
+        flights = SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def fn():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flights.do("key", fn)) for _ in range(2)]
+        await started.wait()
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        assert flights.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_exception_reaches_every_waiter():
+    async def main():
+        flights = SingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("boom")
+
+        results = await asyncio.gather(*(flights.do("key", fn) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert flights.in_flight == 0
+
+    asyncio.run(main())
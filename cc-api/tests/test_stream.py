@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+ストリーミング実行（server.py の stream_run_events）のテスト
+
+claude の代わりに bench/fake_claude.py を stream-json で起動し、NDJSON イベントの並びと実行枠の返却を確認する。
+
+    python -m pytest tests/test_stream.py
+"""
+
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from server import RunRequest  # noqa: E402
+
+FAKE_CLAUDE = str(Path(__file__).resolve().parent.parent / "bench" / "fake_claude.py")
+CMD = [sys.executable, "-S", FAKE_CLAUDE, "-p", "--output-format", "stream-json", "--verbose"]
+
+
+def stream_events(monkeypatch, req: RunRequest, stop_after: int = 0):
+    """stream_run_events の NDJSON を読み、(イベント, release が呼ばれた回数) を返す
+
+    stop_after を指定すると、その件数を読んだところでクライアントの切断と同じくジェネレーターを閉じる。
+    """
+    monkeypatch.setattr(server, "pick_provider", lambda: None)
+    monkeypatch.setattr(server, "config_homes", None)
+    released = []
+
+    async def main():
+        events = []
+        stream = server.stream_run_events(CMD, req, None, lambda: released.append(True))
+        async for chunk in stream:
+            events.append(json.loads(chunk))
+            if stop_after and len(events) >= stop_after:
+                await stream.aclose()
+                break
+        return events
+
+    return asyncio.run(main()), len(released)
+
+
+def test_events_end_with_result_and_end(monkeypatch, tmp_path):
+    monkeypatch.setenv("FAKE_CLAUDE_LATENCY_MS", "30")
+    monkeypatch.setenv("FAKE_CLAUDE_EVENTS", "2")
+    events, released = stream_events(monkeypatch, RunRequest(prompt="読んで", cwd=str(tmp_path)))
+
+    names = [e["event"] for e in events]
+    assert names.count("text") == 2 and names.count("tool_use") == 2
+    assert "result" in names
+    assert names[-1] == "end"
+    assert events[-1]["exit_code"] == 0
+    assert "error" not in names
+    assert released == 1
+
+
+def test_failed_run_reports_error_before_end(monkeypatch, tmp_path):
+    monkeypatch.setenv("FAKE_CLAUDE_LATENCY_MS", "10")
+    monkeypatch.setenv("FAKE_CLAUDE_ERROR_RATE", "1")
+    monkeypatch.setenv("FAKE_CLAUDE_EXIT_CODE", "3")
+    events, released = stream_events(monkeypatch, RunRequest(prompt="読んで", cwd=str(tmp_path)))
+
+    assert [e["event"] for e in events][-2:] == ["error", "end"]
+    assert events[-1]["exit_code"] == 3
+    assert released == 1
+
+
+def test_client_disconnect_releases_slot(monkeypatch, tmp_path):
+    monkeypatch.setenv("FAKE_CLAUDE_LATENCY_MS", "2000")
+    monkeypatch.setenv("FAKE_CLAUDE_EVENTS", "4")
+    events, released = stream_events(monkeypatch, RunRequest(prompt="読んで", cwd=str(tmp_path)), stop_after=1)
+
+    assert len(events) == 1
+    assert "end" not in [e["event"] for e in events]
+    # 切断してもジェネレーターの finally で実行枠を返す（claude は ProcessStream が終了させる）
+    assert released == 1
+
+
+def test_oversized_line_ends_stream_with_error(monkeypatch, tmp_path):
+    monkeypatch.setenv("FAKE_CLAUDE_LATENCY_MS", "10")
+    monkeypatch.setenv("FAKE_CLAUDE_OUTPUT_BYTES", "5000")
+    monkeypatch.setattr(server, "MAX_EVENT_BYTES", 1024)
+    events, released = stream_events(monkeypatch, RunRequest(prompt="読んで", cwd=str(tmp_path)))
+
+    assert events[-1]["event"] == "error"
+    assert "大きすぎる" in events[-1]["error"]
+    assert released == 1
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+隔離ワークスペース（workspace.py）のテスト
+
+git worktree と reflink（使えない環境では作成失敗として扱う）で、作成・変更の集計・書き戻し・掃除を確認する。
+
+    python -m pytest tests/test_workspace.py
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from workspace import WorkspaceError, WorkspaceManager  # noqa: E402
+
+
+def git(repo: Path, *args: str):
+    subprocess.run(["git", "-C", str(repo), *args], check=True, capture_output=True)
+
+
+@pytest.fixture
+def repo(tmp_path) -> Path:
+    repo = tmp_path / "repo"
+    (repo / "app" / "src").mkdir(parents=True)
+    (repo / "README.md").write_text("root\n")
+    (repo / "app" / "main.py").write_text("print('old')\n")
+    (repo / "app" / "src" / "util.py").write_text("x = 1\n")
+    git(repo, "init", "-q")
+    git(repo, "add", ".")
+    git(repo, "-c", "user.name=t", "-c", "user.email=t@example.com", "commit", "-q", "-m", "init")
+    return repo
+
+
+def test_worktree_runs_in_subdirectory_and_merges_it_back(repo, tmp_path):
+    manager = WorkspaceManager(str(tmp_path / "ws"), modes=["worktree"])
+    source = repo / "app"
+
+    async def main():
+        async with manager.isolated(str(source), merge_back=True) as ws:
+            assert ws.path.endswith(os.path.join("merged", "app"))
+            workdir = Path(ws.path)
+            (workdir / "main.py").write_text("print('new')\n")
+            (workdir / "added.py").write_text("y = 2\n")
+            (workdir / "src" / "util.py").unlink()
+        return ws
+
+    ws = asyncio.run(main())
+    assert ws.changed == ["added.py", "main.py"]
+    assert ws.deleted == ["src/util.py"]
+    assert (source / "main.py").read_text() == "print('new')\n"
+    assert (source / "added.py").exists()
+    assert not (source / "src" / "util.py").exists()
+    # ルートからの相対パスでサブディレクトリの下に書き戻していない
+    assert not (source / "app").exists()
+    assert manager.active == 0
+
+
+def test_uncommitted_subdirectory_is_rejected(repo, tmp_path):
+    (repo / "untracked").mkdir()
+    manager = WorkspaceManager(str(tmp_path / "ws"), modes=["worktree"])
+    with pytest.raises(WorkspaceError):
+        asyncio.run(manager.create(str(repo / "untracked")))
+    assert manager.active == 0
+
+
+def test_gc_skips_live_workspaces(repo, tmp_path):
+    root = tmp_path / "ws"
+    manager = WorkspaceManager(str(root), modes=["worktree"], gc_ttl_sec=1)
+
+    async def main():
+        manager.start()
+        ws = await manager.create(str(repo))
+        leftover = root / "leftover"
+        leftover.mkdir()
+        old = time.time() - 10
+        for path in (ws.scratch, leftover):
+            os.utime(path, (old, old))
+
+        await manager.gc()
+        assert os.path.isdir(ws.path)
+        assert not leftover.exists()
+
+        await manager.release(ws)
+        await manager.close()
+
+    asyncio.run(main())
@@ -0,0 +1,353 @@
+"""
+ジョブごとの隔離ワークスペース
+
+同じ cwd（/workspace）を並列実行の claude が同時に編集しないよう、
+ジョブごとに書き込み可能なワークスペースを用意する。作成方法は次の順に試す。
+
+1. overlay  : overlayfs（root なら mount -t overlay、そうでなければ fuse-overlayfs）
+2. reflink  : cp --reflink=always（btrfs / XFS などコピーオンライトに対応したファイルシステムのみ）
+3. worktree : git worktree（元のディレクトリが git リポジトリの場合。コミット済みの内容のみ）
+              リポジトリ全体をチェックアウトし、元のディレクトリに当たるサブディレクトリで実行する
+
+終了後は変更（追加・更新・削除されたファイル）を集計し、指定があれば元のディレクトリに書き戻す。
+作業ディレクトリは実行ごとに削除し、異常終了で残ったものは定期的に掃除する。
+"""
+
+import asyncio
+import filecmp
+import logging
+import os
+import shutil
+import stat
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Set, Tuple
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+MODES = ("overlay", "reflink", "worktree")
+
+workspaces_created = registry.counter(
+    "claude_workspaces_total", "作成した隔離ワークスペース数（mode: overlay / reflink / worktree / failed）", ["mode"]
+)
+workspace_setup_seconds = registry.histogram(
+    "claude_workspace_setup_seconds", "隔離ワークスペースの作成にかかった時間", ["mode"]
+)
+
+
+class WorkspaceError(Exception):
+    """隔離ワークスペースを作成できなかった"""
+
+
+@dataclass
+class Workspace:
+    """1回の実行で使う隔離ワークスペース"""
+    source: str
+    scratch: str  # このワークスペース用の作業ディレクトリ（削除対象）
+    path: str  # claude の cwd として渡すディレクトリ
+    mode: str
+    upper: Optional[str] = None  # overlay の変更レイヤー
+    checkout: Optional[str] = None  # worktree のチェックアウト先（リポジトリのルート。path はその中のサブディレクトリ）
+    prefix: str = ""  # worktree でのリポジトリのルートから source までの相対パス（末尾は /）
+    changed: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    merged: bool = False
+
+    def summary(self) -> dict:
+        return {
+            "mode": self.mode,
+            "changed": self.changed,
+            "deleted": self.deleted,
+            "merged": self.merged,
+        }
+
+
+async def _run(*cmd: str, cwd: Optional[str] = None) -> Tuple[int, str]:
+    """コマンドを実行して (終了コード, 出力) を返す"""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            cwd=cwd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+    except FileNotFoundError as e:
+        return 127, str(e)
+    output, _ = await proc.communicate()
+    return proc.returncode, output.decode("utf-8", errors="replace")
+
+
+def _is_whiteout(st: os.stat_result) -> bool:
+    """overlayfs の削除マーカー（デバイス番号 0/0 のキャラクターデバイス）か"""
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+
+def _overlay_changes(upper: str) -> Tuple[List[str], List[str]]:
+    """overlay の変更レイヤーから (変更されたファイル, 削除されたパス) を集める"""
+    changed, deleted = [], []
+    for dirpath, dirnames, filenames in os.walk(upper):
+        for name in dirnames + filenames:
+            full = os.path.join(dirpath, name)
+            rel = os.path.relpath(full, upper)
+            st = os.lstat(full)
+            if _is_whiteout(st):
+                deleted.append(rel)
+            elif not stat.S_ISDIR(st.st_mode):
+                changed.append(rel)
+    return sorted(changed), sorted(deleted)
+
+
+def _tree_changes(source: str, copy: str) -> Tuple[List[str], List[str]]:
+    """コピーと元のディレクトリを比較して (変更されたファイル, 削除されたパス) を集める
+
+    cp -a は更新時刻を保持するので、サイズと更新時刻で比較すれば中身を読まずに済む。
+    """
+    changed, deleted = [], []
+
+    def walk(rel: str):
+        comparison = filecmp.dircmp(os.path.join(source, rel), os.path.join(copy, rel))
+        deleted.extend(os.path.join(rel, name) for name in comparison.left_only)
+        for name in comparison.right_only:
+            full = os.path.join(copy, rel, name)
+            if os.path.isdir(full) and not os.path.islink(full):
+                for dirpath, _, filenames in os.walk(full):
+                    changed.extend(os.path.relpath(os.path.join(dirpath, f), copy) for f in filenames)
+            else:
+                changed.append(os.path.join(rel, name))
+        _, mismatch, errors = filecmp.cmpfiles(
+            os.path.join(source, rel), os.path.join(copy, rel), comparison.common_files, shallow=True
+        )
+        changed.extend(os.path.join(rel, name) for name in mismatch + errors)
+        for name in comparison.common_dirs:
+            walk(os.path.join(rel, name))
+
+    walk("")
+    return sorted(os.path.normpath(p) for p in changed), sorted(os.path.normpath(p) for p in deleted)
+
+
+def _apply_changes(view: str, source: str, changed: Sequence[str], deleted: Sequence[str]):
+    """ワークスペースの変更を元のディレクトリに書き戻す（後から書いた方が優先）"""
+    for rel in deleted:
+        target = os.path.join(source, rel)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target, ignore_errors=True)
+        elif os.path.lexists(target):
+            os.remove(target)
+    for rel in changed:
+        src = os.path.join(view, rel)
+        target = os.path.join(source, rel)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.islink(src):
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(os.readlink(src), target)
+        else:
+            shutil.copy2(src, target)
+
+
+class WorkspaceManager:
+    """隔離ワークスペースの作成・書き戻し・掃除
+
+    Args:
+        root: 作業ディレクトリを作る場所
+        modes: 試す作成方法（この順に試す）
+        gc_ttl_sec: 異常終了などで残った作業ディレクトリを削除するまでの秒数
+    """
+
+    def __init__(self, root: str, modes: Sequence[str] = MODES, gc_ttl_sec: float = 3600):
+        self.root = root
+        self.modes = [mode for mode in modes if mode in MODES]
+        self.gc_ttl_sec = gc_ttl_sec
+        # 使用中の作業ディレクトリ（gc で消さない。作業ディレクトリ自体の更新時刻は中の編集では変わらない）
+        self.live: Set[str] = set()
+        self._gc_task: Optional[asyncio.Task] = None
+
+    @property
+    def active(self) -> int:
+        return len(self.live)
+
+    def stats(self) -> dict:
+        return {"root": self.root, "modes": self.modes, "active": self.active}
+
+    async def _overlay(self, ws: Workspace) -> bool:
+        ws.upper = os.path.join(ws.scratch, "upper")
+        work = os.path.join(ws.scratch, "work")
+        for path in (ws.upper, work, ws.path):
+            os.makedirs(path)
+        options = f"lowerdir={ws.source},upperdir={ws.upper},workdir={work}"
+        if os.geteuid() == 0:
+            code, output = await _run("mount", "-t", "overlay", "overlay", "-o", options, ws.path)
+        else:
+            code, output = await _run("fuse-overlayfs", "-o", options, ws.path)
+        if code != 0:
+            logger.debug(f"overlay を使えません: {output.strip()}")
+        return code == 0
+
+    async def _reflink(self, ws: Workspace) -> bool:
+        code, output = await _run("cp", "-a", "--reflink=always", ws.source, ws.path)
+        if code != 0:
+            logger.debug(f"reflink コピーを使えません: {output.strip()}")
+            await asyncio.to_thread(shutil.rmtree, ws.path, True)
+        return code == 0
+
+    async def _worktree(self, ws: Workspace) -> bool:
+        code, output = await _run("git", "-C", ws.source, "rev-parse", "--show-toplevel", "--show-prefix")
+        if code != 0:
+            logger.debug(f"git リポジトリではありません: {output.strip()}")
+            return False
+        toplevel, prefix = (output.split("\n") + [""])[:2]
+        ws.checkout, ws.prefix = ws.path, prefix.strip()
+        code, output = await _run("git", "-C", toplevel.strip(), "worktree", "add", "--detach", ws.checkout, "HEAD")
+        if code != 0:
+            logger.debug(f"git worktree を使えません: {output.strip()}")
+            return False
+        # cwd がリポジトリのサブディレクトリなら、チェックアウトの同じサブディレクトリで実行する
+        ws.path = os.path.normpath(os.path.join(ws.checkout, ws.prefix))
+        if not os.path.isdir(ws.path):
+            logger.debug(f"コミット済みの内容に {ws.prefix} がありません")
+            await _run("git", "-C", ws.source, "worktree", "remove", "--force", ws.checkout)
+            return False
+        return True
+
+    async def create(self, source: str) -> Workspace:
+        """source の書き込み可能なビューを作る（失敗時は WorkspaceError）"""
+        source = os.path.abspath(source)
+        if not os.path.isdir(source):
+            raise WorkspaceError(f"ディレクトリが見つかりません: {source}")
+
+        scratch = os.path.join(self.root, uuid.uuid4().hex)
+        os.makedirs(scratch)
+        self.live.add(scratch)
+        for mode in self.modes:
+            ws = Workspace(source=source, scratch=scratch, path=os.path.join(scratch, "merged"), mode=mode)
+            start = time.monotonic()
+            if await getattr(self, f"_{mode}")(ws):
+                workspace_setup_seconds.observe(time.monotonic() - start, mode=mode)
+                workspaces_created.inc(mode=mode)
+                logger.info(f"🗂️ 隔離ワークスペースを作成 ({mode}): {ws.path}")
+                return ws
+            await asyncio.to_thread(self._clear_scratch, scratch)
+
+        workspaces_created.inc(mode="failed")
+        await asyncio.to_thread(shutil.rmtree, scratch, True)
+        self.live.discard(scratch)
+        raise WorkspaceError(f"隔離ワークスペースを作成できません（試した方法: {', '.join(self.modes)}）")
+
+    @staticmethod
+    def _clear_scratch(scratch: str):
+        for name in os.listdir(scratch):
+            shutil.rmtree(os.path.join(scratch, name), ignore_errors=True)
+
+    async def collect_changes(self, ws: Workspace):
+        """ワークスペースで変更されたファイルを集計する"""
+        if ws.mode == "overlay":
+            ws.changed, ws.deleted = await asyncio.to_thread(_overlay_changes, ws.upper)
+        elif ws.mode == "reflink":
+            ws.changed, ws.deleted = await asyncio.to_thread(_tree_changes, ws.source, ws.path)
+        else:
+            # パスはリポジトリのルートからの相対パスなので、source の外は除き、source からの相対パスにする
+            code, output = await _run(
+                "git", "-C", ws.path, "status", "--porcelain", "-z", "--untracked-files=all", "--", "."
+            )
+            if code != 0:
+                raise WorkspaceError(f"git status に失敗しました: {output.strip()}")
+            entries = iter(output.split("\0"))
+            for entry in entries:
+                if not entry:
+                    continue
+                status, rel = entry[:2], entry[3:]
+                if "R" in status or "C" in status:
+                    # 名前の変更は「新しいパス」「元のパス」の2項目で表される
+                    ws.deleted.append(next(entries, ""))
+                (ws.deleted if "D" in status else ws.changed).append(rel)
+            n = len(ws.prefix)
+            ws.changed = sorted(p[n:] for p in ws.changed if p.startswith(ws.prefix))
+            ws.deleted = sorted(p[n:] for p in ws.deleted if p and p.startswith(ws.prefix))
+
+    async def merge_back(self, ws: Workspace):
+        """変更を元のディレクトリに書き戻す"""
+        if not (ws.changed or ws.deleted):
+            return
+        await asyncio.to_thread(_apply_changes, ws.path, ws.source, ws.changed, ws.deleted)
+        ws.merged = True
+        logger.info(f"📥 ワークスペースの変更を書き戻しました ({len(ws.changed)} 変更, {len(ws.deleted)} 削除): {ws.source}")
+
+    @staticmethod
+    async def _unmount(path: str):
+        if os.geteuid() == 0:
+            await _run("umount", path)
+            return
+        # fuse3 では fusermount3、fuse2 では fusermount
+        code, _ = await _run("fusermount3", "-u", path)
+        if code != 0:
+            await _run("fusermount", "-u", path)
+
+    async def release(self, ws: Workspace):
+        """ワークスペースを片付ける"""
+        if ws.mode == "overlay":
+            await self._unmount(ws.path)
+        elif ws.mode == "worktree":
+            await _run("git", "-C", ws.source, "worktree", "remove", "--force", ws.checkout)
+        await asyncio.to_thread(shutil.rmtree, ws.scratch, True)
+        self.live.discard(ws.scratch)
+
+    @asynccontextmanager
+    async def isolated(self, source: str, merge_back: bool = False):
+        """隔離ワークスペースを作り、終了時に変更を集計（と書き戻し）して片付ける
+
+        使用例:
+            async with workspaces.isolated("/workspace", merge_back=True) as ws:
+                ... cwd=ws.path で実行 ...
+            ws.summary()
+        """
+        ws = await self.create(source)
+        try:
+            yield ws
+            try:
+                await self.collect_changes(ws)
+                if merge_back:
+                    await self.merge_back(ws)
+            except OSError as e:
+                raise WorkspaceError(f"ワークスペースの変更を書き戻せませんでした: {e}")
+        finally:
+            await asyncio.shield(self.release(ws))
+
+    async def gc(self):
+        """gc_ttl_sec を過ぎて残っている作業ディレクトリを削除する（使用中のものは除く）"""
+        if not os.path.isdir(self.root):
+            return
+        now = time.time()
+        for name in os.listdir(self.root):
+            scratch = os.path.join(self.root, name)
+            if scratch in self.live:
+                continue
+            try:
+                if now - os.stat(scratch).st_mtime <= self.gc_ttl_sec:
+                    continue
+            except FileNotFoundError:
+                continue
+            merged = os.path.join(scratch, "merged")
+            if os.path.ismount(merged):
+                await self._unmount(merged)
+            await asyncio.to_thread(shutil.rmtree, scratch, True)
+            logger.info(f"🧹 残っていた作業ディレクトリを削除しました: {scratch}")
+
+    async def _gc_loop(self):
+        while True:
+            await self.gc()
+            await asyncio.sleep(min(600, self.gc_ttl_sec))
+
+    def start(self):
+        os.makedirs(self.root, exist_ok=True)
+        if self._gc_task is None:
+            self._gc_task = asyncio.create_task(self._gc_loop())
+
+    async def close(self):
+        if self._gc_task:
+            self._gc_task.cancel()
+            self._gc_task = None
@@ -0,0 +1,268 @@
+"""
+cc-api バックエンドの振り分け
+
+複数の cc-api（CINDERELLA_URLS にカンマ区切りで指定）に対して、
+処理中のリクエストが最も少ないバックエンドを選ぶ（least outstanding requests）。
+
+- /health を定期的に確認し、続けて失敗したバックエンドは振り分け対象から外す
+- 接続できなかったリクエストは、外したうえで別のバックエンドに送り直す（まだ処理されていないため）。
+  すべてのバックエンドに接続できなければ、間隔を空けて（指数バックオフ）もう一度試す
+- 会話キー（conversation_key）付きのリクエストは、セッションを持っている同じバックエンドに送る
+
+HTTP クライアントは起動時に作る1つの aiohttp.ClientSession を共有する（keep-alive の接続を再利用し、
+同時接続数はバックエンドごとに上限を設ける）。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Backend:
+    url: str
+    outstanding: int = 0
+    healthy: bool = True
+    failures: int = 0
+    requests: int = 0
+    last_error: Optional[str] = None
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "last_error": self.last_error,
+        }
+
+
+@dataclass
+class ApiResponse:
+    """cc-api のレスポンス（本文は読み終えた状態で返す）"""
+    status_code: int
+    body: bytes
+
+    @property
+    def text(self) -> str:
+        return self.body.decode("utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+
+class BackendPool:
+    """cc-api バックエンドの集合
+
+    Args:
+        urls: バックエンドの URL
+        probe_interval_sec: /health を確認する間隔
+        probe_timeout_sec: /health のタイムアウト
+        eject_after: 続けてこの回数失敗したら振り分け対象から外す
+        max_sticky: 覚えておく会話キーの数（古いものから忘れる）
+        max_connections: 全体の同時接続数の上限
+        max_connections_per_host: バックエンドごとの同時接続数の上限
+        connect_timeout_sec: 接続のタイムアウト
+        connect_retries: すべてのバックエンドに接続できなかったときに試し直す回数
+        retry_backoff_sec: 試し直すまでの最初の待ち時間（1回ごとに2倍）
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        probe_interval_sec: float = 10,
+        probe_timeout_sec: float = 3,
+        eject_after: int = 2,
+        max_sticky: int = 10000,
+        max_connections: int = 100,
+        max_connections_per_host: int = 32,
+        connect_timeout_sec: float = 5,
+        connect_retries: int = 2,
+        retry_backoff_sec: float = 0.5,
+    ):
+        if not urls:
+            raise ValueError("cc-api のバックエンドが指定されていません")
+        self.backends = [Backend(url.rstrip("/")) for url in urls]
+        self.probe_interval_sec = probe_interval_sec
+        self.probe_timeout_sec = probe_timeout_sec
+        self.eject_after = eject_after
+        self.max_sticky = max_sticky
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.connect_timeout_sec = connect_timeout_sec
+        self.connect_retries = connect_retries
+        self.retry_backoff_sec = retry_backoff_sec
+        self._sticky: "OrderedDict[str, Backend]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def from_env(cls) -> "BackendPool":
+        urls = os.getenv("CINDERELLA_URLS") or os.getenv("CINDERELLA_URL", "http://cc-api:8080")
+        return cls(
+            [u.strip() for u in urls.split(",") if u.strip()],
+            probe_interval_sec=float(os.getenv("CINDERELLA_PROBE_INTERVAL_SEC", "10")),
+            eject_after=int(os.getenv("CINDERELLA_EJECT_AFTER", "2")),
+            max_connections=int(os.getenv("CINDERELLA_MAX_CONNECTIONS", "100")),
+            max_connections_per_host=int(os.getenv("CINDERELLA_MAX_CONNECTIONS_PER_HOST", "32")),
+            connect_timeout_sec=float(os.getenv("CINDERELLA_CONNECT_TIMEOUT_SEC", "5")),
+            connect_retries=int(os.getenv("CINDERELLA_CONNECT_RETRIES", "2")),
+        )
+
+    @property
+    def urls(self) -> List[str]:
+        return [b.url for b in self.backends]
+
+    def stats(self) -> dict:
+        return {"backends": [b.stats() for b in self.backends], "sticky": len(self._sticky)}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """共有の HTTP セッション（最初に使うときに、実行中のイベントループ上で作る）"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=30,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout_sec),
+            )
+        return self._session
+
+    def pick(self, affinity_key: Optional[str] = None, exclude: Optional[List[Backend]] = None) -> Backend:
+        """送信先のバックエンドを選ぶ
+
+        affinity_key が前回と同じバックエンドに送れるならそれを、
+        そうでなければ正常なバックエンドのうち処理中が最も少ないものを選ぶ（同数ならランダム）。
+        正常なバックエンドが1つもなければ、外したものも含めて選ぶ。
+        """
+        exclude = exclude or []
+        if affinity_key and affinity_key in self._sticky:
+            backend = self._sticky[affinity_key]
+            if backend.healthy and backend not in exclude:
+                self._sticky.move_to_end(affinity_key)
+                return backend
+
+        candidates = [b for b in self.backends if b.healthy and b not in exclude]
+        if not candidates:
+            candidates = [b for b in self.backends if b not in exclude] or self.backends
+        fewest = min(b.outstanding for b in candidates)
+        backend = random.choice([b for b in candidates if b.outstanding == fewest])
+
+        if affinity_key:
+            self._sticky[affinity_key] = backend
+            self._sticky.move_to_end(affinity_key)
+            while len(self._sticky) > self.max_sticky:
+                self._sticky.popitem(last=False)
+        return backend
+
+    def _mark_failure(self, backend: Backend, error: str):
+        backend.failures += 1
+        backend.last_error = error
+        if backend.healthy and backend.failures >= self.eject_after:
+            backend.healthy = False
+            logger.warning(f"🚫 cc-api バックエンドを振り分けから除外: {backend.url} ({error})")
+
+    def _mark_success(self, backend: Backend):
+        backend.failures = 0
+        if not backend.healthy:
+            backend.healthy = True
+            logger.info(f"✅ cc-api バックエンドが復帰: {backend.url}")
+
+    async def post(
+        self, path: str, affinity_key: Optional[str] = None, timeout: Optional[float] = None, **kwargs
+    ) -> ApiResponse:
+        """バックエンドを選んで POST する（kwargs は aiohttp の session.post に渡す）
+
+        接続できなかった場合はそのバックエンドを除外して、残りのバックエンドに順に送り直す。
+        どこにも接続できなければ retry_backoff_sec から倍々に待って、connect_retries 回まで試し直す。
+
+        Args:
+            timeout: レスポンスを読み終えるまでの秒数（None なら無制限）
+
+        Raises:
+            aiohttp.ClientConnectionError: どのバックエンドにも接続できなかった / 途中で切断された
+            asyncio.TimeoutError: タイムアウトした（送り直さない）
+        """
+        request_timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=self.connect_timeout_sec)
+        attempt = 0
+        tried: List[Backend] = []
+        while True:
+            backend = self.pick(affinity_key, exclude=tried)
+            tried.append(backend)
+            backend.outstanding += 1
+            backend.requests += 1
+            try:
+                async with self.session.post(f"{backend.url}{path}", timeout=request_timeout, **kwargs) as response:
+                    body = await response.read()
+            except aiohttp.ClientConnectorError as e:
+                # 接続できなかったリクエストは処理されていないので、すぐに除外して別のバックエンドへ
+                backend.failures = max(backend.failures, self.eject_after - 1)
+                self._mark_failure(backend, f"{type(e).__name__}")
+                if len(tried) < len(self.backends):
+                    logger.info(f"🔀 {backend.url} に接続できないため別のバックエンドに送り直します")
+                    continue
+                if attempt >= self.connect_retries:
+                    raise
+                delay = self.retry_backoff_sec * (2 ** attempt)
+                attempt += 1
+                tried = []
+                logger.info(f"⏳ cc-api に接続できないため {delay:.1f} 秒後に送り直します ({attempt}/{self.connect_retries})")
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                backend.outstanding -= 1
+            self._mark_success(backend)
+            return ApiResponse(response.status, body)
+
+    async def probe(self, backend: Backend):
+        timeout = aiohttp.ClientTimeout(total=self.probe_timeout_sec)
+        try:
+            async with self.session.get(f"{backend.url}/health", timeout=timeout) as response:
+                if response.status == 200:
+                    self._mark_success(backend)
+                else:
+                    self._mark_failure(backend, f"HTTP {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._mark_failure(backend, type(e).__name__)
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.gather(*(self.probe(b) for b in self.backends))
+            await asyncio.sleep(self.probe_interval_sec)
+
+    def start(self):
+        """ヘルスチェックを開始する（イベントループ上で呼ぶ。2回目以降は何もしない）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._probe_loop())
+            logger.info(f"📡 cc-api バックエンド: {', '.join(self.urls)}")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def caller_headers(channel, user) -> dict:
+    """cc-api の呼び出し元ごとの公平制御に使うヘッダー（ギルド単位、DM はユーザー単位）"""
+    guild = getattr(channel, "guild", None)
+    caller_id = f"guild:{guild.id}" if guild else f"user:{user.id}"
+    return {"X-Caller-Id": caller_id}
+
+
+# bot.py と debate_handler.py で共有する
+cc_api = BackendPool.from_env()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+/v1/discord/action のレイテンシ・同時実行ベンチマーク
+
+bot.py の FastAPI アプリと Bot のイベントループを本番と同じ構成で動かし、readMessages を送る。
+Discord には接続せず、channel.history() が一定時間かかる偽のチャンネルを返す。
+
+構成:
+- blocking: 別スレッドの API から、以前のブリッジ（future.result() で API のイベントループを止める）
+- threads: 別スレッドの API から、asyncio.wrap_future で待つブリッジ（既定の構成）
+- single: API を Bot と同じイベントループで動かし、ハンドラーを直接 await する（BOT_SINGLE_LOOP）
+
+計測:
+- 逐次: Discord の待ち時間 0 で1件ずつ送り、1アクションあたりのレイテンシと CPU 時間を測る
+  （CPU 時間はクライアントを含むプロセス全体なので、構成どうしの比較にだけ使う）
+- 同時: latency かかる readMessages を N 件同時に送る。重なって処理されれば全体で latency 程度、
+  1件ずつ処理されると N × latency かかる
+- タイムアウト: タイムアウトしたときに Bot のループ側の処理もキャンセルされるか
+
+使い方:
+    python bench/action_concurrency.py --requests 20 --latency-ms 200 --sequential 200
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import requests
+import uvicorn
+
+BOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BOT_DIR))
+os.environ.setdefault("DISCORD_TOKEN", "bench")
+os.environ.setdefault("MEDIA_DIR", tempfile.mkdtemp(prefix="bot-bench-media-"))
+os.environ.pop("DISCORD_BOT_API_KEY", None)
+
+import bot as bot_module  # noqa: E402
+
+# bot.py は DEBUG で1リクエストごとにログを出すので、計測中は警告以上だけにする
+logging.getLogger().setLevel(logging.WARNING)
+
+LAYOUTS = ("blocking", "threads", "single")
+
+
+class FakeChannel:
+    """history() が latency_sec 秒かかるチャンネル（Discord の REST 呼び出しの代わり）"""
+
+    def __init__(self):
+        self.latency_sec = 0.0
+        self.cancelled = 0
+
+    async def history(self, limit: int = 20):
+        try:
+            await asyncio.sleep(self.latency_sec)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        author = SimpleNamespace(id=1, name="bench", display_name="bench", bot=False)
+        for i in range(limit):
+            yield SimpleNamespace(
+                id=i, content=f"message {i}", author=author, reactions=[],
+                created_at=datetime.now(timezone.utc),
+            )
+
+
+async def blocking_bridge(coro, timeout: float = bot_module.DEFAULT_TIMEOUT):
+    """以前の実装: Bot のループの結果を同期的に待つ（API のイベントループが止まる）"""
+    return asyncio.run_coroutine_threadsafe(coro, bot_module.bot.loop).result(timeout=timeout)
+
+
+class Layout:
+    """API サーバーと Bot のイベントループを指定の構成で起動する"""
+
+    def __init__(self, name: str, port: int):
+        self.name = name
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}/v1/discord/action"
+        self.loop = asyncio.new_event_loop()
+        self.server = bot_module.LoopApiServer(
+            uvicorn.Config(bot_module.api_app, host="127.0.0.1", port=port, log_level="warning")
+        )
+        self._serving = None
+
+    def start(self):
+        bot_module.bot.loop = self.loop
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        if self.name == "single":
+            self._serving = asyncio.run_coroutine_threadsafe(self.server.serve(), self.loop)
+        else:
+            self._serving = ThreadPoolExecutor(max_workers=1).submit(self.server.run)
+        deadline = time.monotonic() + 10
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("API サーバーが起動しませんでした")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self._serving.result(timeout=10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def post(url: str, payload: dict) -> tuple:
+    start = time.perf_counter()
+    body = requests.post(url, json=payload, timeout=120).json()
+    return time.perf_counter() - start, body
+
+
+def sequential(url: str, channel: FakeChannel, n: int) -> dict:
+    """待ち時間 0 で1件ずつ送り、1アクションあたりのオーバーヘッドを測る"""
+    channel.latency_sec = 0
+    payload = {"action": "readMessages", "channelId": "1", "limit": 5}
+    session = requests.Session()
+    for _ in range(10):
+        session.post(url, json=payload, timeout=30)
+    latencies = []
+    cpu_start = time.process_time()
+    for _ in range(n):
+        start = time.perf_counter()
+        session.post(url, json=payload, timeout=30).json()
+        latencies.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu_start
+    latencies.sort()
+    return {
+        "requests": n,
+        "latency_ms": {
+            "p50": round(latencies[len(latencies) // 2] * 1000, 2),
+            "p95": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+            "mean": round(statistics.fmean(latencies) * 1000, 2),
+        },
+        "cpu_ms_per_action": round(cpu / n * 1000, 2),
+    }
+
+
+def concurrent(url: str, channel: FakeChannel, n: int, latency_sec: float) -> dict:
+    """latency_sec かかる readMessages を n 件同時に送る"""
+    channel.latency_sec = latency_sec
+    payload = {"action": "readMessages", "channelId": "1", "limit": 5}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        results = list(pool.map(lambda _: post(url, payload), range(n)))
+    wall = time.perf_counter() - start
+    latencies = sorted(r[0] for r in results)
+    return {
+        "requests": n,
+        "ok": sum(1 for _, body in results if body.get("success")),
+        "wall_sec": round(wall, 3),
+        "max_ms": round(latencies[-1] * 1000, 1),
+        # 重なり具合: 1件ずつ処理した場合の時間 / 実際にかかった時間（理想は n 倍）
+        "overlap": round(n * latency_sec / wall, 2),
+    }
+
+
+def timeout_check(url: str, channel: FakeChannel, latency_sec: float) -> dict:
+    """タイムアウトしたときに Bot のループ側の処理もキャンセルされるか"""
+    channel.latency_sec = latency_sec
+    saved = dict(bot_module.ACTION_TIMEOUTS)
+    bot_module.ACTION_TIMEOUTS["readMessages"] = latency_sec / 2
+    cancelled_before = channel.cancelled
+    try:
+        _, body = post(url, {"action": "readMessages", "channelId": "1"})
+        time.sleep(0.1)
+    finally:
+        bot_module.ACTION_TIMEOUTS.clear()
+        bot_module.ACTION_TIMEOUTS.update(saved)
+    return {"error": body.get("error"), "cancelled_on_bot_loop": channel.cancelled > cancelled_before}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="/v1/discord/action のレイテンシ・同時実行ベンチマーク")
+    parser.add_argument("--requests", type=int, default=20, help="同時に送る readMessages の件数")
+    parser.add_argument("--latency-ms", type=float, default=200, help="同時実行で1件の Discord 呼び出しにかかる時間")
+    parser.add_argument("--sequential", type=int, default=200, help="逐次で送る件数（0 なら計測しない）")
+    parser.add_argument("--layouts", default=",".join(LAYOUTS), help=f"計測する構成（{', '.join(LAYOUTS)}）")
+    parser.add_argument("--port", type=int, default=18782)
+    parser.add_argument("--json", help="結果の JSON を書き出すパス（- なら標準出力）")
+    args = parser.parse_args(argv)
+
+    channel = FakeChannel()
+    # 毎回 history() を呼ぶように、履歴のキャッシュは使わない
+    bot_module.message_cache.size = 0
+    bot_module.bot.is_ready = lambda: True
+    bot_module.bot.get_channel = lambda channel_id: channel
+    bridge = bot_module.run_on_bot_loop
+    latency_sec = args.latency_ms / 1000
+
+    report = {"latency_ms": args.latency_ms, "layouts": {}}
+    for i, name in enumerate(n.strip() for n in args.layouts.split(",") if n.strip()):
+        if name not in LAYOUTS:
+            parser.error(f"不明な構成: {name}")
+        bot_module.run_on_bot_loop = blocking_bridge if name == "blocking" else bridge
+        layout = Layout(name, args.port + i)
+        layout.start()
+        try:
+            result = {}
+            if args.sequential:
+                result["sequential"] = sequential(layout.url, channel, args.sequential)
+            result["concurrent"] = concurrent(layout.url, channel, args.requests, latency_sec)
+            if name != "blocking":
+                result["timeout"] = timeout_check(layout.url, channel, latency_sec)
+        finally:
+            layout.stop()
+        report["layouts"][name] = result
+
+        c = result["concurrent"]
+        line = f"{'✅' if c['ok'] == args.requests else '⚠️'} {name:<8}"
+        if "sequential" in result:
+            s = result["sequential"]
+            line += (
+                f" 逐次 p50 {s['latency_ms']['p50']} ms / p95 {s['latency_ms']['p95']} ms"
+                f" / CPU {s['cpu_ms_per_action']} ms/件 |"
+            )
+        line += f" 同時 {args.requests} 件 {c['wall_sec']} 秒（重なり {c['overlap']} 倍）"
+        if "timeout" in result:
+            line += f" | タイムアウト時のキャンセル: {result['timeout']['cancelled_on_bot_loop']}"
+        print(line)
+    bot_module.run_on_bot_loop = bridge
+
+    if args.json == "-":
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    elif args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,17 +7,18 @@ Claude Code から Discord を操作するための API を提供します
 
 import os
 import asyncio
+import contextlib
 import logging
+import signal
 import threading
 import discord
 from discord.ext import commands
 from discord import app_commands
-import requests
 import uvicorn
 from fastapi import FastAPI, Header, HTTPException, Depends
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from typing import Optional
-import concurrent.futures
 from datetime import datetime
 from pathlib import Path
 import aiohttp
@@ -42,6 +43,11 @@ from handlers import (
     handle_timeout, handle_kick, handle_ban,
 )
 
+# cc-api バックエンドの振り分け（CINDERELLA_URLS / CINDERELLA_URL）
+from backends import cc_api, caller_headers
+from message_cache import message_cache
+from search_index import search_index
+
 # 議論機能ハンドラーをインポート
 from debate_handler import (
     DebateManager,
@@ -54,8 +60,9 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 if not DISCORD_TOKEN or not DISCORD_TOKEN.strip():
     raise ValueError("DISCORD_TOKEN is required and cannot be empty")
 
-CINDERELLA_URL = os.getenv("CINDERELLA_URL", "http://cc-api:8080")
 API_PORT = int(os.getenv("API_PORT", "8080"))
+# FastAPI サーバーを Discord Bot と同じイベントループで動かすか（既定は別スレッド）
+SINGLE_LOOP = os.getenv("BOT_SINGLE_LOOP", "").lower() in ("1", "true", "yes")
 
 # メディアディレクトリ設定
 MEDIA_DIR = Path(os.getenv("MEDIA_DIR", "/app/media"))
@@ -129,6 +136,10 @@ class DiscordActionRequest(BaseModel):
     # searchMessages用
     searchContent: Optional[str] = Field(None, description="検索する文字列")
     channelIds: Optional[list] = Field(None, description="検索対象チャンネルIDリスト")
+    after: Optional[str] = Field(None, description="この日時以降のメッセージ（ISO 8601）")
+    before: Optional[str] = Field(None, description="この日時より前のメッセージ（ISO 8601）")
+    sort: Optional[str] = Field(None, description="並び順 (relevance: 関連度順 / newest: 新しい順)")
+    offset: Optional[int] = Field(None, description="ページングの開始位置（前のレスポンスの next_offset）")
     # channelCreate/channelEdit/channelMove用
     type: Optional[str] = Field(None, description="チャンネルタイプ")
     parentId: Optional[str] = Field(None, description="親カテゴリID")
@@ -160,6 +171,12 @@ async def on_ready():
     BOT_USER_ID = bot.user.id
     logger.info(f"{bot.user} が起動しました！✨")
     logger.info(f"Connected to {len(bot.guilds)} guilds")
+    cc_api.start()
+    # 再接続までの間のイベントを取りこぼしている可能性があるので、履歴のキャッシュを捨てる
+    message_cache.invalidate()
+    if search_index:
+        # 止まっていた間のメッセージの読み足しと、過去のメッセージのバックフィル
+        search_index.start(bot)
 
     # スラッシュコマンドを同期
     try:
@@ -171,6 +188,11 @@ async def on_ready():
 
 @bot.event
 async def on_message(message):
+    # Bot自身のメッセージも含めて、履歴のキャッシュと検索インデックスに追加
+    message_cache.on_message(message)
+    if search_index:
+        search_index.on_message(message)
+
     # Bot自身のメッセージは無視
     if message.author == bot.user:
         return
@@ -282,6 +304,49 @@ async def on_message(message):
     await bot.process_commands(message)
 
 
+# 履歴のキャッシュと検索インデックスを Gateway のイベントで最新に保つ
+# （raw イベントは discord.py 自身のメッセージキャッシュにないメッセージでも届く）
+@bot.event
+async def on_raw_message_edit(payload):
+    message_cache.on_raw_message_edit(payload)
+    if search_index:
+        search_index.on_raw_message_edit(payload)
+
+
+@bot.event
+async def on_raw_message_delete(payload):
+    message_cache.on_raw_message_delete(payload)
+    if search_index:
+        search_index.on_raw_message_delete(payload)
+
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    message_cache.on_raw_bulk_message_delete(payload)
+    if search_index:
+        search_index.on_raw_bulk_message_delete(payload)
+
+
+@bot.event
+async def on_raw_reaction_add(payload):
+    message_cache.on_raw_reaction(payload)
+
+
+@bot.event
+async def on_raw_reaction_remove(payload):
+    message_cache.on_raw_reaction(payload)
+
+
+@bot.event
+async def on_raw_reaction_clear(payload):
+    message_cache.on_raw_reaction(payload)
+
+
+@bot.event
+async def on_raw_reaction_clear_emoji(payload):
+    message_cache.on_raw_reaction(payload)
+
+
 @bot.command()
 async def ask(ctx, *, prompt: str = None):
     """Claudeに質問するコマンド"""
@@ -352,6 +417,11 @@ async def task(ctx, *, prompt: str = None):
     task.add_done_callback(lambda t: t.exception() and logger.error(f"Task error: {t.exception()}"))
 
 
+def thread_conversation_key(thread_id) -> str:
+    """スレッドIDから cc-api の会話キーを作る（--resume によるセッション継続用）"""
+    return f"discord-thread:{thread_id}"
+
+
 async def process_ask(ctx, prompt: str):
     """Cinderella APIを呼び出して結果を返す
 
@@ -391,7 +461,7 @@ async def process_ask(ctx, prompt: str):
             # 直近のチャット履歴を取得（添付ファイルの通知を含むため）
             chat_history = ""
             try:
-                async for msg in ctx.channel.history(limit=10):
+                for msg in await message_cache.history(ctx.channel, 10):
                     # 履歴をフォーマット（Botのメッセージも含める）
                     chat_history += f"[{msg.created_at.strftime('%H:%M')}] {msg.author.display_name}: {msg.content[:200]}\n"
                 chat_history = chat_history.strip()
@@ -414,25 +484,31 @@ async def process_ask(ctx, prompt: str):
 - Guild ID: {guild_id}
 - User ID: {user.id}
 - Message ID: {message_id}
-
-【直近のチャット履歴】
+"""
+            # チャット履歴は新しいセッションを開始するときだけ cc-api 側で付加される
+            history_context = f"""【直近のチャット履歴】
 {chat_history if chat_history else '(なし)'}
-
 """
-            
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: requests.post(
-                    f"{CINDERELLA_URL}/v1/claude/run",
-                    json={
-                        "prompt": enhanced_prompt,
-                        "cwd": "/workspace",
-                        "allowed_tools": ["Read", "Bash", "Edit", "discord"],
-                        "timeout_sec": 300,
-                    },
-                    timeout=310,
-                ),
+
+            payload = {
+                "prompt": enhanced_prompt,
+                "context": history_context,
+                "cwd": "/workspace",
+                "allowed_tools": ["Read", "Bash", "Edit", "discord"],
+                "timeout_sec": 300,
+                "lane": "interactive",
+            }
+            # スレッド内の質問は同じ Claude セッションで会話を続ける
+            if isinstance(channel, discord.Thread):
+                payload["conversation_key"] = thread_conversation_key(channel.id)
+
+            # 会話キーがあればセッションを持っている cc-api に、なければ空いている cc-api に送る
+            response = await cc_api.post(
+                "/v1/claude/run",
+                affinity_key=payload.get("conversation_key"),
+                json=payload,
+                headers=caller_headers(channel, user),
+                timeout=310,
             )
 
         logger.info(f"📥 [4/5] cc-apiからレスポンス受信 (status: {response.status_code})")
@@ -476,11 +552,11 @@ async def process_ask(ctx, prompt: str):
             await ctx.send(f"❌ エラー ({response.status_code}): {error_detail or 'APIで問題が発生したみたい'}")
             await update_reaction(ctx.message, "❌")
 
-    except requests.exceptions.ConnectionError as e:
+    except aiohttp.ClientConnectionError as e:
         logger.error(f"Connection error: {e}")
         await ctx.send("❌ cc-apiに接続できなかったみたい……Dockerコンテナが動いているか確認してね！")
         await update_reaction(ctx.message, "❌")
-    except requests.exceptions.Timeout as e:
+    except asyncio.TimeoutError as e:
         logger.error(f"Timeout error: {e}")
         await ctx.send("⏱️ タイムアウトしちゃった……時間のかかる処理は今のところ無理そう")
         await update_reaction(ctx.message, "❌")
@@ -566,11 +642,11 @@ async def process_task(ctx, prompt: str):
             chat_history = ""
             try:
                 # スレッド内の履歴を取得（現在のスレッドのみ）
-                async for msg in thread.history(limit=10):
+                for msg in await message_cache.history(thread, 10):
                     chat_history += f"[{msg.created_at.strftime('%H:%M')}] {msg.author.display_name}: {msg.content[:200]}\n"
 
                 # チャンネルの履歴を取得（スレッド外のメッセージのみ、他のスレッドは除外）
-                async for msg in channel.history(limit=5):
+                for msg in await message_cache.history(channel, 5):
                     # スレッドに属するメッセージを除外
                     if not msg.thread:
                         chat_history += f"[{msg.created_at.strftime('%H:%M')}] {msg.author.display_name}: {msg.content[:200]}\n"
@@ -599,26 +675,30 @@ async def process_task(ctx, prompt: str):
 - Message ID: {message_id}
 - Thread ID: {thread.id}
 
-【直近のチャット履歴】
-{chat_history if chat_history else '(なし)'}
-
 【重要】
 回答は必ずスレッド(Thread ID: {thread.id})内で行ってください。
+"""
+            # チャット履歴は新しいセッションを開始するときだけ cc-api 側で付加される
+            history_context = f"""【直近のチャット履歴】
+{chat_history if chat_history else '(なし)'}
 """
 
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: requests.post(
-                    f"{CINDERELLA_URL}/v1/claude/run",
-                    json={
-                        "prompt": enhanced_prompt,
-                        "cwd": "/workspace",
-                        "allowed_tools": ["Read", "Bash", "Edit", "discord"],
-                        "timeout_sec": 300,
-                    },
-                    timeout=310,
-                ),
+            conversation_key = thread_conversation_key(thread.id)
+            response = await cc_api.post(
+                "/v1/claude/run",
+                affinity_key=conversation_key,
+                json={
+                    "prompt": enhanced_prompt,
+                    "context": history_context,
+                    # スレッド内の後続の質問は同じ Claude セッションを再開する
+                    "conversation_key": conversation_key,
+                    "cwd": "/workspace",
+                    "allowed_tools": ["Read", "Bash", "Edit", "discord"],
+                    "timeout_sec": 300,
+                    "lane": "task",
+                },
+                headers=caller_headers(channel, user),
+                timeout=310,
             )
 
         logger.info(f"📥 [4/6] cc-apiからレスポンス受信 (status: {response.status_code})")
@@ -666,13 +746,13 @@ async def process_task(ctx, prompt: str):
             if original_message:
                 await update_reaction(original_message, "❌")
 
-    except requests.exceptions.ConnectionError as e:
+    except aiohttp.ClientConnectionError as e:
         logger.error(f"Connection error: {e}")
         if thread:
             await thread.send("❌ cc-apiに接続できなかったみたい……Dockerコンテナが動いているか確認してね！")
         if original_message:
             await update_reaction(original_message, "❌")
-    except requests.exceptions.Timeout as e:
+    except asyncio.TimeoutError as e:
         logger.error(f"Timeout error: {e}")
         if thread:
             await thread.send("⏱️ タイムアウトしちゃった……時間のかかる処理は今のところ無理そう")
@@ -788,7 +868,7 @@ async def info(ctx):
 **Cinderella Discord Bot** ✨
 
 🤖 Bot名: {bot.user.display_name}
-📡 API: {CINDERELLA_URL}
+📡 API: {', '.join(cc_api.urls)}
 🔧 許可ツール: Read, Bash, Edit
 ⏱️ タイムアウト: 300秒
 """
@@ -854,7 +934,7 @@ async def info_slash(interaction: discord.Interaction):
 **Cinderella Discord Bot** ✨
 
 🤖 Bot名: {bot.user.display_name}
-📡 API: {CINDERELLA_URL}
+📡 API: {', '.join(cc_api.urls)}
 🔧 許可ツール: Read, Bash, Edit
 ⏱️ タイムアウト: 300秒
 """
@@ -916,21 +996,92 @@ async def verify_api_key(x_api_key: str = Header(None)):
     return x_api_key
 
 
-def run_async(coro, timeout: int = DEFAULT_TIMEOUT):
-    """Botのイベントループで非同期処理を実行
+async def run_on_bot_loop(coro, timeout: float = DEFAULT_TIMEOUT):
+    """Botのイベントループでコルーチンを実行し、結果を待つ
+
+    API サーバーのイベントループはブロックせずに await するので、複数のアクションを同時に処理できる。
+    API サーバーが Bot と同じイベントループで動いている場合（BOT_SINGLE_LOOP）は直接 await する。
+    タイムアウトしたときや、クライアントの切断でリクエストがキャンセルされたときは、
+    Bot のイベントループ側の処理もキャンセルする。
 
     Args:
         coro: 非同期コルーチン
         timeout: タイムアウト秒数（デフォルト30秒）
+
+    Raises:
+        asyncio.TimeoutError: timeout 秒以内に終わらなかった
     """
+    if asyncio.get_running_loop() is bot.loop:
+        # 単一ループ構成ではそのまま await する（タイムアウト時は wait_for がキャンセルする）
+        return await asyncio.wait_for(coro, timeout)
     future = asyncio.run_coroutine_threadsafe(coro, bot.loop)
-    return future.result(timeout=timeout)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        future.cancel()
+        raise
+
+
+# アクション名 → ハンドラー（handler(req, bot) を Bot のイベントループで実行する）
+ACTION_HANDLERS = {
+    # Message handlers
+    "react": handle_react,
+    "reactions": handle_reactions,
+    "sendMessage": handle_send_message,
+    "sendFile": handle_send_file,
+    "editMessage": handle_edit_message,
+    "deleteMessage": handle_delete_message,
+    "readMessages": handle_read_messages,
+    "fetchMessage": handle_fetch_message,
+    "pinMessage": handle_pin_message,
+    "listPins": handle_list_pins,
+    "threadCreate": handle_thread_create,
+    "threadList": handle_thread_list,
+    "threadReply": handle_thread_reply,
+    "sticker": handle_sticker,
+    "poll": handle_poll,
+    "searchMessages": handle_search_messages,
+    # Channel handlers
+    "channelInfo": handle_channel_info,
+    "channelList": handle_channel_list,
+    "permissions": handle_permissions,
+    "channelCreate": handle_channel_create,
+    "categoryCreate": handle_category_create,
+    "channelEdit": handle_channel_edit,
+    "channelMove": handle_channel_move,
+    "channelDelete": handle_channel_delete,
+    "categoryEdit": handle_category_edit,
+    "categoryDelete": handle_category_delete,
+    # Guild handlers
+    "memberInfo": handle_member_info,
+    "roleInfo": handle_role_info,
+    "emojiList": handle_emoji_list,
+    "emojiUpload": handle_emoji_upload,
+    "stickerUpload": handle_sticker_upload,
+    "voiceStatus": handle_voice_status,
+    "eventList": handle_event_list,
+    "roleAdd": handle_role_add,
+    "roleRemove": handle_role_remove,
+    "timeout": handle_timeout,
+    "kick": handle_kick,
+    "ban": handle_ban,
+}
 
 
 @api_app.get("/health")
 async def api_health():
-    """ヘルスチェック"""
-    return {"ok": True, "bot_ready": bot.is_ready()}
+    """ヘルスチェック（on_ready までは 503 を返し、ロードバランサーや監視から準備中と分かるようにする）"""
+    ready = bot.is_ready()
+    body = {
+        "ok": ready,
+        "bot_ready": ready,
+        "single_loop": SINGLE_LOOP,
+        "cc_api": cc_api.stats(),
+        "message_cache": message_cache.stats(),
+        # stats() は SQLite を読むのでイベントループを止めないようスレッドで実行する
+        "search_index": await asyncio.to_thread(search_index.stats) if search_index else None,
+    }
+    return JSONResponse(body, status_code=200 if ready else 503)
 
 
 @api_app.post(
@@ -953,94 +1104,18 @@ async def discord_action(req: DiscordActionRequest):
     timeout = ACTION_TIMEOUTS.get(action, DEFAULT_TIMEOUT)
     logger.debug(f"Using timeout: {timeout}s for action: {action}")
 
+    handler = ACTION_HANDLERS.get(action)
+    if handler is None:
+        return DiscordActionResponse(success=False, error=f"Unknown action: {action}")
+
     try:
-        # Message handlers
-        if action == "react":
-            result = run_async(handle_react(req, bot))
-        elif action == "reactions":
-            result = run_async(handle_reactions(req, bot))
-        elif action == "sendMessage":
-            result = run_async(handle_send_message(req, bot))
-        elif action == "sendFile":
-            result = run_async(handle_send_file(req, bot))
-        elif action == "editMessage":
-            result = run_async(handle_edit_message(req, bot))
-        elif action == "deleteMessage":
-            result = run_async(handle_delete_message(req, bot))
-        elif action == "readMessages":
-            result = run_async(handle_read_messages(req, bot))
-        elif action == "fetchMessage":
-            result = run_async(handle_fetch_message(req, bot))
-        elif action == "pinMessage":
-            result = run_async(handle_pin_message(req, bot))
-        elif action == "listPins":
-            result = run_async(handle_list_pins(req, bot))
-        elif action == "threadCreate":
-            result = run_async(handle_thread_create(req, bot))
-        elif action == "threadList":
-            result = run_async(handle_thread_list(req, bot))
-        elif action == "threadReply":
-            result = run_async(handle_thread_reply(req, bot))
-        elif action == "sticker":
-            result = run_async(handle_sticker(req, bot))
-        elif action == "poll":
-            result = run_async(handle_poll(req, bot))
-        elif action == "searchMessages":
-            result = run_async(handle_search_messages(req, bot))
-        # Channel handlers
-        elif action == "channelInfo":
-            result = run_async(handle_channel_info(req, bot))
-        elif action == "channelList":
-            result = run_async(handle_channel_list(req, bot))
-        elif action == "permissions":
-            result = run_async(handle_permissions(req, bot))
-        elif action == "channelCreate":
-            result = run_async(handle_channel_create(req, bot))
-        elif action == "categoryCreate":
-            result = run_async(handle_category_create(req, bot))
-        elif action == "channelEdit":
-            result = run_async(handle_channel_edit(req, bot))
-        elif action == "channelMove":
-            result = run_async(handle_channel_move(req, bot))
-        elif action == "channelDelete":
-            result = run_async(handle_channel_delete(req, bot))
-        elif action == "categoryEdit":
-            result = run_async(handle_category_edit(req, bot))
-        elif action == "categoryDelete":
-            result = run_async(handle_category_delete(req, bot))
-        # Guild handlers
-        elif action == "memberInfo":
-            result = run_async(handle_member_info(req, bot))
-        elif action == "roleInfo":
-            result = run_async(handle_role_info(req, bot))
-        elif action == "emojiList":
-            result = run_async(handle_emoji_list(req, bot))
-        elif action == "emojiUpload":
-            result = run_async(handle_emoji_upload(req, bot))
-        elif action == "stickerUpload":
-            result = run_async(handle_sticker_upload(req, bot))
-        elif action == "voiceStatus":
-            result = run_async(handle_voice_status(req, bot))
-        elif action == "eventList":
-            result = run_async(handle_event_list(req, bot))
-        elif action == "roleAdd":
-            result = run_async(handle_role_add(req, bot))
-        elif action == "roleRemove":
-            result = run_async(handle_role_remove(req, bot))
-        elif action == "timeout":
-            result = run_async(handle_timeout(req, bot))
-        elif action == "kick":
-            result = run_async(handle_kick(req, bot))
-        elif action == "ban":
-            result = run_async(handle_ban(req, bot))
-        else:
-            return DiscordActionResponse(success=False, error=f"Unknown action: {action}")
+        result = await run_on_bot_loop(handler(req, bot), timeout)
 
         if result.get("success"):
             return DiscordActionResponse(success=True, data=result.get("data"))
         else:
             return DiscordActionResponse(success=False, error=result.get("error"))
-    except concurrent.futures.TimeoutError:
+    except asyncio.TimeoutError:
         logger.error(f"Discord action timeout after {timeout}s")
         return DiscordActionResponse(success=False, error=f"Timeout after {timeout}s")
     except Exception as e:
@@ -1049,7 +1124,7 @@ async def discord_action(req: DiscordActionRequest):
 
 
 # ========================================
-# FastAPIサーバーを別スレッドで起動
+# FastAPIサーバーの起動（別スレッド / Bot と同じイベントループ）
 # ========================================
 
 def run_api():
@@ -1058,14 +1133,60 @@ def run_api():
     uvicorn.run(api_app, host="0.0.0.0", port=API_PORT, log_level="info")
 
 
+class LoopApiServer(uvicorn.Server):
+    """Bot のイベントループ内で動かす uvicorn サーバー
+
+    シグナルは run_single_loop() で受けて API と Bot を順に止めるので、uvicorn には処理させない。
+    """
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+
+async def run_single_loop():
+    """FastAPIサーバーと Discord Bot を1つのイベントループで実行
+
+    API は Bot のログイン前から応答するが、on_ready までは /health の bot_ready が false で、
+    アクションは "Bot is not ready yet" を返す。
+    SIGINT / SIGTERM を受けるか、どちらかが終了したら、API → Bot の順に止める。
+    """
+    server = LoopApiServer(uvicorn.Config(api_app, host="0.0.0.0", port=API_PORT, log_level="info"))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    logger.info(f"Starting API server on port {API_PORT} (single event loop)")
+    async with bot:
+        api_task = asyncio.create_task(server.serve(), name="api-server")
+        bot_task = asyncio.create_task(bot.start(DISCORD_TOKEN), name="discord-bot")
+        stop_task = asyncio.create_task(stop.wait(), name="stop-signal")
+        await asyncio.wait({api_task, bot_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+
+        logger.info("🛑 API サーバーと Bot を停止します")
+        stop_task.cancel()
+        server.should_exit = True
+        await api_task
+        await cc_api.close()
+        if search_index:
+            await search_index.close()
+        await bot.close()
+        # ログインの失敗などで Bot が先に終了した場合は、その例外をそのまま上げる
+        await bot_task
+
+
 # ========================================
 # メイン処理
 # ========================================
 
 if __name__ == "__main__":
-    # FastAPIサーバーを別スレッドで起動
-    api_thread = threading.Thread(target=run_api, daemon=True)
-    api_thread.start()
-
-    # Discord Botを起動
-    bot.run(DISCORD_TOKEN)
+    if SINGLE_LOOP:
+        asyncio.run(run_single_loop())
+    else:
+        # FastAPIサーバーを別スレッドで起動
+        api_thread = threading.Thread(target=run_api, daemon=True)
+        api_thread.start()
+
+        # Discord Botを起動
+        bot.run(DISCORD_TOKEN)
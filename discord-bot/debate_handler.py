@@ -7,14 +7,14 @@ Bot間議論機能ハンドラー
 
 import json
 import logging
-import asyncio
 from typing import Optional, List, Dict, Any
 from dataclasses import dataclass, field
 from datetime import datetime
 import discord
 from discord.ext import commands
-import requests
-import os
+
+from backends import cc_api, caller_headers
+from message_cache import message_cache
 
 # 既存のハンドラーをインポート
 from handlers import (
@@ -25,7 +25,6 @@ from handlers import (
 
 logger = logging.getLogger(__name__)
 
-CINDERELLA_URL = os.getenv("CINDERELLA_URL", "http://cc-api:8080")
 
 # APIタイムアウト設定
 CINDERELLA_API_TIMEOUT = 60  # APIのタイムアウト（秒）
@@ -311,9 +310,7 @@ async def process_debate_message(
         )
     
     # 直近のメッセージを取得
-    recent_messages = []
-    async for msg in message.channel.history(limit=10):
-        recent_messages.append(msg)
+    recent_messages = await message_cache.history(message.channel, 10)
     recent_messages.reverse()  # 古い順に並べ替え
     
     # ClaudeCode用のプロンプトを生成（Discord Action対応）
@@ -321,19 +318,21 @@ async def process_debate_message(
     
     try:
         # cc-api経由でClaudeCodeを呼び出し
-        loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: requests.post(
-                f"{CINDERELLA_URL}/v1/claude/run",
-                json={
-                    "prompt": prompt,
-                    "cwd": "/workspace",
-                    "allowed_tools": ["Read"],
-                    "timeout_sec": 60,
-                },
-                timeout=CINDERELLA_REQUEST_TIMEOUT,
-            ),
+        response = await cc_api.post(
+            "/v1/claude/run",
+            json={
+                "prompt": prompt,
+                "cwd": "/workspace",
+                "allowed_tools": ["Read"],
+                "timeout_sec": 60,
+                # 議論ターンは出力（Discord Action JSON）を Bot 側で実行するだけなので、
+                # 同じ入力の再送は cc-api の結果キャッシュで返してよい
+                "cache": True,
+                # 議論は人が待っている !ask より後回しにしてよい
+                "lane": "background",
+            },
+            headers=caller_headers(message.channel, message.author),
+            timeout=CINDERELLA_REQUEST_TIMEOUT,
         )
         
         if response.status_code != 200:
@@ -5,9 +5,13 @@
 """
 
 import logging
+import sqlite3
 import discord
 from pydantic import BaseModel
 
+from message_cache import message_cache
+from search_index import parse_time, search_index
+
 logger = logging.getLogger(__name__)
 
 
@@ -162,7 +166,7 @@ async def handle_read_messages(req: BaseModel, bot) -> dict:
 
         limit = req.limit or 20
         messages = []
-        async for message in channel.history(limit=limit):
+        for message in await message_cache.history(channel, limit):
             reactions = []
             for reaction in message.reactions:
                 reactions.append({
@@ -474,10 +478,76 @@ async def handle_poll(req: BaseModel, bot) -> dict:
 
 
 async def handle_search_messages(req: BaseModel, bot) -> dict:
-    """メッセージを検索"""
-    if not req.guildId or not req.searchContent:
-        return {"success": False, "error": "guildId and searchContent are required for searchMessages"}
+    """メッセージを検索（検索インデックスがあればそこから、なければ各チャンネルの履歴を読む）"""
+    if not req.guildId:
+        return {"success": False, "error": "guildId is required for searchMessages"}
+    if not bot.get_guild(int(req.guildId)):
+        return {"success": False, "error": f"Guild {req.guildId} not found"}
+    if search_index is None:
+        if not req.searchContent:
+            return {"success": False, "error": "guildId and searchContent are required for searchMessages"}
+        return await search_messages_by_history(req, bot)
+    if not (req.searchContent or req.userId or req.channelIds or req.after or req.before):
+        return {"success": False, "error": "searchContent or a filter (userId, channelIds, after, before) is required"}
+    if req.sort not in (None, "relevance", "newest"):
+        return {"success": False, "error": "sort must be relevance or newest"}
+
+    try:
+        after = parse_time(req.after) if req.after else None
+        before = parse_time(req.before) if req.before else None
+    except ValueError as e:
+        return {"success": False, "error": f"Invalid date: {e}"}
 
+    try:
+        limit = min(req.limit or 20, 100)
+        result = await search_index.search(
+            int(req.guildId),
+            text=req.searchContent or "",
+            channel_ids=[int(c) for c in req.channelIds or []],
+            author_id=int(req.userId) if req.userId else None,
+            after=after,
+            before=before,
+            sort=req.sort or "relevance",
+            limit=limit,
+            offset=max(req.offset or 0, 0),
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Search index query failed, falling back to history scan: {e}")
+        if not req.searchContent:
+            return {"success": False, "error": str(e)}
+        return await search_messages_by_history(req, bot)
+
+    messages = []
+    for row in result["rows"]:
+        # チャンネル名は変わっていることがあるので、わかれば今の名前を使う
+        channel = bot.get_channel(row["channel_id"])
+        messages.append({
+            "id": str(row["id"]),
+            "content": row["content"],
+            "author": {
+                "id": str(row["author_id"]),
+                "username": row["author_name"],
+                "display_name": row["author_display_name"]
+            },
+            "channel_id": str(row["channel_id"]),
+            "channel_name": channel.name if channel else row["channel_name"],
+            "timestamp": row["created_at"]
+        })
+
+    logger.info(f"Messages searched: {len(messages)} messages found ({result['took_ms']} ms)")
+    return {"success": True, "data": {
+        "messages": messages,
+        "count": len(messages),
+        "query": req.searchContent,
+        "has_more": result["has_more"],
+        "next_offset": result["next_offset"],
+        "took_ms": result["took_ms"],
+        "backfill": result["backfill"]
+    }}
+
+
+async def search_messages_by_history(req: BaseModel, bot) -> dict:
+    """各チャンネルの直近100件を順に読んで部分一致で探す（検索インデックスを使わない場合）"""
     try:
         guild = bot.get_guild(int(req.guildId))
         if not guild:
@@ -0,0 +1,228 @@
+"""
+チャンネルごとの直近メッセージのキャッシュ
+
+!ask / !task / 議論 / readMessages は毎回 channel.history() で直近のメッセージを REST で取得していた。
+チャンネルごとに直近 MESSAGE_CACHE_SIZE 件のリングバッファを持ち、Gateway のイベントで最新に保つことで、
+REST の呼び出し（レート制限のバケット）を使わずに返す。
+
+- バッファは最初に読まれたときに history() で1回だけ埋める（1ページ = 100件までは REST 1回）
+- 埋めたあとは Gateway のイベント（新規・編集・削除）で更新するので、最新の状態と途切れなく続いている
+- 要求された件数をバッファがまかなえない（件数が足りず、チャンネルの先頭まで読んでもいない）ときは REST で読む
+- リアクションの追加・削除はバッファ内のメッセージのリアクション数をその場で更新する
+  （Bot 自身も呼び出しのたびにリアクションを付けるので、バッファを捨てるとほとんど当たらなくなる）
+- Gateway に再接続したとき（on_ready）は、取りこぼしがありうるので全チャンネルのバッファを捨てる
+"""
+
+import logging
+import os
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+# channel.history() の1リクエストで取得できる最大件数
+HISTORY_PAGE_SIZE = 100
+
+
+class ChannelBuffer:
+    """1チャンネル分のリングバッファ（古い順に並ぶ）"""
+
+    def __init__(self, size: int):
+        self.messages: Deque[discord.Message] = deque(maxlen=size)
+        # history() で埋め終わったか（埋める前・埋めている最中のイベントも messages に入る）
+        self.filled = False
+        # チャンネルの先頭まで読んだか（件数が size に満たなくても全件そろっている）
+        self.complete = False
+
+    def covers(self, limit: int) -> bool:
+        return self.filled and (len(self.messages) >= limit or self.complete)
+
+    def newest(self, limit: int) -> List[discord.Message]:
+        """新しい順に limit 件（channel.history() と同じ順）"""
+        result = []
+        for message in reversed(self.messages):
+            if len(result) >= limit:
+                break
+            result.append(message)
+        return result
+
+    def add(self, message: discord.Message):
+        if self.messages and message.id <= self.messages[-1].id:
+            # 埋めている最中に届いたものと重なった場合など
+            if any(m.id == message.id for m in self.messages):
+                return
+            merged = sorted([*self.messages, message], key=lambda m: m.id)
+            self.messages.clear()
+            self.messages.extend(merged)
+            return
+        self.messages.append(message)
+
+    def get(self, message_id: int) -> Optional[discord.Message]:
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+        return None
+
+    def replace(self, message: discord.Message):
+        for i, cached in enumerate(self.messages):
+            if cached.id == message.id:
+                self.messages[i] = message
+                return
+
+    def remove(self, message_ids: set):
+        if any(m.id in message_ids for m in self.messages):
+            kept = [m for m in self.messages if m.id not in message_ids]
+            self.messages.clear()
+            self.messages.extend(kept)
+
+
+def apply_reaction(message: discord.Message, payload):
+    """リアクションのイベントをメッセージの reactions に反映する（discord.py が自身のキャッシュに行うのと同じ処理）
+
+    discord.py の非公開メソッドを使うので requirements.txt でバージョンを固定している。
+    消えたときは tests/test_message_cache.py の test_discord_py_internals_still_exist が失敗する。
+    """
+    event_type = getattr(payload, "event_type", None)
+    emoji = getattr(payload, "emoji", None)
+    if emoji is not None and emoji.is_unicode_emoji():
+        # history() で読んだ Reaction の絵文字は str なので揃える
+        emoji = emoji.name
+    if event_type == "REACTION_ADD":
+        message._add_reaction({"me": False, "burst": payload.burst}, emoji, payload.user_id)
+    elif event_type == "REACTION_REMOVE":
+        message._remove_reaction({}, emoji, payload.user_id)
+    elif emoji is not None:
+        message._clear_emoji(payload.emoji)
+    else:
+        message.reactions.clear()
+
+
+class MessageCache:
+    """チャンネルごとのリングバッファ（Bot のイベントループ上でだけ使う）
+
+    Args:
+        size: 1チャンネルで覚えておくメッセージ数
+        max_channels: バッファを持つチャンネル数の上限（使われていないものから捨てる）
+    """
+
+    def __init__(self, size: int = 100, max_channels: int = 500):
+        self.size = size
+        self.max_channels = max_channels
+        self._channels: "OrderedDict[int, ChannelBuffer]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.rest_calls = 0
+        self.rest_calls_saved = 0
+
+    @classmethod
+    def from_env(cls) -> "MessageCache":
+        return cls(
+            size=int(os.getenv("MESSAGE_CACHE_SIZE", "100")),
+            max_channels=int(os.getenv("MESSAGE_CACHE_MAX_CHANNELS", "500")),
+        )
+
+    async def history(self, channel, limit: int) -> List[discord.Message]:
+        """channel.history(limit=limit) と同じく新しい順のメッセージ一覧"""
+        if self.size <= 0 or limit > self.size:
+            # バッファに収まらない件数はそのまま REST で読む
+            self.misses += 1
+            self.rest_calls += -(-limit // HISTORY_PAGE_SIZE)
+            return [m async for m in channel.history(limit=limit)]
+
+        buffer = self._channels.get(channel.id)
+        if buffer is not None and buffer.covers(limit):
+            self._channels.move_to_end(channel.id)
+            self.hits += 1
+            self.rest_calls_saved += -(-limit // HISTORY_PAGE_SIZE)
+            return buffer.newest(limit)
+
+        self.misses += 1
+        buffer = self._buffer(channel.id)
+        # 1回の REST でバッファを埋めておく（件数が少なくても多くても REST の回数は同じ）
+        fetch = min(self.size, HISTORY_PAGE_SIZE) if limit <= HISTORY_PAGE_SIZE else self.size
+        self.rest_calls += -(-fetch // HISTORY_PAGE_SIZE)
+        fetched = [m async for m in channel.history(limit=fetch)]
+        for message in reversed(fetched):
+            buffer.add(message)
+        buffer.filled = True
+        buffer.complete = len(fetched) < fetch
+        return buffer.newest(limit)
+
+    def _buffer(self, channel_id: int) -> ChannelBuffer:
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            buffer = ChannelBuffer(self.size)
+            self._channels[channel_id] = buffer
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        self._channels.move_to_end(channel_id)
+        return buffer
+
+    # --- Gateway のイベント（一度も読まれていないチャンネルは何もしない） ---
+
+    def on_message(self, message: discord.Message):
+        buffer = self._channels.get(message.channel.id)
+        if buffer is not None:
+            buffer.add(message)
+
+    def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        buffer = self._channels.get(payload.channel_id)
+        if buffer is None:
+            return
+        message = getattr(payload, "message", None)
+        if message is None:
+            # 更新後のメッセージを持たない古い discord.py では、次に読むときに埋め直す
+            self.invalidate(payload.channel_id)
+            return
+        buffer.replace(message)
+
+    def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        buffer = self._channels.get(payload.channel_id)
+        if buffer is not None:
+            buffer.remove({payload.message_id})
+
+    def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        buffer = self._channels.get(payload.channel_id)
+        if buffer is not None:
+            buffer.remove(set(payload.message_ids))
+
+    def on_raw_reaction(self, payload):
+        """リアクションの追加・削除・全削除（on_raw_reaction_add / remove / clear / clear_emoji）
+
+        history() で読んだメッセージは discord.py が更新しないので、ここでリアクション数を更新する。
+        更新できない（すでに消えたリアクションの削除など）ときは、次に読むときに埋め直す。
+        """
+        buffer = self._channels.get(payload.channel_id)
+        message = buffer.get(payload.message_id) if buffer is not None else None
+        if message is None or message._state._get_message(message.id) is message:
+            # discord.py のメッセージキャッシュにあるもの（Gateway で受け取ったもの）は discord.py が更新済み
+            return
+        try:
+            apply_reaction(message, payload)
+        except (AttributeError, ValueError):
+            self.invalidate(payload.channel_id)
+
+    def invalidate(self, channel_id: Optional[int] = None):
+        """バッファを捨てる（channel_id を省略すると全チャンネル）"""
+        if channel_id is None:
+            self._channels.clear()
+        else:
+            self._channels.pop(channel_id, None)
+
+    def stats(self) -> dict:
+        reads = self.hits + self.misses
+        return {
+            "channels": len(self._channels),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / reads, 3) if reads else None,
+            "rest_calls": self.rest_calls,
+            "rest_calls_saved": self.rest_calls_saved,
+        }
+
+
+# bot.py・debate_handler.py・handlers で共有する
+message_cache = MessageCache.from_env()
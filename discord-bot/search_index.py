@@ -0,0 +1,462 @@
+"""
+ギルドのメッセージの全文検索インデックス（SQLite FTS5）
+
+searchMessages は、ギルドのテキストチャンネルごとに channel.history(limit=100) を順に読んで部分一致で探していた。
+チャンネル数だけ REST を呼ぶうえ、直近100件より古いメッセージは見つからない。
+メッセージをローカルの SQLite に保存して FTS5 で検索する。
+
+- Gateway のイベント（新規・編集・削除）は少しためてから1回のトランザクションでまとめて書き込む
+- 過去のメッセージはバックグラウンドで少しずつ読み込む（バックフィル）。
+  チャンネルごとの進み具合を DB に保存するので、再起動しても続きから再開する
+- 起動（再接続）するたびに、Bot が止まっていた間のメッセージを各チャンネルの最新側から読み足す
+- トークナイザーは trigram（日本語のように空白で区切らない文章でも部分一致で探せる）。
+  3文字未満の語は LIKE で絞り込む
+
+Bot が止まっていた間の編集・削除は反映されない（次に同じメッセージがバックフィルで読まれたときに更新される）。
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+# channel.history() の1リクエストで取得できる最大件数
+HISTORY_PAGE_SIZE = 100
+# trigram トークナイザーで MATCH を使える最小の文字数
+MIN_MATCH_CHARS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    parent_id INTEGER,
+    channel_name TEXT,
+    author_id INTEGER NOT NULL,
+    author_name TEXT,
+    author_display_name TEXT,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_guild ON messages(guild_id, id);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages(channel_id, id);
+CREATE INDEX IF NOT EXISTS messages_author ON messages(author_id, id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF content ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+
+CREATE TABLE IF NOT EXISTS backfill (
+    channel_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    oldest_id INTEGER,
+    newest_id INTEGER,
+    indexed INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+UPSERT = """
+INSERT INTO messages (
+    id, guild_id, channel_id, parent_id, channel_name, author_id, author_name, author_display_name, content, created_at
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET content = excluded.content
+WHERE messages.content IS NOT excluded.content
+"""
+
+
+def message_row(message: discord.Message) -> tuple:
+    channel = message.channel
+    return (
+        message.id,
+        message.guild.id,
+        channel.id,
+        getattr(channel, "parent_id", None),
+        getattr(channel, "name", None),
+        message.author.id,
+        message.author.name,
+        message.author.display_name,
+        message.content,
+        message.created_at.isoformat(),
+    )
+
+
+def parse_time(value: str) -> datetime:
+    """ISO 8601 の日付・日時（タイムゾーンがなければ UTC とみなす）"""
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def fts_phrase(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+class SearchIndex:
+    """メッセージの全文検索インデックス
+
+    Args:
+        path: SQLite のファイル
+        flush_interval_sec: Gateway のイベントをまとめて書き込む間隔
+        backfill_interval_sec: バックフィルで history() を呼ぶ間隔（レート制限の枠を対話的な処理に残すため）
+        backfill_max_messages: 1チャンネルでさかのぼる件数の上限（0 なら先頭まで）
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval_sec: float = 1.0,
+        backfill_interval_sec: float = 1.0,
+        backfill_max_messages: int = 10000,
+    ):
+        self.path = path
+        self.flush_interval_sec = flush_interval_sec
+        self.backfill_interval_sec = backfill_interval_sec
+        self.backfill_max_messages = backfill_max_messages
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[str, tuple]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._backfill_task: Optional[asyncio.Task] = None
+        self.queries = 0
+        self.query_ms_total = 0.0
+        self.backfill_rest_calls = 0
+        self.live_writes = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["SearchIndex"]:
+        # 初回の起動で各チャンネルの履歴を読み込む（REST を多く使う）ので、パスを指定したときだけ有効にする
+        path = os.getenv("SEARCH_INDEX_PATH", "")
+        if not path:
+            return None
+        return cls(
+            path,
+            backfill_interval_sec=float(os.getenv("SEARCH_BACKFILL_INTERVAL_SEC", "1.0")),
+            backfill_max_messages=int(os.getenv("SEARCH_BACKFILL_MAX_MESSAGES", "10000")),
+        )
+
+    # --- DB（スレッドで実行する） ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _write(self, ops: List[Tuple[str, tuple]]):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for op, args in ops:
+                    if op == "upsert":
+                        conn.execute(UPSERT, args)
+                        # 進み具合を記録済みのチャンネルは最新側を進めておく（再起動時の読み足しをここから始める）
+                        conn.execute(
+                            "UPDATE backfill SET newest_id = ? WHERE channel_id = ? AND newest_id < ?",
+                            (args[0], args[2], args[0]),
+                        )
+                    elif op == "edit":
+                        conn.execute("UPDATE messages SET content = ? WHERE id = ?", args)
+                    elif op == "delete":
+                        conn.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in args])
+
+    def _state(self, channel_id: int) -> Optional[tuple]:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT oldest_id, newest_id, indexed, done FROM backfill WHERE channel_id = ?", (channel_id,)
+            ).fetchone()
+
+    def _save_page(self, guild_id: int, channel_id: int, rows: List[tuple], oldest_id, newest_id, done: bool):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(UPSERT, rows)
+                conn.execute(
+                    """
+                    INSERT INTO backfill (channel_id, guild_id, oldest_id, newest_id, indexed, done)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(channel_id) DO UPDATE SET
+                        oldest_id = excluded.oldest_id,
+                        newest_id = MAX(COALESCE(backfill.newest_id, 0), COALESCE(excluded.newest_id, 0)),
+                        indexed = backfill.indexed + ?,
+                        done = excluded.done
+                    """,
+                    (channel_id, guild_id, oldest_id, newest_id, len(rows), int(done), len(rows)),
+                )
+
+    # --- Gateway のイベント ---
+
+    def on_message(self, message: discord.Message):
+        if message.guild is not None:
+            self._pending.append(("upsert", message_row(message)))
+
+    def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        # 本文が変わったときだけ data に content が入る（埋め込みの展開などでは入らない）
+        if payload.guild_id is not None and "content" in payload.data:
+            self._pending.append(("edit", (payload.data["content"], payload.message_id)))
+
+    def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if payload.guild_id is not None:
+            self._pending.append(("delete", (payload.message_id,)))
+
+    def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        if payload.guild_id is not None:
+            self._pending.append(("delete", tuple(payload.message_ids)))
+
+    async def flush(self):
+        if self._pending:
+            ops, self._pending = self._pending, []
+            await asyncio.to_thread(self._write, ops)
+            self.live_writes += len(ops)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_sec)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"検索インデックスへの書き込みに失敗: {e}")
+
+    # --- バックフィル ---
+
+    @staticmethod
+    def _channels(bot) -> list:
+        channels = []
+        for guild in bot.guilds:
+            for channel in [*guild.channels, *guild.threads]:
+                if not hasattr(channel, "history"):
+                    continue
+                permissions = channel.permissions_for(guild.me)
+                if permissions.read_messages and permissions.read_message_history:
+                    channels.append(channel)
+        return channels
+
+    async def _fetch(self, channel, **kwargs) -> List[discord.Message]:
+        self.backfill_rest_calls += 1
+        messages = [m async for m in channel.history(limit=HISTORY_PAGE_SIZE, **kwargs)]
+        await asyncio.sleep(self.backfill_interval_sec)
+        return messages
+
+    async def _catch_up(self, channel, newest_id: int) -> int:
+        """Bot が止まっていた間のメッセージを最新側に読み足す"""
+        added = 0
+        while True:
+            page = await self._fetch(channel, after=discord.Object(newest_id), oldest_first=True)
+            if not page:
+                return added
+            state = await asyncio.to_thread(self._state, channel.id)
+            newest_id = max(newest_id, page[-1].id)
+            await asyncio.to_thread(
+                self._save_page, channel.guild.id, channel.id, [message_row(m) for m in page],
+                state[0], newest_id, bool(state[3]),
+            )
+            added += len(page)
+            if len(page) < HISTORY_PAGE_SIZE:
+                return added
+
+    async def _backfill_channel(self, channel) -> int:
+        """過去のメッセージを古い方へ1ページずつ読む（進み具合は DB に保存する）"""
+        added = 0
+        while True:
+            state = await asyncio.to_thread(self._state, channel.id)
+            oldest_id, newest_id, indexed, done = state or (None, None, 0, 0)
+            if done or (self.backfill_max_messages and indexed >= self.backfill_max_messages):
+                return added
+            before = discord.Object(oldest_id) if oldest_id else None
+            page = await self._fetch(channel, before=before)
+            finished = len(page) < HISTORY_PAGE_SIZE
+            if page:
+                oldest_id = page[-1].id
+                newest_id = max(newest_id or 0, page[0].id)
+            await asyncio.to_thread(
+                self._save_page, channel.guild.id, channel.id, [message_row(m) for m in page],
+                oldest_id, newest_id, finished,
+            )
+            added += len(page)
+            if finished:
+                return added
+
+    async def _backfill(self, bot):
+        start = time.monotonic()
+        channels = self._channels(bot)
+        added = 0
+        # 先に全チャンネルの最新側を読み足してから、古い方へさかのぼる
+        for channel in channels:
+            state = await asyncio.to_thread(self._state, channel.id)
+            if state and state[1]:
+                try:
+                    added += await self._catch_up(channel, state[1])
+                except discord.HTTPException as e:
+                    logger.warning(f"検索インデックスの読み足しに失敗: #{channel} ({channel.id}): {e}")
+        for channel in channels:
+            try:
+                added += await self._backfill_channel(channel)
+            except discord.HTTPException as e:
+                logger.warning(f"検索インデックスのバックフィルに失敗: #{channel} ({channel.id}): {e}")
+        logger.info(
+            f"🔎 検索インデックスのバックフィル完了: {len(channels)} チャンネル, "
+            f"{added} 件追加 ({time.monotonic() - start:.0f}秒)"
+        )
+
+    def start(self, bot):
+        """書き込みとバックフィルを開始する（on_ready で呼ぶ。バックフィルは再接続のたびに読み足す）"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if self._backfill_task is None or self._backfill_task.done():
+            self._backfill_task = asyncio.create_task(self._backfill(bot))
+
+    async def close(self):
+        for task in (self._flush_task, self._backfill_task):
+            if task:
+                task.cancel()
+        self._flush_task = self._backfill_task = None
+        await self.flush()
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+                self._conn = None
+
+    # --- 検索 ---
+
+    def _query(
+        self,
+        guild_id: int,
+        text: str,
+        channel_ids: List[int],
+        author_id: Optional[int],
+        after: Optional[datetime],
+        before: Optional[datetime],
+        sort: str,
+        limit: int,
+        offset: int,
+    ) -> List[sqlite3.Row]:
+        terms = text.split()
+        match_terms = [t for t in terms if len(t) >= MIN_MATCH_CHARS]
+        where = ["m.guild_id = ?"]
+        params: list = [guild_id]
+        if match_terms:
+            where.append("messages_fts MATCH ?")
+            params.append(" AND ".join(fts_phrase(t) for t in match_terms))
+        for term in terms:
+            if len(term) < MIN_MATCH_CHARS:
+                where.append("m.content LIKE ? ESCAPE '\\'")
+                escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                params.append(f"%{escaped}%")
+        if channel_ids:
+            # スレッドは親チャンネルを指定しても見つかるようにする
+            marks = ", ".join("?" * len(channel_ids))
+            where.append(f"(m.channel_id IN ({marks}) OR m.parent_id IN ({marks}))")
+            params += channel_ids + channel_ids
+        if author_id:
+            where.append("m.author_id = ?")
+            params.append(author_id)
+        if after:
+            where.append("m.id >= ?")
+            params.append(discord.utils.time_snowflake(after))
+        if before:
+            where.append("m.id < ?")
+            params.append(discord.utils.time_snowflake(before))
+
+        if match_terms:
+            source = "messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+            order = "bm25(messages_fts), m.id DESC" if sort == "relevance" else "m.id DESC"
+        else:
+            source = "messages m"
+            order = "m.id DESC"
+        sql = f"SELECT m.* FROM {source} WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ? OFFSET ?"
+        with self._lock:
+            conn = self._connect()
+            conn.row_factory = sqlite3.Row
+            try:
+                return conn.execute(sql, params + [limit, offset]).fetchall()
+            finally:
+                conn.row_factory = None
+
+    def _coverage(self, guild_id: int, channel_ids: List[int]) -> dict:
+        sql = "SELECT COUNT(*), COALESCE(SUM(done), 0), COALESCE(SUM(indexed), 0) FROM backfill WHERE guild_id = ?"
+        params: list = [guild_id]
+        if channel_ids:
+            sql += f" AND channel_id IN ({', '.join('?' * len(channel_ids))})"
+            params += channel_ids
+        with self._lock:
+            channels, done, indexed = self._connect().execute(sql, params).fetchone()
+        return {"channels": channels, "channels_done": done, "messages_backfilled": indexed}
+
+    async def search(
+        self,
+        guild_id: int,
+        text: str = "",
+        channel_ids: Optional[List[int]] = None,
+        author_id: Optional[int] = None,
+        after: Optional[datetime] = None,
+        before: Optional[datetime] = None,
+        sort: str = "relevance",
+        limit: int = 20,
+        offset: int = 0,
+    ) -> dict:
+        """検索する（sort: relevance = 関連度順 / newest = 新しい順）。次のページは next_offset で取得する"""
+        await self.flush()
+        start = time.perf_counter()
+        channel_ids = channel_ids or []
+        rows = await asyncio.to_thread(
+            self._query, guild_id, text, channel_ids, author_id, after, before, sort, limit + 1, offset
+        )
+        coverage = await asyncio.to_thread(self._coverage, guild_id, channel_ids)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.queries += 1
+        self.query_ms_total += elapsed_ms
+        has_more = len(rows) > limit
+        return {
+            "rows": rows[:limit],
+            "has_more": has_more,
+            "next_offset": offset + limit if has_more else None,
+            "took_ms": round(elapsed_ms, 2),
+            "backfill": coverage,
+        }
+
+    def stats(self) -> dict:
+        # /health から呼ばれるので、メッセージ数は数えずにバックフィルの進み具合だけ読む
+        with self._lock:
+            channels, done, backfilled = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(done), 0), COALESCE(SUM(indexed), 0) FROM backfill"
+            ).fetchone()
+        return {
+            "path": self.path,
+            "live_writes": self.live_writes,
+            "pending_writes": len(self._pending),
+            "messages_backfilled": backfilled,
+            "backfill_channels": channels,
+            "backfill_channels_done": done,
+            "backfill_running": bool(self._backfill_task and not self._backfill_task.done()),
+            "backfill_rest_calls": self.backfill_rest_calls,
+            "queries": self.queries,
+            "avg_query_ms": round(self.query_ms_total / self.queries, 2) if self.queries else None,
+        }
+
+
+# bot.py と handlers で共有する（SEARCH_INDEX_PATH を指定しなければ無効）
+search_index = SearchIndex.from_env()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+cc-api バックエンドの振り分け（backends.py）のテスト
+
+localhost に aiohttp の小さなサーバーを立て、接続できないバックエンドは閉じたポートで表す。
+
+    python -m pytest tests/test_backends.py
+"""
+
+import asyncio
+import socket
+import sys
+from pathlib import Path
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import backends  # noqa: E402
+from backends import BackendPool  # noqa: E402
+
+
+def closed_port_url() -> str:
+    """接続を拒否される URL（一度 bind したポートを閉じる）"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return f"http://127.0.0.1:{port}"
+
+
+async def start_server(health_status: int = 200):
+    """/v1/claude/run に {"ok": true} を、/health に health_status を返すサーバー"""
+    app = web.Application()
+    state = {"health_status": health_status}
+
+    async def run(request):
+        return web.json_response({"ok": True})
+
+    async def health(request):
+        return web.Response(status=state["health_status"])
+
+    app.router.add_post("/v1/claude/run", run)
+    app.router.add_get("/health", health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, state, f"http://127.0.0.1:{port}"
+
+
+def test_pick_prefers_fewest_outstanding_and_skips_unhealthy():
+    pool = BackendPool(["http://a", "http://b", "http://c"])
+    a, b, c = pool.backends
+    a.outstanding, b.outstanding, c.outstanding = 3, 1, 0
+    c.healthy = False
+    assert pool.pick() is b
+
+    # 正常なものがなければ外したものも含めて選ぶ
+    a.healthy = b.healthy = False
+    assert pool.pick() is c
+
+
+def test_pick_keeps_conversation_on_same_backend():
+    pool = BackendPool(["http://a", "http://b"])
+    first = pool.pick("conv-1")
+    first.outstanding = 5
+    assert pool.pick("conv-1") is first
+
+    # セッションを持つバックエンドが外れたら別のものに移る
+    first.healthy = False
+    moved = pool.pick("conv-1")
+    assert moved is not first
+    assert pool.pick("conv-1") is moved
+
+
+def test_connection_error_fails_over_to_next_backend():
+    async def main():
+        runner, _, live_url = await start_server()
+        pool = BackendPool([closed_port_url(), live_url])
+        dead, live = pool.backends
+        # 接続できないほうを先に選ばせる
+        live.outstanding = 1
+        try:
+            response = await pool.post("/v1/claude/run", json={"prompt": "hi"}, timeout=5)
+        finally:
+            await pool.close()
+            await runner.cleanup()
+
+        assert response.status_code == 200
+        assert response.json() == {"ok": True}
+        assert dead.requests == 1 and live.requests == 1
+        # 接続できなかったバックエンドはすぐに振り分けから外す
+        assert dead.healthy is False
+        assert dead.last_error == "ClientConnectorError"
+        assert dead.outstanding == 0 and live.outstanding == 1
+
+    asyncio.run(main())
+
+
+def test_all_backends_down_backs_off_then_raises(monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(backends.asyncio, "sleep", fake_sleep)
+
+    async def main():
+        pool = BackendPool([closed_port_url(), closed_port_url()], connect_retries=2, retry_backoff_sec=0.5)
+        try:
+            with pytest.raises(aiohttp.ClientConnectorError):
+                await pool.post("/v1/claude/run", json={"prompt": "hi"})
+        finally:
+            await pool.close()
+        # 1巡（2台）ごとに倍々に待ち、connect_retries 回試し直したらあきらめる
+        assert delays == [0.5, 1.0]
+        assert [b.requests for b in pool.backends] == [3, 3]
+
+    asyncio.run(main())
+
+
+def test_probe_ejects_and_restores_backend():
+    async def main():
+        runner, state, url = await start_server(health_status=503)
+        pool = BackendPool([url], eject_after=2)
+        backend = pool.backends[0]
+        try:
+            await pool.probe(backend)
+            assert backend.healthy is True
+            await pool.probe(backend)
+            assert backend.healthy is False
+            assert backend.last_error == "HTTP 503"
+
+            state["health_status"] = 200
+            await pool.probe(backend)
+            assert backend.healthy is True
+            assert backend.failures == 0
+        finally:
+            await pool.close()
+            await runner.cleanup()
+
+    asyncio.run(main())
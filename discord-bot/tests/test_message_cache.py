@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+チャンネルごとの直近メッセージのキャッシュ（message_cache.py）のテスト
+
+Discord には接続せず、history() を数える偽のチャンネルと discord.Message で確認する。
+
+    python -m pytest tests/test_message_cache.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import discord
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from message_cache import MessageCache  # noqa: E402
+
+BOT_USER_ID = 1
+CHANNEL_ID = 10
+
+
+class FakeState:
+    """Message の生成とリアクションの更新に必要な分だけの ConnectionState"""
+    self_id = BOT_USER_ID
+
+    def __init__(self):
+        self.cached = {}
+
+    def _get_message(self, message_id):
+        return self.cached.get(message_id)
+
+    def get_emoji_from_partial_payload(self, data):
+        return data["name"]
+
+    def store_user(self, data, cache=True):
+        return discord.User(state=self, data=data)
+
+
+class FakeChannel:
+    """古い順の messages を持ち、history() の呼び出し回数を数える"""
+
+    def __init__(self, messages):
+        self.id = CHANNEL_ID
+        self.guild = None
+        self.type = discord.ChannelType.text
+        self.messages = messages
+        self.history_calls = 0
+
+    async def history(self, limit):
+        self.history_calls += 1
+        for message in list(reversed(self.messages))[:limit]:
+            yield message
+
+
+def make_message(state, channel, message_id, content="hi", reactions=None):
+    data = {
+        "id": str(message_id), "channel_id": str(channel.id), "content": content, "type": 0,
+        "author": {"id": "2", "username": "user", "discriminator": "0", "avatar": None},
+        "attachments": [], "embeds": [], "mentions": [], "mention_roles": [],
+        "pinned": False, "mention_everyone": False, "tts": False,
+        "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None,
+        "reactions": reactions or [],
+    }
+    return discord.Message(state=state, channel=channel, data=data)
+
+
+def make_channel(count=5):
+    state = FakeState()
+    channel = FakeChannel([])
+    channel.messages = [make_message(state, channel, i) for i in range(1, count + 1)]
+    return state, channel
+
+
+def reaction_event(message_id, emoji, event_type="REACTION_ADD", user_id=BOT_USER_ID):
+    data = {"message_id": message_id, "channel_id": CHANNEL_ID, "user_id": user_id, "type": 0}
+    return discord.RawReactionActionEvent(data, discord.PartialEmoji(name=emoji), event_type)
+
+
+def history(cache, channel, limit):
+    return asyncio.run(cache.history(channel, limit))
+
+
+def test_second_read_is_served_from_buffer():
+    _, channel = make_channel()
+    cache = MessageCache(size=10)
+    first = history(cache, channel, 3)
+    second = history(cache, channel, 5)
+    assert [m.id for m in first] == [5, 4, 3]
+    assert [m.id for m in second] == [5, 4, 3, 2, 1]
+    assert channel.history_calls == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_window_not_covered_reads_rest():
+    state, channel = make_channel(0)
+    channel.messages = [make_message(state, channel, i) for i in range(1, 301)]
+    cache = MessageCache(size=100)
+    history(cache, channel, 10)
+    assert len(history(cache, channel, 100)) == 100
+    assert channel.history_calls == 1
+    assert len(history(cache, channel, 150)) == 150
+    assert channel.history_calls == 2
+
+
+def test_gateway_events_keep_buffer_current():
+    state, channel = make_channel(3)
+    cache = MessageCache(size=10)
+    history(cache, channel, 3)
+
+    cache.on_message(make_message(state, channel, 4, "new"))
+    cache.on_raw_message_edit(SimpleNamespace(channel_id=CHANNEL_ID, message=make_message(state, channel, 2, "edited")))
+    cache.on_raw_message_delete(SimpleNamespace(channel_id=CHANNEL_ID, message_id=1))
+
+    messages = history(cache, channel, 3)
+    assert [m.id for m in messages] == [4, 3, 2]
+    assert messages[2].content == "edited"
+    assert channel.history_calls == 1
+
+
+def test_reactions_update_counts_without_refetch():
+    state, channel = make_channel(1)
+    channel.messages = [make_message(state, channel, 1, reactions=[{"emoji": {"name": "💬"}, "count": 1, "me": True}])]
+    cache = MessageCache(size=10)
+    history(cache, channel, 1)
+
+    cache.on_raw_reaction(reaction_event(1, "💬", user_id=3))
+    cache.on_raw_reaction(reaction_event(1, "✅"))
+    cache.on_raw_reaction(reaction_event(1, "💬", "REACTION_REMOVE"))
+
+    message = history(cache, channel, 1)[0]
+    assert {str(r.emoji): r.count for r in message.reactions} == {"💬": 1, "✅": 1}
+    assert channel.history_calls == 1
+
+
+def test_reaction_clear_empties_reactions():
+    state, channel = make_channel(1)
+    channel.messages = [make_message(state, channel, 1, reactions=[{"emoji": {"name": "✅"}, "count": 2, "me": True}])]
+    cache = MessageCache(size=10)
+    history(cache, channel, 1)
+    cache.on_raw_reaction(discord.RawReactionClearEvent({"message_id": 1, "channel_id": CHANNEL_ID}))
+    assert history(cache, channel, 1)[0].reactions == []
+    assert channel.history_calls == 1
+
+
+def test_unknown_reaction_removal_refetches():
+    _, channel = make_channel(1)
+    cache = MessageCache(size=10)
+    history(cache, channel, 1)
+    cache.on_raw_reaction(reaction_event(1, "✅", "REACTION_REMOVE"))
+    history(cache, channel, 1)
+    assert channel.history_calls == 2
+
+
+def test_messages_tracked_by_discord_py_are_left_alone():
+    state, channel = make_channel(1)
+    cache = MessageCache(size=10)
+    history(cache, channel, 1)
+    # Gateway で受け取ったメッセージは discord.py 自身がリアクションを更新する
+    state.cached[1] = channel.messages[0]
+    cache.on_raw_reaction(reaction_event(1, "✅"))
+    assert channel.messages[0].reactions == []
+
+
+def test_discord_py_internals_still_exist():
+    # apply_reaction と on_raw_reaction は discord.py の非公開メソッドに頼っている。
+    # discord.py を上げてこれが失敗したら、message_cache.py を新しい API に合わせる
+    for name in ("_add_reaction", "_remove_reaction", "_clear_emoji"):
+        assert callable(getattr(discord.Message, name, None)), name
+    assert callable(getattr(discord.state.ConnectionState, "_get_message", None))
+    assert "burst" in discord.RawReactionActionEvent.__slots__
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+メッセージの全文検索インデックス（search_index.py）のテスト
+
+Discord には接続せず、Gateway のイベントと同じ形の書き込みを一時ファイルの SQLite に入れて検索する。
+
+    python -m pytest tests/test_search_index.py
+"""
+
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import discord
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from search_index import SearchIndex  # noqa: E402
+
+GUILD_ID = 100
+CHANNEL_ID = 200
+THREAD_ID = 300
+BASE_TIME = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def row(minutes: int, content: str, channel_id=CHANNEL_ID, parent_id=None, author_id=1) -> tuple:
+    created_at = BASE_TIME + timedelta(minutes=minutes)
+    message_id = discord.utils.time_snowflake(created_at)
+    return (
+        message_id, GUILD_ID, channel_id, parent_id, "general", author_id, "user", "User", content,
+        created_at.isoformat(),
+    )
+
+
+def make_index(tmp_path, rows) -> SearchIndex:
+    index = SearchIndex(str(tmp_path / "search.db"))
+    index._pending = [("upsert", r) for r in rows]
+    return index
+
+
+def contents(result: dict) -> list:
+    return [r["content"] for r in result["rows"]]
+
+
+def test_japanese_substring_and_short_terms(tmp_path):
+    index = make_index(tmp_path, [row(1, "明日の定例会議は延期です"), row(2, "昼ごはんの話"), row(3, "会議室の予約")])
+
+    async def main():
+        assert contents(await index.search(GUILD_ID, "定例会議")) == ["明日の定例会議は延期です"]
+        # 3文字未満は LIKE で探す
+        assert contents(await index.search(GUILD_ID, "会議", sort="newest")) == ["会議室の予約", "明日の定例会議は延期です"]
+
+    asyncio.run(main())
+
+
+def test_filters_and_paging(tmp_path):
+    rows = [
+        row(1, "deploy done", author_id=1),
+        row(2, "deploy failed", author_id=2),
+        row(3, "deploy in thread", channel_id=THREAD_ID, parent_id=CHANNEL_ID),
+        row(4, "deploy elsewhere", channel_id=999),
+    ]
+    index = make_index(tmp_path, rows)
+
+    async def main():
+        in_channel = await index.search(GUILD_ID, "deploy", channel_ids=[CHANNEL_ID], sort="newest")
+        assert contents(in_channel) == ["deploy in thread", "deploy failed", "deploy done"]
+        by_author = await index.search(GUILD_ID, "deploy", author_id=2)
+        assert contents(by_author) == ["deploy failed"]
+        after = await index.search(GUILD_ID, "deploy", after=BASE_TIME + timedelta(minutes=3), sort="newest")
+        assert contents(after) == ["deploy elsewhere", "deploy in thread"]
+
+        first = await index.search(GUILD_ID, "deploy", sort="newest", limit=3)
+        assert first["has_more"] and first["next_offset"] == 3
+        rest = await index.search(GUILD_ID, "deploy", sort="newest", limit=3, offset=3)
+        assert contents(rest) == ["deploy done"] and not rest["has_more"]
+
+    asyncio.run(main())
+
+
+def test_edit_and_delete_are_reflected(tmp_path):
+    first, second = row(1, "古いお知らせ"), row(2, "消えるお知らせ")
+    index = make_index(tmp_path, [first, second])
+
+    async def main():
+        await index.flush()
+        index.on_raw_message_edit(
+            SimpleNamespace(guild_id=GUILD_ID, message_id=first[0], data={"content": "新しいお知らせ"})
+        )
+        index.on_raw_message_delete(SimpleNamespace(guild_id=GUILD_ID, message_id=second[0]))
+        assert contents(await index.search(GUILD_ID, "お知らせ")) == ["新しいお知らせ"]
+        assert contents(await index.search(GUILD_ID, "古いお知")) == []
+
+    asyncio.run(main())
+
+
+def test_other_guilds_are_not_searched(tmp_path):
+    index = make_index(tmp_path, [row(1, "secret plan")])
+
+    async def main():
+        assert contents(await index.search(GUILD_ID + 1, "secret")) == []
+
+    asyncio.run(main())